@@ -0,0 +1,307 @@
+"""
+End-to-end reaction time: a lift raising SAVE / TAKE in its COMMAND word until the order is created
+and ORDER_HANDLE is acknowledged
+
+    python -m benchmarks.bench_e2e [--quick] [--lifts 1 --lifts 10] [--rounds 10] \
+        [--plc-latency 0.005] [--rest-latency 0.05] [--threshold ack.p99_ms=4000] [--output ...]
+
+The adapter runs its per-lift monitors and the PLC heartbeats against a simulated PLC with N lifts
+(benchmarks/synthetic.py) and a stub GzRobot REST server. Lifts come in pairs sharing the COMMAND and
+ORDER_HANDLE words on their own bits, like lift-a / lift-b of signal.json. Every lift behaves like the PLC does:
+after a random idle time it writes the car number, raises a command bit, drops it once ORDER_HANDLE
+is set and waits for the adapter to clear ORDER_HANDLE before the next command.
+
+For every command two latencies are recorded from the moment the bit is raised:
+    ack: ORDER_HANDLE written to the PLC
+    order: create_order received by the REST server (sent by the order outbox)
+A command without both within --timeout seconds is counted as missed.
+The process exits with 1 when a threshold is exceeded in any scenario
+"""
+import os
+import asyncio
+import argparse
+import itertools
+import tempfile
+import random
+from typing import Any, Dict, List, Optional
+
+from benchmarks.common import make_order_outbox, start_simulator, stop_simulator, summarize, write_results
+from benchmarks.stub_restapi import StubRestApi
+from benchmarks.synthetic import make_device_conf
+from core.adapter import Adapter
+from core.adapter import adapter as adapter_module
+from utils import conf
+from utils.gzrobot import restapi
+from utils.protocol.http.aio_http_client import AioHttpClient
+from utils.protocol.mc.aio_mc_simulator import (
+    McPlcSimulator, McRegisterFile, preload_signal, tick_heartbeat
+)
+
+
+# the defaults allow one poll interval (3 s) plus the 0.5 s settle time of monitor_generate_order
+THRESHOLDS = {
+    "ack.p50_ms": 3000,
+    "ack.p99_ms": 4000,
+    "order.p50_ms": 3000,
+    "order.p99_ms": 4000,
+    "missed": 0,
+}
+
+TASKS = (
+    # (command bit, car number register, ORDER_HANDLE bit)
+    ("SAVE", "SAVE_NUMBER", "SAVE_CAR_HANDLE"),
+    ("TAKE", "TAKE_NUMBER", "TAKE_CAR_HANDLE"),
+)
+
+
+class WatchedRegisterFile(McRegisterFile):
+    """
+    A register file that resolves futures when a bit of a word reaches a value
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._watchers: Dict[int, List[tuple]] = {}
+
+    def watch_bit(self, addr: int, bit: int, value: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+
+        if (self.get_word("D", addr) >> bit & 1) == value:
+            future.set_result(asyncio.get_running_loop().time())
+        else:
+            self._watchers.setdefault(addr, []).append((bit, value, future))
+
+        return future
+
+    def set_word(self, device: str, addr: int, value: int) -> None:
+        super().set_word(device, addr, value)
+
+        if device != "D" or addr not in self._watchers:
+            return
+
+        now = asyncio.get_running_loop().time()
+        pending = []
+
+        for bit, expected, future in self._watchers.pop(addr):
+            if future.done():
+                continue
+            if (value >> bit & 1) == expected:
+                future.set_result(now)
+            else:
+                pending.append((bit, expected, future))
+
+        if pending:
+            self._watchers[addr] = pending
+
+
+def set_bit(register_file: McRegisterFile, addr: int, bit: int, value: int) -> None:
+    word = register_file.get_word("D", addr)
+    register_file.set_word("D", addr, word | 1 << bit if value else word & ~(1 << bit))
+
+
+async def drive_lift(sub_device_conf: Dict[str, Any], register_file: WatchedRegisterFile, rest: StubRestApi,
+                     rounds: int, idle: float, timeout: float, car_numbers, rng: random.Random,
+                     trials: List[Dict[str, Any]]) -> None:
+    """
+    Issue `rounds` commands like the PLC of a lift does, one at a time
+    """
+    loop = asyncio.get_running_loop()
+    name = sub_device_conf["NAME"]
+    recv_conf = sub_device_conf["SIGNAL"]["RECV"]
+    handle_conf = sub_device_conf["SIGNAL"]["SEND"]["ORDER_HANDLE"]
+    command_addr = recv_conf["COMMAND"]["ADDRESS"]
+
+    for _ in range(rounds):
+        await asyncio.sleep(rng.uniform(0, idle))
+
+        command, number_key, handle_key = rng.choice(TASKS)
+        command_bit = recv_conf["COMMAND"]["BIT"][command]
+        handle_bit = handle_conf["BIT"][handle_key]
+        car_number = next(car_numbers)
+
+        trial: Dict[str, Any] = {"lift": name, "command": command, "car_number": car_number}
+        trials.append(trial)
+
+        register_file.set_word("D", recv_conf[number_key]["ADDRESS"], car_number)
+        ack = register_file.watch_bit(handle_conf["ADDRESS"], handle_bit, 1)
+
+        raised_at = loop.time()
+        set_bit(register_file, command_addr, command_bit, 1)
+
+        try:
+            trial["ack"] = await asyncio.wait_for(ack, timeout) - raised_at
+        except asyncio.TimeoutError:
+            pass
+
+        set_bit(register_file, command_addr, command_bit, 0)
+
+        try:
+            remaining = max(0.0, timeout - (loop.time() - raised_at))
+            trial["order"] = await rest.wait_order(name, car_number, remaining) - raised_at
+        except asyncio.TimeoutError:
+            pass
+
+        # the next command is only issued after the adapter has finished the handshake
+        try:
+            await asyncio.wait_for(register_file.watch_bit(handle_conf["ADDRESS"], handle_bit, 0), timeout)
+        except asyncio.TimeoutError:
+            set_bit(register_file, handle_conf["ADDRESS"], handle_bit, 0)
+
+
+async def run_scenario(lifts: int, rounds: int, idle: float, timeout: float, plc_latency: float,
+                       rest_latency: float, seed: int) -> Dict[str, Any]:
+    device_conf = make_device_conf(lifts)
+    register_file = WatchedRegisterFile()
+    heartbeats = preload_signal(register_file, device_conf)
+
+    simulator = McPlcSimulator(register_file, latency=plc_latency)
+    simulator_task, device_conf["PORT"] = await start_simulator(simulator)
+
+    rest = StubRestApi(latency=rest_latency)
+    http_client = AioHttpClient(base_url=await rest.start(), keep_alive=True, timeout=60)
+    default_http_client, restapi.aio_requests = restapi.aio_requests, http_client
+
+    outbox_dir = tempfile.TemporaryDirectory()
+    default_outbox = adapter_module.order_outbox
+    adapter_module.order_outbox = make_order_outbox(os.path.join(outbox_dir.name, "outbox.db"))
+    await adapter_module.order_outbox.start()
+
+    adapter = Adapter(device_conf)
+    adapter.load_sub_device()
+
+    # the PLC facing loops of Adapter.run, the database driven reports are left out
+    loops = [
+        asyncio.create_task(coro) for coro in (
+            *(tick_heartbeat(register_file, *heartbeat) for heartbeat in heartbeats),
+            adapter.get_base_device().send_heartbeat(),
+            adapter.get_base_device().recv_heartbeat(),
+            *adapter.for_each_sub_device(adapter.monitor_generate_order),
+            *adapter.for_each_sub_device(adapter.monitor_clear_error),
+            *adapter.for_each_sub_device(adapter.monitor_clear_signal),
+            adapter.monitor_clear_reverse_car_number(),
+        )
+    ]
+
+    trials: List[Dict[str, Any]] = []
+    car_numbers = itertools.count(1)
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+
+    try:
+        requests_before = simulator.get_stats()["requests"]
+        started_at = loop.time()
+
+        await asyncio.gather(*(
+            drive_lift(sub_device_conf, register_file, rest, rounds, idle, timeout, car_numbers, rng, trials)
+            for sub_device_conf in device_conf["SUB_DEVICE"]
+        ))
+
+        elapsed = loop.time() - started_at
+        plc_requests = simulator.get_stats()["requests"] - requests_before
+    finally:
+        for task in loops:
+            task.cancel()
+        await asyncio.gather(*loops, return_exceptions=True)
+
+        await adapter_module.order_outbox.close()
+        adapter_module.order_outbox = default_outbox
+        outbox_dir.cleanup()
+
+        restapi.aio_requests = default_http_client
+        await http_client.close()
+        await rest.close()
+
+        await adapter.get_base_device().get_client().close()
+        await stop_simulator(simulator_task)
+
+    return {
+        "lifts": lifts,
+        "commands": len(trials),
+        "missed": sum(1 for trial in trials if "ack" not in trial or "order" not in trial),
+        "duplicate_orders": len(rest.get_orders()) - sum(1 for trial in trials if "order" in trial),
+        "plc_requests_per_s": round(plc_requests / elapsed, 1),
+        "ack": summarize([trial["ack"] for trial in trials if "ack" in trial]),
+        "order": summarize([trial["order"] for trial in trials if "order" in trial]),
+    }
+
+
+def get_value(scenario: Dict[str, Any], metric: str) -> Any:
+    rr: Any = scenario
+    for key in metric.split("."):
+        rr = rr[key]
+    return rr
+
+
+def check_thresholds(scenarios: Dict[str, Dict[str, Any]], thresholds: Dict[str, float]) -> List[str]:
+    failures = []
+
+    for name, scenario in scenarios.items():
+        for metric, limit in thresholds.items():
+            value = get_value(scenario, metric)
+            if value > limit:
+                failures.append("{} {} = {} > {}".format(name, metric, value, limit))
+
+    return failures
+
+
+def parse_threshold(value: str) -> tuple:
+    metric, limit = value.split("=")
+    if metric not in THRESHOLDS:
+        raise argparse.ArgumentTypeError("unknown metric {}, one of {}".format(metric, ", ".join(THRESHOLDS)))
+    return metric, float(limit)
+
+
+async def run(lift_counts: List[int], rounds: int, idle: float, timeout: float, plc_latency: float,
+              rest_latency: float, seed: int) -> Dict[str, Dict[str, Any]]:
+    # the benchmark must not append to the production register journal
+    conf["JOURNAL"]["ENABLE"] = False
+
+    return {
+        "lifts_{}".format(lifts): await run_scenario(lifts, rounds, idle, timeout, plc_latency, rest_latency, seed)
+        for lifts in lift_counts
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Lift command to order creation latency")
+    parser.add_argument("--quick", action="store_true", help="1 and 10 lifts, 3 commands per lift")
+    parser.add_argument("--lifts", type=int, action="append", help="number of lifts, repeatable (default 1, 10, 50)")
+    parser.add_argument("--rounds", type=int, default=10, help="commands issued by every lift")
+    parser.add_argument("--idle", type=float, default=3, help="max random seconds between two commands of a lift")
+    parser.add_argument("--timeout", type=float, default=15, help="seconds after which a command is missed")
+    parser.add_argument("--plc-latency", type=float, default=0.005, help="seconds added to every PLC response")
+    parser.add_argument("--rest-latency", type=float, default=0.05, help="seconds added to every REST response")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threshold", type=parse_threshold, action="append", default=[], metavar="METRIC=VALUE",
+                        help="override a threshold, e.g. ack.p99_ms=4000")
+    parser.add_argument("--output", help="result file, default benchmarks/results/bench_e2e.json")
+    args = parser.parse_args(argv)
+
+    lift_counts = args.lifts or ([1, 10] if args.quick else [1, 10, 50])
+    rounds = 3 if args.quick else args.rounds
+    thresholds = {**THRESHOLDS, **dict(args.threshold)}
+
+    scenarios = asyncio.run(run(lift_counts, rounds, args.idle, args.timeout, args.plc_latency,
+                                args.rest_latency, args.seed))
+    failures = check_thresholds(scenarios, thresholds)
+
+    print(write_results("bench_e2e", {
+        "parameters": {
+            "rounds": rounds,
+            "idle_s": args.idle,
+            "plc_latency_s": args.plc_latency,
+            "rest_latency_s": args.rest_latency,
+        },
+        "thresholds": thresholds,
+        "scenarios": scenarios,
+        "failures": failures,
+    }, args.output))
+
+    for failure in failures:
+        print("FAIL {}".format(failure))
+
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""
+Fleet scale load: Adapter.run against a simulated PLC, a stub REST server and an in-memory database
+for a synthetic fleet
+
+    python -m benchmarks.bench_fleet [--quick] [--agvs 100] [--lifts 10] [--duration 60] [--churn 5] \
+        [--plc-latency 0.005] [--rest-latency 0.02] [--db-latency 0.002] [--output ...]
+
+- the signal map, the database rows and the REST payloads are synthesized for --agvs agvs and --lifts lifts
+  (benchmarks/synthetic.py), --churn agvs change their state every second
+- every lift issues a SAVE / TAKE command every --command-interval seconds on average
+- the database is benchmarks/fake_db.py (change notifications are disabled, the adapter polls),
+  the register journal is disabled
+
+Reports PLC frames, database queries and REST requests per second, the event loop lag and the memory
+"""
+import os
+import asyncio
+import argparse
+import itertools
+import random
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from benchmarks.bench_e2e import WatchedRegisterFile, drive_lift
+from benchmarks.common import (
+    get_rss_mb, make_order_outbox, sample_loop_lag, start_simulator, stop_simulator, summarize, write_results
+)
+from benchmarks.fake_db import FakeDatabase
+from benchmarks.stub_restapi import StubRestApi
+from benchmarks.synthetic import SyntheticFleet, make_device_conf
+from core.adapter import Adapter
+from core.adapter import adapter as adapter_module
+from utils import conf, aiopg
+from utils.gzrobot import restapi
+from utils.protocol.http.aio_http_client import AioHttpClient
+from utils.protocol.mc.aio_mc_simulator import McPlcSimulator, preload_signal, tick_heartbeat
+
+
+def get_db_calls() -> Dict[str, int]:
+    return {name: int(stats["calls"]) for name, stats in aiopg.get_statement_stats().items()}
+
+
+def get_rate_delta(before: Dict[str, int], after: Dict[str, int], elapsed: float) -> Dict[str, float]:
+    return {
+        key: round((after.get(key, 0) - before.get(key, 0)) / elapsed, 2)
+        for key in sorted(after)
+        if after.get(key, 0) != before.get(key, 0)
+    }
+
+
+async def churn_fleet(fleet: SyntheticFleet, count: int) -> None:
+    while True:
+        await asyncio.sleep(1)
+        fleet.churn(count)
+
+
+async def sample_rss(samples: List[float], interval: float = 1) -> None:
+    while True:
+        samples.append(get_rss_mb())
+        await asyncio.sleep(interval)
+
+
+async def run(agvs: int, lifts: int, duration: float, warmup: float, churn: int, command_interval: float,
+              plc_latency: float, rest_latency: float, db_latency: float, seed: int) -> Dict[str, Any]:
+    # the adapter polls the database, and must not append to the production register journal
+    conf["JOURNAL"]["ENABLE"] = False
+    conf["DATABASE_NOTIFY"]["ENABLE"] = False
+    conf["GP_CACHE"]["NOTIFY"] = False
+
+    rss_at_start = get_rss_mb()
+
+    fleet = SyntheticFleet(agvs, seed=seed)
+    device_conf = make_device_conf(lifts, agvs)
+    register_file = WatchedRegisterFile()
+    heartbeats = preload_signal(register_file, device_conf)
+
+    simulator = McPlcSimulator(register_file, latency=plc_latency)
+    simulator_task, device_conf["PORT"] = await start_simulator(simulator)
+
+    rest = StubRestApi(latency=rest_latency, agvs=fleet.get_agv_list(), errors=fleet.errors)
+    http_client = AioHttpClient(base_url=await rest.start(), keep_alive=True, timeout=60)
+    default_http_client, restapi.aio_requests = restapi.aio_requests, http_client
+
+    database = FakeDatabase(fleet, latency=db_latency)
+    database.install(aiopg)
+
+    outbox_dir = tempfile.TemporaryDirectory()
+    default_outbox = adapter_module.order_outbox
+    adapter_module.order_outbox = make_order_outbox(os.path.join(outbox_dir.name, "outbox.db"))
+
+    lags: List[float] = []
+    rss_samples: List[float] = []
+    trials: List[Dict[str, Any]] = []
+    car_numbers = itertools.count(1)
+    rng = random.Random(seed)
+
+    adapter = Adapter(device_conf)
+    await adapter.run()
+
+    tasks = [
+        adapter.get_loops(),
+        *(asyncio.create_task(tick_heartbeat(register_file, *heartbeat)) for heartbeat in heartbeats),
+        asyncio.create_task(churn_fleet(fleet, churn)),
+        *(
+            asyncio.create_task(drive_lift(sub_device_conf, register_file, rest, 1 << 30, command_interval * 2,
+                                           command_interval * 5, car_numbers, rng, trials))
+            for sub_device_conf in device_conf["SUB_DEVICE"]
+        ),
+    ]
+
+    loop = asyncio.get_running_loop()
+
+    try:
+        await asyncio.sleep(warmup)
+
+        tasks.append(asyncio.create_task(sample_loop_lag(lags)))
+        tasks.append(asyncio.create_task(sample_rss(rss_samples)))
+
+        plc_before = simulator.get_stats()["requests"]
+        db_before = get_db_calls()
+        rest_before = rest.get_stats()
+        trials_before = len(trials)
+        started_at = loop.time()
+
+        await asyncio.sleep(duration)
+
+        elapsed = loop.time() - started_at
+        plc_after = simulator.get_stats()["requests"]
+        db_after = get_db_calls()
+        rest_after = rest.get_stats()
+        commands = len(trials) - trials_before
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await adapter_module.order_outbox.close()
+        adapter_module.order_outbox = default_outbox
+        outbox_dir.cleanup()
+
+        database.uninstall()
+
+        restapi.aio_requests = default_http_client
+        await http_client.close()
+        await rest.close()
+
+        await adapter.get_base_device().get_client().close()
+        await stop_simulator(simulator_task)
+
+    db_rates = get_rate_delta(db_before, db_after, elapsed)
+    rest_rates = get_rate_delta(rest_before, rest_after, elapsed)
+
+    return {
+        "agvs": agvs,
+        "lifts": lifts,
+        "duration_s": round(elapsed, 2),
+        "plc_frames_per_s": round((plc_after - plc_before) / elapsed, 2),
+        "db_queries_per_s": round(sum(db_rates.values()), 2),
+        "db_statements_per_s": db_rates,
+        "rest_requests_per_s": round(sum(rest_rates.values()), 2),
+        "rest_endpoints_per_s": rest_rates,
+        "lift_commands": commands,
+        "loop_lag": summarize(lags),
+        "memory": {
+            "rss_at_start_mb": rss_at_start,
+            "rss_min_mb": min(rss_samples, default=0.0),
+            "rss_max_mb": max(rss_samples, default=0.0),
+            "rss_at_end_mb": rss_samples[-1] if rss_samples else 0.0,
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Fleet scale synthetic load")
+    parser.add_argument("--quick", action="store_true", help="a 10 seconds run")
+    parser.add_argument("--agvs", type=int, default=100)
+    parser.add_argument("--lifts", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before the measure starts")
+    parser.add_argument("--churn", type=int, help="agvs changing state every second (default 5%% of the fleet)")
+    parser.add_argument("--command-interval", type=float, default=10,
+                        help="mean seconds between two commands of a lift")
+    parser.add_argument("--plc-latency", type=float, default=0.005, help="seconds added to every PLC response")
+    parser.add_argument("--rest-latency", type=float, default=0.02, help="seconds added to every REST response")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="seconds added to every database query")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file, default benchmarks/results/bench_fleet.json")
+    args = parser.parse_args(argv)
+
+    duration = 10 if args.quick else args.duration
+    warmup = 2 if args.quick else args.warmup
+    churn = args.churn if args.churn is not None else max(1, args.agvs // 20)
+
+    results = asyncio.run(run(args.agvs, args.lifts, duration, warmup, churn, args.command_interval,
+                              args.plc_latency, args.rest_latency, args.db_latency, args.seed))
+    print(write_results("bench_fleet", results, args.output))
+
+
+if __name__ == "__main__":
+    main()
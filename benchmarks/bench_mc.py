@@ -0,0 +1,205 @@
+"""
+MC codec and client round trip benchmarks
+
+    python -m benchmarks.bench_mc [--quick] [--output benchmarks/results/bench_mc.json]
+
+- codec: encode / decode cost per frame, ASCII vs binary, for 1 / 10 / 100 / 960 words
+- client: AioMcClient.recv_register / send_register against a canned in-memory transport (no network),
+  the codec above plus the client's locking, metrics and reads
+- round_trip: throughput and latency against a local simulator with 1 / 10 / 100 concurrent callers
+  sharing one client, like the devices of an adapter do
+- poll_cycle: one iteration of every per-lift monitor of Adapter against the simulator
+"""
+import copy
+import asyncio
+import argparse
+
+from benchmarks.common import (
+    run_callers, seed_connection_pool, start_simulator, stop_simulator, summarize, time_per_call, write_results
+)
+from utils import sig_cfg
+from utils.protocol.mc import frame
+from utils.protocol.mc.aio_mc_client import AioMcClient
+from utils.protocol.mc.aio_mc_simulator import McPlcSimulator, McRegisterFile, preload_signal
+
+
+WORD_COUNTS = (1, 10, 100, 960)
+CONCURRENCY = (1, 10, 100)
+
+
+class CannedTransport:
+    """
+    Answer every request with the same response
+    """
+
+    def __init__(self, response: bytes) -> None:
+        self._response = response
+        self._buffer = b""
+
+    def is_closing(self) -> bool:
+        return False
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def write(self, data) -> None:
+        self._buffer = self._response
+
+    async def read(self, n=-1) -> bytes:
+        if n < 0:
+            n = len(self._buffer)
+        rr, self._buffer = self._buffer[:n], self._buffer[n:]
+        return rr
+
+    async def readexactly(self, n) -> bytes:
+        if len(self._buffer) < n:
+            raise asyncio.IncompleteReadError(self._buffer, n)
+        return await self.read(n)
+
+
+def bench_codec() -> dict:
+    rr = {}
+
+    for is_ascii in (True, False):
+        for count in WORD_COUNTS:
+            values = list(range(count))
+            read_request = frame.encode_batch_read_request("D", 11000, count, is_ascii)
+            response = frame.encode_response(frame.decode_request(read_request), values)
+
+            def decode_read_response():
+                frame.decode_words(frame.decode_response(response)[1], is_ascii)
+
+            rr["{}_{}".format("ascii" if is_ascii else "binary", count)] = {
+                "frame_bytes": len(response),
+                "encode_read_request_us": time_per_call(
+                    lambda: frame.encode_batch_read_request("D", 11000, count, is_ascii)),
+                "decode_read_response_us": time_per_call(decode_read_response),
+                "encode_write_request_us": time_per_call(
+                    lambda: frame.encode_batch_write_request("D", 11000, values, is_ascii)),
+                "encode_random_write_request_us": time_per_call(
+                    lambda: frame.encode_random_write_request(
+                        (("D", 11000 + index, value) for index, value in enumerate(values[:160])), is_ascii)),
+            }
+
+    return rr
+
+
+async def bench_client() -> dict:
+    """
+    AioMcClient's own cost per call, it only speaks ASCII 3E
+    """
+    rr = {}
+    loop = asyncio.get_running_loop()
+
+    for count in WORD_COUNTS:
+        request = frame.decode_request(frame.encode_batch_read_request("D", 11000, count))
+        read_client = AioMcClient("canned", 0, transport=CannedTransport(frame.encode_response(request, range(count))))
+        write_client = AioMcClient("canned", 0, transport=CannedTransport(frame.encode_response(request)))
+        values = list(range(count))
+
+        async def repeat(coro_fn, number=2000 // count + 100):
+            started_at = loop.time()
+            for _ in range(number):
+                await coro_fn()
+            return round((loop.time() - started_at) / number * 1e6, 4)
+
+        rr[str(count)] = {
+            "recv_register_us": await repeat(lambda: read_client.recv_register(11000, count)),
+            "send_register_us": await repeat(lambda: write_client.send_register(11000, values)),
+        }
+
+    return rr
+
+
+async def bench_round_trip(total: int) -> dict:
+    rr = {}
+    simulator = McPlcSimulator()
+    task, port = await start_simulator(simulator)
+
+    try:
+        for concurrency in CONCURRENCY:
+            client = AioMcClient("127.0.0.1", port)
+
+            for count in (1, 100):
+                elapsed, latencies = await run_callers(
+                    concurrency, total, lambda: client.recv_register(11000, count))
+
+                rr["read_{}_words_x{}".format(count, concurrency)] = {
+                    "throughput_per_s": round(total / elapsed, 1),
+                    **summarize(latencies),
+                }
+
+            await client.close()
+    finally:
+        await stop_simulator(task)
+
+    return rr
+
+
+async def bench_poll_cycle(cycles: int) -> dict:
+    """
+    One cycle is an iteration of monitor_generate_order, monitor_clear_error and monitor_clear_signal
+    for every lift, the lifts are idle in AUTO mode (no order, no REST call)
+    """
+    from core.adapter import Adapter
+
+    device_conf = copy.deepcopy(sig_cfg["DEVICE"][0])
+    register_file = McRegisterFile()
+    preload_signal(register_file, device_conf)
+
+    simulator = McPlcSimulator(register_file)
+    task, port = await start_simulator(simulator)
+
+    client = AioMcClient("127.0.0.1", port)
+
+    try:
+        seed_connection_pool(device_conf, client)
+
+        adapter = Adapter(device_conf)
+        adapter.load_sub_device()
+
+        async def cycle():
+            await asyncio.gather(*(
+                monitor.__wrapped__(adapter, sub_device)
+                for sub_device in adapter.get_all_sub_devices()
+                for monitor in (Adapter.monitor_generate_order, Adapter.monitor_clear_error, Adapter.monitor_clear_signal)
+            ))
+
+        await cycle()
+        requests_before = simulator.get_stats()["requests"]
+        _, latencies = await run_callers(1, cycles, cycle)
+
+        return {
+            "lifts": len(adapter.get_all_sub_devices()),
+            "frames_per_cycle": (simulator.get_stats()["requests"] - requests_before) / cycles,
+            **summarize(latencies),
+        }
+    finally:
+        await client.close()
+        await stop_simulator(task)
+
+
+async def run(quick: bool) -> dict:
+    return {
+        "codec": bench_codec(),
+        "client": await bench_client(),
+        "round_trip": await bench_round_trip(500 if quick else 5000),
+        "poll_cycle": await bench_poll_cycle(20 if quick else 200),
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="MC codec and client benchmarks")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a smoke run")
+    parser.add_argument("--output", help="result file, default benchmarks/results/bench_mc.json")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.quick))
+    print(write_results("bench_mc", results, args.output))
+
+
+if __name__ == "__main__":
+    main()
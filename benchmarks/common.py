@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import timeit
+import asyncio
+import platform
+import resource
+import datetime
+import subprocess
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from core.device.implement import BaseDevice
+from utils import conf
+from utils.aio_outbox import AioOutbox
+from utils.protocol.tcp.aio_tcp_server import AioTcpServer
+from utils.protocol.mc.aio_mc_client import AioMcClient
+from utils.protocol.mc.aio_mc_simulator import McPlcSimulator
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentile(sorted_values: Sequence[float], p: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """
+    Latency statistics in milliseconds
+    """
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 4) if values else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 4),
+        "p90_ms": round(percentile(values, 90) * 1000, 4),
+        "p99_ms": round(percentile(values, 99) * 1000, 4),
+        "max_ms": round(values[-1] * 1000, 4) if values else 0.0,
+    }
+
+
+def time_per_call(fn: Callable[[], Any], repeat: int = 5) -> float:
+    """
+    Best time of one call in microseconds, the number of calls per run is chosen by timeit
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return round(min(timer.repeat(repeat=repeat, number=number)) / number * 1e6, 4)
+
+
+def get_environment() -> Dict[str, Any]:
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip()
+    except Exception:
+        revision = ""
+
+    return {
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "git_revision": revision,
+    }
+
+
+def write_results(name: str, results: Dict[str, Any], output: Optional[str] = None) -> str:
+    """
+    Write the results with the environment to `output` (default benchmarks/results/<name>.json)
+    """
+    output = output or os.path.join(RESULTS_DIR, "{}.json".format(name))
+
+    dirname = os.path.dirname(output)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+
+    with open(output, mode="w", encoding="UTF-8") as f:
+        json.dump({
+            "benchmark": name,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "environment": get_environment(),
+            "results": results,
+        }, f, indent=2, ensure_ascii=False)
+
+    return output
+
+
+async def start_simulator(simulator: McPlcSimulator, host: str = "127.0.0.1") -> Tuple[asyncio.Task, int]:
+    """
+    Serve the simulator on an ephemeral port, returns the serving task and the port
+    """
+    server = AioTcpServer((host, 0), simulator.get_handler_class())
+    task = asyncio.create_task(server.serve_forever())
+
+    while server.server is None or not server.server.sockets:
+        await asyncio.sleep(0.01)
+
+    return task, server.server.sockets[0].getsockname()[1]
+
+
+async def stop_simulator(task: asyncio.Task) -> None:
+    """
+    Stop a simulator started by start_simulator(), the clients should be closed first
+    so the connection handlers can finish on their own
+    """
+    await asyncio.sleep(0.05)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def run_callers(concurrency: int, total: int, call: Callable[[], Any]) -> Tuple[float, List[float]]:
+    """
+    Run `total` calls spread over `concurrency` callers, returns the elapsed seconds and every call's latency
+    """
+    latencies: List[float] = []
+    remaining = [total]
+
+    async def caller():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started_at = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    return time.perf_counter() - started_at, latencies
+
+
+async def sample_loop_lag(lags: List[float], interval: float = 0.1) -> None:
+    """
+    Append how late every wakeup of a `interval` sleep is, in seconds, until cancelled
+    """
+    loop = asyncio.get_running_loop()
+
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - started_at - interval))
+
+
+def get_rss_mb() -> float:
+    """
+    Resident set size of the process, the peak size where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm", mode="r") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 2)
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return round(rss / 1024 / (1024 if sys.platform == "darwin" else 1), 2)
+
+
+def seed_connection_pool(device_conf: Dict[str, Any], client: AioMcClient) -> None:
+    """
+    Make the devices of `device_conf` (signal.json) use `client` instead of connecting to the configured PLC
+    """
+    BaseDevice._connection_pool[device_conf["HOST"] + str(device_conf["PORT"])] = client
+
+
+def make_order_outbox(path: str) -> AioOutbox:
+    """
+    An order outbox configured like the adapter's (conf["OUTBOX"]) but stored at `path`
+    """
+    from core.adapter import adapter as adapter_module
+
+    OUTBOX_CONF = conf["OUTBOX"]
+    return AioOutbox(
+        path=path,
+        handler=adapter_module.submit_order,
+        workers=OUTBOX_CONF["WORKERS"],
+        max_retries=OUTBOX_CONF["MAX_RETRIES"],
+        backoff=OUTBOX_CONF["BACKOFF"],
+        max_backoff=OUTBOX_CONF["MAX_BACKOFF"],
+    )
@@ -0,0 +1,70 @@
+"""
+Compare two benchmark result files
+
+    python -m benchmarks.compare old.json new.json [--threshold 10]
+
+Every numeric result is compared, metrics ending in _us / _ms are better when lower,
+metrics containing "per_s" are better when higher. Exits with 1 when a metric regressed
+by more than `threshold` percent
+"""
+import sys
+import json
+import argparse
+from typing import Any, Dict
+
+
+def flatten(obj: Any, prefix: str = "") -> Dict[str, float]:
+    rr = {}
+
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            rr.update(flatten(value, "{}.{}".format(prefix, key) if prefix else key))
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        rr[prefix] = float(obj)
+
+    return rr
+
+
+def get_direction(metric: str) -> int:
+    """
+    1 when higher is better, -1 when lower is better, 0 when the metric is informational
+    """
+    name = metric.rsplit(".", 1)[-1]
+    if "per_s" in name:
+        return 1
+    if name.endswith("_us") or name.endswith("_ms"):
+        return -1
+    return 0
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=10, help="regression threshold in percent")
+    args = parser.parse_args(argv)
+
+    with open(args.old, mode="r", encoding="UTF-8") as f:
+        old = flatten(json.load(f)["results"])
+    with open(args.new, mode="r", encoding="UTF-8") as f:
+        new = flatten(json.load(f)["results"])
+
+    regressions = 0
+    for metric in sorted(set(old) & set(new)):
+        direction = get_direction(metric)
+        if not direction or not old[metric]:
+            continue
+
+        change = (new[metric] - old[metric]) / old[metric] * 100
+        regressed = change * direction < -args.threshold
+        regressions += regressed
+
+        print("{:<60} {:>12.4f} {:>12.4f} {:>+8.1f}% {}".format(
+            metric, old[metric], new[metric], change, "REGRESSION" if regressed else ""))
+
+    print("{} regression(s) over {}%".format(regressions, args.threshold))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+An in-memory stand-in for the GzRobot database, answering the named statements of utils/gzrobot/dbapi.py
+"""
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.synthetic import SyntheticFleet
+from utils.aio_postgresql import AioPostgresql
+
+
+class FakeDatabase:
+    """
+    install() replaces the raw query methods of an AioPostgresql instance, the named statements
+    (execute_named, fetch_named, ...) keep their timing counters, so get_statement_stats() still counts the queries.
+    Every query is delayed by `latency` seconds, a statement without a handler raises NotImplementedError.
+    `fleet` only needs the rows and active_orders of a SyntheticFleet (the replay passes recorded rows)
+    """
+
+    def __init__(self, fleet: SyntheticFleet, latency: float = 0) -> None:
+        self._fleet = fleet
+        self._latency = latency
+        self._aiopg: Optional[AioPostgresql] = None
+        self._names: Dict[str, str] = {}
+
+        self._handlers: Dict[str, Callable[..., Any]] = {
+            "get_all_agv_state": self.get_all_agv_state,
+            "get_agv_state": self.get_agv_state,
+            "get_agv_id_with_active_order": self.get_agv_id_with_active_order,
+            "agv_has_active_order": self.agv_has_active_order,
+            "update_io_state": lambda io_id: "UPDATE 1",
+            "update_io_states": lambda io_id_list: "UPDATE {}".format(len(io_id_list)),
+            "get_gp_value": lambda key: [],
+        }
+
+    def install(self, aiopg: AioPostgresql) -> None:
+        self._aiopg = aiopg
+        self._names = {aiopg.get_statement(name): name for name in aiopg.get_statement_stats()}
+
+        for method in ("execute", "executemany", "fetch", "fetchrow", "fetchval"):
+            setattr(aiopg, method, getattr(self, method))
+
+    def uninstall(self) -> None:
+        if self._aiopg is not None:
+            for method in ("execute", "executemany", "fetch", "fetchrow", "fetchval"):
+                delattr(self._aiopg, method)
+            self._aiopg = None
+
+    async def _call(self, query: str, *args) -> Any:
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+        name = self._names.get(query)
+        if name not in self._handlers:
+            raise NotImplementedError("{} has no handler for {}".format(__class__.__name__, name or query.strip()[:60]))
+
+        return self._handlers[name](*args)
+
+    # ---- AioPostgresql raw methods
+
+    async def execute(self, query: str, *args, timeout=None) -> str:
+        return await self._call(query, *args)
+
+    async def executemany(self, command: str, args, *, timeout=None) -> None:
+        for item in args:
+            await self._call(command, *item)
+
+    async def fetch(self, query: str, *args, timeout=None, record_class=None) -> list:
+        return await self._call(query, *args)
+
+    async def fetchrow(self, query: str, *args, timeout=None, record_class=None):
+        rr = await self._call(query, *args)
+        return rr[0] if rr else None
+
+    async def fetchval(self, query: str, *args, column=0, timeout=None):
+        row = await self.fetchrow(query, *args)
+        return None if row is None else list(row.values())[column]
+
+    # ---- statements
+
+    def get_all_agv_state(self) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self._fleet.rows.values()]
+
+    def get_agv_state(self, agv_id: int) -> List[Dict[str, Any]]:
+        row = self._fleet.rows.get(agv_id)
+        return [] if row is None else [dict(row)]
+
+    def get_agv_id_with_active_order(self) -> List[Dict[str, Any]]:
+        return [{"agv_id": agv_id} for agv_id in self._fleet.active_orders]
+
+    def agv_has_active_order(self, agv_id: int) -> List[Dict[str, Any]]:
+        return [{"order_id": "synthetic-{}".format(agv_id)}] if agv_id in self._fleet.active_orders else []
@@ -0,0 +1,119 @@
+"""
+A stub GzRobot REST server for benchmarks, it answers the endpoints used by utils/gzrobot/restapi.py
+"""
+import json
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+
+class StubRestApi:
+    """
+    Every request is delayed by `latency` seconds, created orders are kept with their arrival time
+
+    `agvs` is the data of /api/engine/basic-data/agvs/, `errors` maps an agv_id to its errors
+    """
+
+    def __init__(self, latency: float = 0, agvs: Optional[List[Dict[str, Any]]] = None,
+                 errors: Optional[Dict[int, List[Dict[str, Any]]]] = None) -> None:
+        self._latency = latency
+        self._agvs = agvs or []
+        self._errors = errors or {}
+
+        self._runner: Optional[web.AppRunner] = None
+        self._orders: List[Dict[str, Any]] = []
+        # (device_name, car_number) -> future of the arrival time
+        self._order_waiters: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._stats: Dict[str, int] = {}
+
+    def get_orders(self) -> List[Dict[str, Any]]:
+        return list(self._orders)
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self._stats)
+
+    def get_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.post("/api/om/order/", self.create_order),
+            web.get("/api/engine/basic-data/agvs/", self.get_agvs),
+            web.get("/api/engine/errors/agvs/", self.get_all_errors),
+            web.get("/api/engine/errors/agvs/{agv_id}/", self.get_errors),
+            web.post("/api/engine/ctrl-mgr/clear-fault/", self.clear_fault),
+        ])
+        return app
+
+    async def start(self, host: str = "127.0.0.1") -> str:
+        """
+        Serve on an ephemeral port, returns the base url
+        """
+        self._runner = web.AppRunner(self.get_app(), access_log=None)
+        await self._runner.setup()
+
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+
+        port = self._runner.addresses[0][1]
+        return "http://{}:{}".format(host, port)
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def wait_order(self, device_name: str, car_number: int, timeout: float) -> float:
+        """
+        Wait for the order of a lift and a car number, returns the loop time it arrived at
+        """
+        key = (device_name, str(car_number))
+        future = self._order_waiters.setdefault(key, asyncio.get_running_loop().create_future())
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        finally:
+            if future.done():
+                self._order_waiters.pop(key, None)
+
+    async def _enter(self, name: str) -> float:
+        arrived_at = asyncio.get_running_loop().time()
+        self._stats[name] = self._stats.get(name, 0) + 1
+
+        if self._latency:
+            await asyncio.sleep(self._latency)
+
+        return arrived_at
+
+    async def create_order(self, request: web.Request) -> web.Response:
+        arrived_at = await self._enter("create_order")
+
+        body = await request.json()
+        task_info = json.loads(body["parameters"])["task_info"]
+
+        self._orders.append({"arrived_at": arrived_at, **body})
+
+        key = (task_info["device_name"], task_info["car_number"])
+        future = self._order_waiters.setdefault(key, asyncio.get_running_loop().create_future())
+        if not future.done():
+            future.set_result(arrived_at)
+
+        return web.json_response({"code": 0, "data": [{"in_order_id": len(self._orders)}], "msg": ""})
+
+    async def get_agvs(self, request: web.Request) -> web.Response:
+        await self._enter("get_agvs")
+        return web.json_response({"code": 0, "data": self._agvs})
+
+    async def get_all_errors(self, request: web.Request) -> web.Response:
+        await self._enter("get_all_errors")
+        return web.json_response({
+            "code": 0,
+            "data": [dict(error, agv_id=agv_id) for agv_id, errors in self._errors.items() for error in errors],
+        })
+
+    async def get_errors(self, request: web.Request) -> web.Response:
+        await self._enter("get_errors")
+        return web.json_response({"code": 0, "data": self._errors.get(int(request.match_info["agv_id"]), [])})
+
+    async def clear_fault(self, request: web.Request) -> web.Response:
+        await self._enter("clear_fault")
+        return web.json_response({"code": 0, "data": None})
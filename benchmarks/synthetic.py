@@ -0,0 +1,159 @@
+"""
+Synthetic signal maps, database rows and REST payloads for benchmarks, derived from conf/private/signal.json
+"""
+import copy
+import random
+from typing import Any, Dict, List, Optional, Set
+
+from utils import sig_cfg
+
+
+# address distance between the signal blocks of two groups of synthetic lifts
+LIFT_STRIDE = 100
+
+# the per-agv signals of synthetic fleets start here, above the lift blocks
+AGV_BASE_ADDR = 20000
+# address distance between two per-agv signals (error, battery, car action, mode)
+AGV_STRIDE = 1000
+
+
+def shift_addresses(signal_conf: Dict[str, Any], offset: int) -> Dict[str, Any]:
+    """
+    A copy of a SIGNAL tree with every ADDRESS moved by `offset`
+    """
+    rr = copy.deepcopy(signal_conf)
+
+    def shift(node):
+        for key, value in node.items():
+            if key == "ADDRESS":
+                node[key] = value + offset
+            elif isinstance(value, dict):
+                shift(value)
+
+    shift(rr)
+    return rr
+
+
+def make_agv_signal(agvs: int, base_addr: int = AGV_BASE_ADDR, stride: int = AGV_STRIDE) -> Dict[str, Any]:
+    """
+    The REPORT_AGV_* signals of a device for agv 1 .. agvs
+
+    Errors, batteries and car actions are consecutive words, so the bulk reports are single block writes.
+    The modes take 2 bits per agv, 8 agvs per word
+    """
+    agv_id_list = [str(agv_id) for agv_id in range(1, agvs + 1)]
+
+    return {
+        "REPORT_AGV_ERROR": {agv_id: {"ADDRESS": base_addr + int(agv_id)} for agv_id in agv_id_list},
+        "REPORT_AGV_BATTERY": {agv_id: {"ADDRESS": base_addr + stride + int(agv_id)} for agv_id in agv_id_list},
+        "REPORT_CAR_ACTION": {agv_id: {"ADDRESS": base_addr + stride * 2 + int(agv_id)} for agv_id in agv_id_list},
+        "REPORT_AGV_MODE": {
+            "ADDRESS": base_addr + stride * 3,
+            **{
+                agv_id: {
+                    "ADDRESS": base_addr + stride * 3 + (int(agv_id) - 1) // 8,
+                    "BIT": {"AUTO": (int(agv_id) - 1) % 8 * 2, "RUNNING": (int(agv_id) - 1) % 8 * 2 + 1},
+                }
+                for agv_id in agv_id_list
+            },
+        },
+    }
+
+
+def make_device_conf(lifts: int, agvs: Optional[int] = None, host: str = "127.0.0.1", port: int = 5000,
+                     stride: int = LIFT_STRIDE) -> Dict[str, Any]:
+    """
+    The first device of signal.json with `lifts` sub devices on one PLC
+
+    The lifts are made in groups shaped like the configured sub devices: sub device N uses the signals
+    of configured sub device N % len(SUB_DEVICE) moved by (N // len(SUB_DEVICE)) * stride.
+    The lifts of a group share the words the configured ones share (COMMAND, ORDER_HANDLE ...)
+    on their own bits, like on the real PLC, the first group keeps the configured addresses.
+    When `agvs` is given the per-agv signals are replaced by make_agv_signal(agvs)
+    """
+    device_conf = copy.deepcopy(sig_cfg["DEVICE"][0])
+    templates = device_conf["SUB_DEVICE"]
+
+    device_conf["HOST"] = host
+    device_conf["PORT"] = port
+    device_conf["SUB_DEVICE"] = [
+        {
+            **copy.deepcopy(templates[index % len(templates)]),
+            "NAME": "lift-{}".format(index),
+            "SIGNAL": shift_addresses(templates[index % len(templates)]["SIGNAL"], index // len(templates) * stride),
+        }
+        for index in range(lifts)
+    ]
+
+    if agvs is not None:
+        device_conf["SIGNAL"]["SEND"].update(make_agv_signal(agvs))
+
+    return device_conf
+
+
+class SyntheticFleet:
+    """
+    The state of `agvs` agvs as seen by the database (agv_state rows, active orders)
+    and by the REST api (agv info, errors)
+
+    churn() changes the state of some agvs like a running site does
+    """
+
+    def __init__(self, agvs: int, seed: int = 0, fault_ratio: float = 0.05, order_ratio: float = 0.3,
+                 offline_ratio: float = 0.05) -> None:
+        self._random = random.Random(seed)
+        self._fault_ratio = fault_ratio
+        self._order_ratio = order_ratio
+        self._offline_ratio = offline_ratio
+
+        self.rows: Dict[int, Dict[str, Any]] = {}
+        self.agvs: Dict[int, Dict[str, Any]] = {}
+        self.errors: Dict[int, List[Dict[str, Any]]] = {}
+        self.active_orders: Set[int] = set()
+
+        for agv_id in range(1, agvs + 1):
+            self.agvs[agv_id] = {
+                "id": agv_id,
+                "agv_id": agv_id,
+                "agv_name": "agv-{}".format(agv_id),
+                "battery_capacity": self._random.uniform(20, 100),
+                "battery_current": self._random.uniform(0, 30),
+            }
+            self.rows[agv_id] = {"agv_id": agv_id, "can_be_connected": True}
+            self.randomize(agv_id)
+
+    def randomize(self, agv_id: int) -> None:
+        roll = self._random.random
+        connected = roll() >= self._offline_ratio
+        fault = roll() < self._fault_ratio
+
+        self.rows[agv_id].update(
+            network_connected=connected,
+            dispatch_task_active=connected,
+            fault_happened=fault,
+        )
+        self.agvs[agv_id]["fault_happened"] = fault
+        self.agvs[agv_id]["battery_capacity"] = max(0.0, min(100.0, self.agvs[agv_id]["battery_capacity"]
+                                                             + self._random.uniform(-2, 2)))
+
+        if fault:
+            self.errors[agv_id] = [{"error_code": self._random.randint(1, 999), "error_msg": "synthetic"}]
+        else:
+            self.errors.pop(agv_id, None)
+
+        if roll() < self._order_ratio:
+            self.active_orders.add(agv_id)
+        else:
+            self.active_orders.discard(agv_id)
+
+    def churn(self, count: int) -> List[int]:
+        """
+        Randomize `count` agvs, returns their ids
+        """
+        agv_id_list = self._random.sample(sorted(self.rows), min(count, len(self.rows)))
+        for agv_id in agv_id_list:
+            self.randomize(agv_id)
+        return agv_id_list
+
+    def get_agv_list(self) -> List[Dict[str, Any]]:
+        return list(self.agvs.values())
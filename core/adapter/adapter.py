@@ -1,28 +1,88 @@
+import time
 import enum
 import asyncio
+import functools
 
 from core.device import Device
 from core.device import SubDevice
 from core.device import DeviceManager
+from core.device.implement import BaseDevice, merge_read_ranges
 
-from utils import log, conf
+from utils import log, conf, aiopg_listener, metrics
+from utils.profiler import profiler
+from utils.tracing import annotate
 from utils.gzrobot import restapi, dbapi
 from utils.config import Config
+from utils.auxiliary import loop_time
+from utils.aio_outbox import AioOutbox, OUTBOX_STATUS
+
+from .fleet import FleetState, AgvStateRow
+
+
+LOOP_ITERATION_SECONDS = metrics.histogram(
+    "adapter_loop_iteration_seconds", "Duration of one iteration of an adapter job", ["job"])
+LOOP_OVERRUNS = metrics.counter(
+    "adapter_loop_overruns_total", "Iterations of an adapter job that took longer than its interval", ["job"])
+LOOP_ERRORS = metrics.counter(
+    "adapter_loop_errors_total", "Iterations of an adapter job that raised", ["job"])
 
 
 def safe_forever_loop(loop_time):
     def inner(coro):
+        iteration_seconds = LOOP_ITERATION_SECONDS.labels(coro.__name__)
+        overruns = LOOP_OVERRUNS.labels(coro.__name__)
+        errors = LOOP_ERRORS.labels(coro.__name__)
+
+        # wrapper.__wrapped__ 为单次执行的原函数（用于基准测试等场景）
+        @functools.wraps(coro)
         async def wrapper(*args, **kwargs):
             while True:
+                started_at = time.perf_counter()
                 try:
-                    await coro(*args, **kwargs)
+                    with profiler.job(coro.__name__):
+                        await coro(*args, **kwargs)
                 except Exception as e:
+                    errors.inc()
                     asyncio.get_running_loop().call_exception_handler({"exception": e})
+
+                elapsed = time.perf_counter() - started_at
+                iteration_seconds.observe(elapsed)
+                # 单次执行超过循环间隔, 实际的轮询周期已被拉长
+                if loop_time and elapsed > loop_time:
+                    overruns.inc()
+
                 await asyncio.sleep(loop_time)
         return wrapper
     return inner
 
 
+async def submit_order(payload):
+    return await restapi.create_order(**payload)
+
+
+def order_status_callback(key, status, payload, result):
+    if status == OUTBOX_STATUS.DONE:
+        log.info("订单 {} 创建成功, order id: {}".format(key, result))
+    elif status == OUTBOX_STATUS.PENDING:
+        log.warning("订单 {} 创建失败, 稍后重试: {!r}".format(key, result))
+    else:
+        log.error("订单 {} 创建失败, 已放弃重试: {!r}".format(key, result))
+
+
+OUTBOX_CONF = conf["OUTBOX"]
+
+order_outbox = AioOutbox(
+    path=OUTBOX_CONF["PATH"],
+    handler=submit_order,
+    workers=OUTBOX_CONF["WORKERS"],
+    max_retries=OUTBOX_CONF["MAX_RETRIES"],
+    backoff=OUTBOX_CONF["BACKOFF"],
+    max_backoff=OUTBOX_CONF["MAX_BACKOFF"],
+    retention_days=OUTBOX_CONF["RETENTION_DAYS"],
+)
+order_outbox.add_callback(order_status_callback)
+
+
 class AGV_STATE(enum.Enum):
     AUTO = "AUTO"
     RUNNING = "RUNNING"
@@ -37,6 +97,7 @@ class DeviceAdapterManager:
 
     @classmethod
     def get(cls, device_name) -> Device | SubDevice:
+        annotate(device=device_name)
         return cls._mapping[device_name]
 
 
@@ -49,18 +110,43 @@ class Adapter:
         self._base_device = Device(cfg, debug=debug)
         self._sub_device_manager = DeviceManager()
 
+        self._fleet_state = FleetState()
+
+        self._agv_state_reconciled_at = 0
+        self._agv_state_reported_version = 0
+        self._agv_state_report_lock = asyncio.Lock()
+        self._changed_agv_id_set: set[int] = set()
+        self._agv_state_changed_event = asyncio.Event()
+
+        self._loops: asyncio.Future | None = None
+
     def get_conf(self) -> Config:
         return self._conf
 
+    def get_fleet_state(self) -> FleetState:
+        return self._fleet_state
+
     def get_base_device(self) -> Device:
         return self._base_device
 
+    def get_loops(self) -> asyncio.Future | None:
+        """
+        run() 启动的所有循环任务, 取消它即可停止 Adapter
+        """
+        return self._loops
+
     def get_sub_device_manager(self) -> DeviceManager:
         return self._sub_device_manager
 
     def get_all_sub_devices(self) -> list[SubDevice]:
         return self.get_sub_device_manager().get_all_device()
 
+    def for_each_sub_device(self, loop_fn) -> list:
+        """
+        为每个子设备创建一个独立的循环, 某个轿厢的等待或异常不会影响其他轿厢
+        """
+        return [loop_fn(sub_device) for sub_device in self.get_all_sub_devices()]
+
     def load_sub_device(self):
 
         SUB_DEVICE_CONF = self.get_base_device().get_conf()["SUB_DEVICE"]
@@ -79,247 +165,410 @@ class Adapter:
         for sub_device in self.get_all_sub_devices():
             self.device_mapping.add(sub_device.get_name(), sub_device)
 
-    # ---- 查询 restapi, dbapi 后通过信号、向设备上报某些信息
+    # ---- 查询 restapi, dbapi 后更新车队状态表、再通过信号向设备上报某些信息
+
+    async def refresh_fleet_state(self):
+        """
+        从数据库全量刷新车队状态表
+        """
+        all_agv_state = await dbapi.get_all_agv_state()
+        agv_id_set_with_active_order = await dbapi.get_agv_id_set_with_active_order()
+
+        for row in all_agv_state:
+            self.update_fleet_state(row, row["agv_id"] in agv_id_set_with_active_order)
+
+        self._fleet_state.retain(row["agv_id"] for row in all_agv_state)
+
+    def update_fleet_state(self, row, has_active_order):
+        self._fleet_state.update(
+            row["agv_id"],
+            can_be_connected=row["can_be_connected"],
+            network_connected=row["network_connected"],
+            dispatch_task_active=row["dispatch_task_active"],
+            fault_happened=row["fault_happened"],
+            has_active_order=bool(has_active_order),
+        )
 
     @safe_forever_loop(5)
     async def report_agv_battery_info(self):
         """
         上报电池电量状态
         """
-        agv_info_list = await restapi.get_all_agv_info()
-        for agv_info in agv_info_list:
-            agv_id = agv_info["agv_id"]
-
+        for agv_info in await restapi.get_all_agv_info():
             # HACK: 这里的实际电量实际上要获取容量、太菜了
             # current_battery = round(agv_info["battery_current"])
 
-            current_battery = round(agv_info["battery_capacity"])
+            self._fleet_state.update(agv_info["agv_id"], battery=round(agv_info["battery_capacity"]))
             # current_battery = 80
 
-            await self.get_base_device().report_agv_battery_info(agv_id, current_battery)
+        await self.get_base_device().report_battery_bulk({
+            row.agv_id: row.battery
+            for row in self._fleet_state.rows()
+            if row.battery is not None
+        })
 
     @safe_forever_loop(3)
     async def report_agv_error_info(self):
         # TODO: 需要进行过滤出关键的常见 code - 2023-07-24 -
         # 复位（没有故障就清除）
 
-        all_agv_state = await dbapi.get_all_agv_state()
+        fault_agv_id_list = []
+        for row in self._fleet_state.rows():
+            if row.fault_happened:
+                fault_agv_id_list.append(row.agv_id)
+            elif row.fault_happened is not None:
+                self._fleet_state.update(row.agv_id, error_code=0)
 
-        for row in all_agv_state:
-            agv_id = row["agv_id"]
+        # 查询失败的 agv 本轮不更新、保持上一次的错误代码
+        for agv_id, rr in (await restapi.get_agv_error_info_many(fault_agv_id_list)).items():
+            self._fleet_state.update(agv_id, error_code=rr[0]["error_code"] if rr else 0)
 
-            has_fault_happened = row["fault_happened"]
+        await self.get_base_device().report_error_code_bulk({
+            row.agv_id: row.error_code
+            for row in self._fleet_state.rows()
+            if row.error_code is not None
+        })
 
-            if has_fault_happened:
-                rr = await restapi.get_agv_error_info(agv_id)
-                if rr:
-                    error_code = rr[0]["error_code"]
-                    await self.get_base_device().report_agv_error_code(agv_id, error_code)
-                else:
-                    await self.get_base_device().report_agv_error_code(agv_id, 0)
+    @safe_forever_loop(3)
+    async def report_agv_state(self):
+        """
+        刷新车队状态表并上报 agv 的模式
+        启用数据库变更通知且已连接时, 只上报状态发生变化的 agv, 每 RECONCILE_INTERVAL 秒全量刷新、上报一次
+        否则与轮询模式一样每轮（3s）都全量刷新、上报
+        """
+        NOTIFY_CONF = conf["DATABASE_NOTIFY"]
+        reconcile_interval = NOTIFY_CONF["RECONCILE_INTERVAL"] if NOTIFY_CONF["ENABLE"] else 0
+
+        is_reconcile = not aiopg_listener.is_connected() or \
+            loop_time() - self._agv_state_reconciled_at >= reconcile_interval
+
+        if is_reconcile:
+            await self.refresh_fleet_state()
+
+        await self.report_changed_agv_state(full=is_reconcile)
 
+        if is_reconcile:
+            self._agv_state_reconciled_at = loop_time()
+
+    async def report_changed_agv_state(self, full=False):
+        async with self._agv_state_report_lock:
+            version = self._fleet_state.get_version()
+
+            if full:
+                rows = self._fleet_state.rows()
             else:
-                await self.get_base_device().report_agv_error_code(agv_id, 0)
+                rows = self._fleet_state.changed_since(self._agv_state_reported_version, "state_version")
 
-    @safe_forever_loop(3)
-    async def report_agv_state(self):
+            for row in rows:
+                if self.can_report_agv_state(row):
+                    await self.report_single_agv_state(row)
 
-        all_agv_state = await dbapi.get_all_agv_state()
+            self._agv_state_reported_version = version
 
-        for row in all_agv_state:
-            agv_id = row["agv_id"]
-            has_connection_network = row["network_connected"]
-            in_dispatch_active = row["dispatch_task_active"]
-            has_fault_happened = row["fault_happened"]
-
-            has_active_order = await dbapi.agv_has_active_order(agv_id)
-
-            if not has_connection_network:
-                await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.AUTO.value)
-                await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.RUNNING.value)
-                log.info("agv {} 未连接, 取消「自动」 「运行中」模式".format(agv_id))
-                continue
-
-            if not in_dispatch_active:
-                await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.AUTO.value)
-                await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.RUNNING.value)
-                log.info("agv {} 未加入调度, 取消「自动」「运行中」模式".format(agv_id))
-                continue
-
-            if has_fault_happened:
-                await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.AUTO.value)
-                log.info("agv {} 有报错, 取消「自动」模式".format(agv_id))
-                continue
-
-            if has_active_order:
-                await self.get_base_device().write_agv_mode(agv_id, AGV_STATE.RUNNING.value)
-                log.info("agv {} 有存活订单, 上报为 「运行中」模式".format(agv_id))
-                continue
-
-            await self.get_base_device().write_agv_mode(agv_id, AGV_STATE.AUTO.value)
+    def can_report_agv_state(self, row: AgvStateRow) -> bool:
+        """
+        只通过 restapi 出现过的 agv（电量、错误信息）没有数据库中的状态字段,
+        signal.json 中未配置模式地址的 agv 也无法上报
+        """
+        if row.network_connected is None or row.dispatch_task_active is None or row.fault_happened is None:
+            return False
+
+        if str(row.agv_id) not in self.get_base_device().get_send_conf()["REPORT_AGV_MODE"]:
+            log.warning("REPORT_AGV_MODE 中未配置 agv {} 的地址, 忽略其模式".format(row.agv_id),
+                        extra={"subject": "agv-mode-{}".format(row.agv_id)})
+            return False
+
+        return True
+
+    def on_agv_state_changed(self, payload):
+        """
+        数据库变更通知回调, payload 为 agv_id
+        """
+        self._changed_agv_id_set.add(int(payload))
+        self._agv_state_changed_event.set()
+
+    def on_agv_state_listener_reconnect(self):
+        """
+        断线期间的通知已经丢失, 重连后立即全量同步一次
+        """
+        self._agv_state_reconciled_at = 0
+
+    @safe_forever_loop(0)
+    async def consume_agv_state_changes(self):
+        """
+        处理数据库变更通知, 同一 agv 的多次通知合并为一次上报
+        """
+        await self._agv_state_changed_event.wait()
+        self._agv_state_changed_event.clear()
+
+        changed_agv_id_set, self._changed_agv_id_set = self._changed_agv_id_set, set()
+
+        for agv_id in changed_agv_id_set:
+            row = await dbapi.get_agv_state(agv_id)
+            if row is not None:
+                self.update_fleet_state(row, await dbapi.agv_has_active_order(agv_id))
+
+        await self.report_changed_agv_state()
+
+    async def report_single_agv_state(self, row: AgvStateRow):
+        agv_id = row.agv_id
+        has_connection_network = row.network_connected
+        in_dispatch_active = row.dispatch_task_active
+        has_fault_happened = row.fault_happened
+        has_active_order = row.has_active_order
+
+        if not has_connection_network:
+            await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.AUTO.value)
             await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.RUNNING.value)
-            log.info("agv {} 状态正常, 上报为 「自动」模式".format(agv_id))
+            log.info("agv {} 未连接, 取消「自动」 「运行中」模式".format(agv_id), extra={"subject": "agv-mode-{}".format(agv_id)})
+            return
+
+        if not in_dispatch_active:
+            await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.AUTO.value)
+            await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.RUNNING.value)
+            log.info("agv {} 未加入调度, 取消「自动」「运行中」模式".format(agv_id), extra={"subject": "agv-mode-{}".format(agv_id)})
+            return
+
+        if has_fault_happened:
+            await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.AUTO.value)
+            log.info("agv {} 有报错, 取消「自动」模式".format(agv_id), extra={"subject": "agv-mode-{}".format(agv_id)})
+            return
+
+        if has_active_order:
+            await self.get_base_device().write_agv_mode(agv_id, AGV_STATE.RUNNING.value)
+            log.info("agv {} 有存活订单, 上报为 「运行中」模式".format(agv_id), extra={"subject": "agv-mode-{}".format(agv_id)})
+            return
+
+        await self.get_base_device().write_agv_mode(agv_id, AGV_STATE.AUTO.value)
+        await self.get_base_device().reset_agv_mode(agv_id, AGV_STATE.RUNNING.value)
+        log.info("agv {} 状态正常, 上报为 「自动」模式".format(agv_id), extra={"subject": "agv-mode-{}".format(agv_id)})
 
     # ---- 捕捉信号、调用 restapi 或 dbapi 执行相关功能
     @safe_forever_loop(3)
-    async def monitor_stop_heartbeat(self):
+    async def monitor_stop_heartbeat(self, sub_device: SubDevice):
         """
         如果是非急停模式、则刷入心跳
         """
-        for sub_device in self.get_all_sub_devices():
-            if not await sub_device.mode_is_stop():
-                io_id = conf["HEARTBEAT_DI"][sub_device.get_name()]
-                await dbapi.update_io_state(io_id)
+        if not await sub_device.mode_is_stop():
+            io_id = conf["HEARTBEAT_DI"][sub_device.get_name()]
+            await dbapi.update_io_state(io_id)
 
     @safe_forever_loop(3)
-    async def monitor_clear_error(self):
+    async def monitor_clear_error(self, sub_device: SubDevice):
         """
         如果是重置模式，则清错
         """
-        for sub_device in self.get_all_sub_devices():
-            if await sub_device.mode_is_reset():
-                agv_id_list = [
-                    agv_info["id"]
-                    for agv_info in await restapi.get_all_agv_info()
-                    if agv_info.get("fault_happened")
-                ]
-                await restapi.clear_agv_error(agv_id_list)
-                await asyncio.sleep(3)
+        if await sub_device.mode_is_reset():
+            agv_id_list = [
+                agv_info["id"]
+                for agv_info in await restapi.get_all_agv_info()
+                if agv_info.get("fault_happened")
+            ]
+            await restapi.clear_agv_error(agv_id_list)
+            await asyncio.sleep(3)
+
+    async def enqueue_order(self, device_name, order_name, task_code, car_number):
+        """
+        将订单写入本地 outbox, 由后台 worker 调用 restapi 创建
+        命令在订单写入后即被确认, 因此 OUTBOX.MAX_RETRIES 为 0: 订单一直重试到创建成功, 不会被放弃
+        同一 (轿厢, 任务, 车板号) 的订单仍未创建完成时不会再次写入, 返回订单是否被接受
+        命令的重复由 ORDER_HANDLE 位保证: 确认位置位后同一命令不会再次生成订单
+        """
+        return await order_outbox.enqueue(
+            "{}:{}:{}".format(device_name, task_code, car_number),
+            {
+                "ts_name": conf["ORDER_CONF"]["ts_name"],
+                "order_name": order_name,
+                "parameters": {
+                    "task_code": task_code,
+                    "task_info": {
+                        "car_number": str(car_number),
+                        "device_name": str(device_name),
+                    }
+                }
+            }
+        )
 
     @safe_forever_loop(3)
-    async def monitor_generate_order(self):
+    async def monitor_generate_order(self, sub_device: SubDevice):
         """
         生成订单，有 3 种任务：
             1. 入库任务（必定指定板号）
             2. 出库任务（不指定板号）
             3. 出库任务（必定指定板号）
         """
-        TS_NAME = conf["ORDER_CONF"]["ts_name"]
+        device_name = sub_device.get_name()
+
+        if await sub_device.mode_is_abnormal():
+            log.info("轿厢 {} 模式不正常".format(device_name))
+            return
+
+        # 入库任务
+        if await sub_device.has_save_car_task():
+            await asyncio.sleep(0.5)
+            # 车板号
+            car_number = await sub_device.get_save_car_number()
+            if not await sub_device.save_task_is_start_handle():
+                # 创建任务, 只有订单被接受时才确认命令, 否则下一轮重试
+                if await self.enqueue_order(device_name, device_name + "_save", "1000", car_number):
+                    # 命令接收完成
+                    await sub_device.report_save_task_handle_start()
+                else:
+                    log.warning("轿厢 {} 车板号 {} 的存板订单仍未创建完成, 暂不确认命令".format(device_name, car_number))
+
+        # 出库任务
+        elif await sub_device.has_take_car_task():
+            await asyncio.sleep(0.5)
+            # 车板号
+            car_number = await sub_device.get_take_car_number()
+            # 指定车板号的叫料任务
+            if not await sub_device.take_task_is_start_handle():
+                # 创建任务，判断 car_number 是否大于 0, 来区分是否是指定板号
+
+                if car_number > 0:
+                    # 指定车号
+                    accepted = await self.enqueue_order(device_name, device_name + "_take", "2000", car_number)
+                else:
+                    # 不指定车号
+                    accepted = await self.enqueue_order(device_name, device_name + "_take", "3000", car_number)
+
+                # 只有订单被接受时才确认命令, 否则下一轮重试
+                if accepted:
+                    # 命令接收完成
+                    await sub_device.report_take_task_handle_start()
+                else:
+                    log.warning("轿厢 {} 车板号 {} 的取板订单仍未创建完成, 暂不确认命令".format(device_name, car_number))
+
+    # ---- 刷新寄存器镜像, 供 read_from_image() 的请求使用
+
+    def get_scan_ranges(self) -> list[tuple[BaseDevice, int, int]]:
+        """
+        需要保持新鲜的寄存器: 基础设备的车板信息区域, 每个轿厢的状态与命令字
+        """
+        STORE_INFO_CONF = self.get_base_device().get_recv_conf()["STORE_INFO"]
+        rr: list[tuple[BaseDevice, int, int]] = [
+            (self.get_base_device(), STORE_INFO_CONF["ADDRESS"], STORE_INFO_CONF["LENGTH"])
+        ]
 
         for sub_device in self.get_all_sub_devices():
+            RECV_CONF = sub_device.get_recv_conf()
+            rr.append((sub_device, RECV_CONF["STATUS"]["ADDRESS"], 1))
+            rr.append((sub_device, RECV_CONF["COMMAND"]["ADDRESS"], 1))
 
-            device_name = sub_device.get_name()
-
-            if await sub_device.mode_is_abnormal():
-                log.info("轿厢 {} 模式不正常".format(device_name))
-                continue
-
-            # 入库任务
-            if await sub_device.has_save_car_task():
-                await asyncio.sleep(0.5)
-                # 车板号
-                car_number = await sub_device.get_save_car_number()
-                if not await sub_device.save_task_is_start_handle():
-                    # 创建任务
-                    await restapi.create_order(
-                        ts_name=TS_NAME,
-                        order_name=device_name + "_save",
-                        parameters={
-                            "task_code": "1000",
-                            "task_info": {
-                                "car_number": str(car_number),
-                                "device_name": str(device_name),
-                            }
-                        }
-                    )
+        return rr
 
-                    # 命令接收完成
-                    await sub_device.report_save_task_handle_start()
+    @safe_forever_loop(conf["IMAGE_SCAN"]["INTERVAL"])
+    async def scan_image(self):
+        """
+        块读取所有需要保持新鲜的寄存器（同一个 PLC 连接上间隔不超过 IMAGE_SCAN.MAX_GAP 个字的区域合并为一次读取）,
+        再更新各个设备的寄存器镜像
+        默认关闭: 扫描会持续占用 PLC 与连接锁, 没有请求时也一样; 只有 HTTP 请求频繁且需要比 IMAGE_MAX_AGE
+        更稳定的延迟时才开启, 间隔应略小于 IMAGE_MAX_AGE 中最小的值
+        """
+        client_mapping: dict[int, list[tuple[BaseDevice, int, int]]] = {}
+        for scan_range in self.get_scan_ranges():
+            client_mapping.setdefault(id(scan_range[0].get_client()), []).append(scan_range)
 
-            # 出库任务
-            elif await sub_device.has_take_car_task():
-                await asyncio.sleep(0.5)
-                # 车板号
-                car_number = await sub_device.get_take_car_number()
-                # 指定车板号的叫料任务
-                if not await sub_device.take_task_is_start_handle():
-                    # 创建任务，判断 car_number 是否大于 0, 来区分是否是指定板号
-
-                    if car_number > 0:
-                        # 指定车号
-                        await restapi.create_order(
-                            ts_name=TS_NAME,
-                            order_name=device_name + "_take",
-                            parameters={
-                                "task_code": "2000",
-                                "task_info": {
-                                    "car_number": str(car_number),
-                                    "device_name": str(device_name),
-                                }
-                            }
-                        )
-                    else:
-                        # 不指定车号
-                        await restapi.create_order(
-                            ts_name=TS_NAME,
-                            order_name=device_name + "_take",
-                            parameters={
-                                "task_code": "3000",
-                                "task_info": {
-                                    "car_number": str(car_number),
-                                    "device_name": str(device_name),
-                                }
-                            }
-                        )
+        for scan_ranges in client_mapping.values():
+            client = scan_ranges[0][0].get_client()
 
-                    # 命令接收完成
-                    await sub_device.report_take_task_handle_start()
+            for start_addr, count in merge_read_ranges(
+                    ((addr, length) for _, addr, length in scan_ranges), conf["IMAGE_SCAN"]["MAX_GAP"]):
+                rr = await client.safe_recv_register(start_addr, count)
+                values = rr if isinstance(rr, tuple) else (rr, )
+
+                for device, addr, length in scan_ranges:
+                    if start_addr <= addr and addr + length <= start_addr + count:
+                        device.get_image().update(addr, values[addr - start_addr:addr - start_addr + length])
 
     # ---- 捕捉信号、满足条件后做一些操作、不依赖 restapi 或者 dbapi 等外部接口
     @safe_forever_loop(3)
-    async def monitor_clear_signal(self):
+    async def monitor_clear_signal(self, sub_device: SubDevice):
         """
         清理某些信号
         """
 
-        for sub_device in self.get_all_sub_devices():
+        # await sub_device.report_agv_load_action_finish()
+        # await sub_device.report_agv_unload_action_finish()
 
-            # await sub_device.report_agv_load_action_finish()
-            # await sub_device.report_agv_unload_action_finish()
+        if not await sub_device.is_wait_save_task() and await sub_device.require_reset_agv_load_action():
+            await sub_device.reset_agv_load_action()
+            log.info("清理轿厢 {} 的卸货完成信号".format(sub_device.get_name()))
 
-            if not await sub_device.is_wait_save_task() and await sub_device.require_reset_agv_load_action():
-                await sub_device.reset_agv_load_action()
-                log.info("清理轿厢 {} 的卸货完成信号".format(sub_device.get_name()))
+        if not await sub_device.is_wait_take_task() and await sub_device.require_reset_agv_unload_action():
+            await sub_device.reset_agv_unload_action()
+            log.info("清理轿厢 {} 的卸货完成信号".format(sub_device.get_name()))
 
-            if not await sub_device.is_wait_take_task() and await sub_device.require_reset_agv_unload_action():
-                await sub_device.reset_agv_unload_action()
-                log.info("清理轿厢 {} 的卸货完成信号".format(sub_device.get_name()))
+        # ------------------------------------------------------------------------
 
-            # ------------------------------------------------------------------------
+        # 存板入库、取板出库
+        if await sub_device.save_task_is_start_handle():
+            # sub_device.report_save_task_handle_start()
+            await sub_device.report_save_task_handle_finish()
+            log.info("清理轿厢 {} 的取板任务确认信号".format(sub_device.get_name()))
 
-            # 存板入库、取板出库
-            if await sub_device.save_task_is_start_handle():
-                # sub_device.report_save_task_handle_start()
-                await sub_device.report_save_task_handle_finish()
-                log.info("清理轿厢 {} 的取板任务确认信号".format(sub_device.get_name()))
+        if await sub_device.take_task_is_start_handle():
+            # sub_device.report_take_task_handle_start()
+            await sub_device.report_take_task_handle_finish()
+            log.info("清理轿厢 {} 的存板任务确认信号".format(sub_device.get_name()))
 
-            if await sub_device.take_task_is_start_handle():
-                # sub_device.report_take_task_handle_start()
-                await sub_device.report_take_task_handle_finish()
-                log.info("清理轿厢 {} 的存板任务确认信号".format(sub_device.get_name()))
+        # 如果轿厢不在对接层
+        if not await sub_device.ready_docking():
 
-            # 如果轿厢不在对接层
-            if not await sub_device.ready_docking():
+            if await sub_device.require_reset_agv_find_car_number():
+                await sub_device.reset_agv_find_car_number()
+                log.info("清理轿厢 {} 的自己寻找的上报板号信号".format(sub_device.get_name()))
 
-                if await self.get_base_device().require_reset_agv_reverse_car_number():
-                    await self.get_base_device().reset_agv_reverse_car_number()
-                    log.info("清理轿厢 {} 的倒板任务信号".format(sub_device.get_name()))
+            if await sub_device.require_reset_agv_unload_finish_car_number():
+                await sub_device.reset_agv_unload_finish_car_number()
+                log.info("清理轿厢 {} 的最终上报板号完成信号".format(sub_device.get_name()))
 
-                # ---------------------------------------
-                if await sub_device.require_reset_agv_find_car_number():
-                    await sub_device.reset_agv_find_car_number()
-                    log.info("清理轿厢 {} 的自己寻找的上报板号信号".format(sub_device.get_name()))
+    @safe_forever_loop(3)
+    async def monitor_clear_reverse_car_number(self):
+        """
+        有轿厢不在对接层时清理倒板任务信号
+        倒板信号属于基础设备, 由这一个循环处理, 清理前的等待不会阻塞各个轿厢的循环
+        """
+        if not await self.get_base_device().require_reset_agv_reverse_car_number():
+            return
 
-                if await sub_device.require_reset_agv_unload_finish_car_number():
-                    await sub_device.reset_agv_unload_finish_car_number()
-                    log.info("清理轿厢 {} 的最终上报板号完成信号".format(sub_device.get_name()))
+        for sub_device in self.get_all_sub_devices():
+            if not await sub_device.ready_docking():
+                await self.get_base_device().reset_agv_reverse_car_number()
+                log.info("清理轿厢 {} 的倒板任务信号".format(sub_device.get_name()))
+                return
 
     async def run(self):
 
         self.load_sub_device()
         self.add_adapter_device_relation()
 
-        asyncio.gather(
+        await order_outbox.start()
+
+        NOTIFY_CONF = conf["DATABASE_NOTIFY"]
+        if NOTIFY_CONF["ENABLE"]:
+            if NOTIFY_CONF["INSTALL_TRIGGERS"]:
+                await dbapi.install_agv_state_notify_triggers(NOTIFY_CONF["CHANNEL"])
+
+            aiopg_listener.add_callback(NOTIFY_CONF["CHANNEL"], self.on_agv_state_changed)
+            aiopg_listener.add_reconnect_callback(self.on_agv_state_listener_reconnect)
+
+        GP_CACHE_CONF = conf["GP_CACHE"]
+        if GP_CACHE_CONF["NOTIFY"]:
+            if NOTIFY_CONF["INSTALL_TRIGGERS"]:
+                await dbapi.install_gp_notify_trigger(GP_CACHE_CONF["CHANNEL"])
+
+            aiopg_listener.add_callback(GP_CACHE_CONF["CHANNEL"], dbapi.on_gp_changed)
+            aiopg_listener.add_reconnect_callback(dbapi.on_gp_listener_reconnect)
+
+        if NOTIFY_CONF["ENABLE"] or GP_CACHE_CONF["NOTIFY"]:
+            aiopg_listener.start()
+
+        # 寄存器镜像扫描, 关闭时 read_from_image() 的请求在数据过期后合并为一次实时读取
+        scan_loops = [self.scan_image()] if conf["IMAGE_SCAN"]["ENABLE"] else []
+
+        self._loops = asyncio.gather(
+            *scan_loops,
             # 心跳检测
             self.get_base_device().send_heartbeat(),
             self.get_base_device().recv_heartbeat(),
@@ -330,13 +579,16 @@ class Adapter:
             self.report_agv_error_info(),
             # # 上报 agv 模式
             self.report_agv_state(),
+            self.consume_agv_state_changes(),
             # # -------------------
+            # 以下任务每个轿厢各自独立运行、互不阻塞
             # 监听区域心跳
-            # self.monitor_stop_heartbeat(),
+            # *self.for_each_sub_device(self.monitor_stop_heartbeat),
             # 监听生成订单
-            self.monitor_generate_order(),
+            *self.for_each_sub_device(self.monitor_generate_order),
             # 监听 agv 清错指令
-            self.monitor_clear_error(),
+            *self.for_each_sub_device(self.monitor_clear_error),
             # 监听信号清理
-            self.monitor_clear_signal()
+            *self.for_each_sub_device(self.monitor_clear_signal),
+            self.monitor_clear_reverse_car_number(),
         )
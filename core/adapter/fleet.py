@@ -0,0 +1,110 @@
+import typing
+
+
+class AgvStateRow:
+    """
+    agv 的状态行, 使用 __slots__ 保持每个 agv 的内存占用固定
+    version 为该行任意字段最后一次发生变化时的表版本号
+    state_version 为该行决定 agv 模式的字段（STATE_FIELDS）最后一次发生变化时的表版本号
+    """
+
+    __slots__ = (
+        "agv_id",
+        "version",
+        "state_version",
+        "can_be_connected",
+        "network_connected",
+        "dispatch_task_active",
+        "fault_happened",
+        "has_active_order",
+        "battery",
+        "error_code",
+    )
+
+    FIELDS = __slots__[3:]
+
+    STATE_FIELDS = frozenset((
+        "can_be_connected",
+        "network_connected",
+        "dispatch_task_active",
+        "fault_happened",
+        "has_active_order",
+    ))
+
+    def __init__(self, agv_id: int) -> None:
+        self.agv_id = agv_id
+        self.version = 0
+        self.state_version = 0
+
+        for field in self.FIELDS:
+            setattr(self, field, None)
+
+    def __repr__(self) -> str:
+        return "<{} {}>".format(
+            __class__.__name__,
+            ", ".join("{}={}".format(field, getattr(self, field)) for field in __class__.__slots__)
+        )
+
+
+class FleetState:
+    """
+    车队状态表, 以 agv_id 为键, 由 dbapi / restapi 的刷新任务原地更新
+    每次有字段发生变化时表版本号加一, 通过 changed_since 可以只取出变化过的 agv
+    """
+
+    def __init__(self) -> None:
+        self._rows: dict[int, AgvStateRow] = {}
+        self._version = 0
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def get_version(self) -> int:
+        return self._version
+
+    def get(self, agv_id) -> typing.Optional[AgvStateRow]:
+        return self._rows.get(int(agv_id))
+
+    def rows(self) -> list[AgvStateRow]:
+        return list(self._rows.values())
+
+    def update(self, agv_id, **fields) -> bool:
+        """
+        原地更新一个 agv 的字段, 返回是否有字段发生了变化
+        """
+        agv_id = int(agv_id)
+
+        row = self._rows.get(agv_id)
+        if row is None:
+            row = self._rows[agv_id] = AgvStateRow(agv_id)
+
+        changed_fields = []
+        for field, value in fields.items():
+            if getattr(row, field) != value:
+                setattr(row, field, value)
+                changed_fields.append(field)
+
+        if changed_fields:
+            self._version += 1
+            row.version = self._version
+
+            if not AgvStateRow.STATE_FIELDS.isdisjoint(changed_fields):
+                row.state_version = self._version
+
+        return bool(changed_fields)
+
+    def changed_since(self, version: int, version_attr: str = "version") -> list[AgvStateRow]:
+        """
+        返回表版本号 version 之后发生过变化的 agv
+        version_attr 为 "state_version" 时只关心决定 agv 模式的字段
+        """
+        return [row for row in self._rows.values() if getattr(row, version_attr) > version]
+
+    def retain(self, agv_id_set) -> None:
+        """
+        删除不在 agv_id_set 中的 agv（例如已从系统中移除的车辆）
+        """
+        agv_id_set = {int(agv_id) for agv_id in agv_id_set}
+        for agv_id in list(self._rows):
+            if agv_id not in agv_id_set:
+                del self._rows[agv_id]
@@ -2,3 +2,5 @@ from .device import BaseDevice
 from .device import Device
 from .device import SubDevice
 from .device import DeviceManager
+from .implement import ImageRead
+from .implement import read_from_image
@@ -57,6 +57,10 @@ class DeviceAbstract(metaclass=abc.ABCMeta):
     async def safe_send(self, start_addr: int, values: int | list | tuple) -> None:
         pass
 
+    @abc.abstractmethod
+    async def safe_send_many(self, addr_values: dict[int, int]) -> None:
+        pass
+
     @abc.abstractmethod
     async def safe_recv(self, start_addr: int, count: int = 1) -> int | tuple:
         pass
@@ -4,6 +4,8 @@ import asyncio
 from bidict import bidict
 
 from utils import log
+from utils.profiler import profile_methods
+from utils.tracing import trace_methods
 from .implement import BaseDevice
 
 
@@ -32,6 +34,8 @@ class DeviceManager:
         return self._device_list
 
 
+@trace_methods
+@profile_methods
 class Device(BaseDevice):
     def __repr__(self) -> str:
         return "{} {}".format(__class__.__name__, self.get_name())
@@ -87,6 +91,31 @@ class Device(BaseDevice):
 
         return bool(typing.cast(int, await self.safe_recv(RECV_ADDR)))
 
+    async def get_store_info(self) -> tuple:
+        """
+        一次读取整个车板信息区域（STORE_INFO.LENGTH 个字）, 第 n 个值对应车板号 n
+        """
+        RECV_CONF = self.get_recv_conf()["STORE_INFO"]
+        RECV_ADDR = RECV_CONF["ADDRESS"]
+        RECV_LENGTH = RECV_CONF["LENGTH"]
+
+        rr = await self.safe_recv(RECV_ADDR, RECV_LENGTH)
+
+        return rr if isinstance(rr, tuple) else (rr, )
+
+    async def has_cars(self, car_numbers):
+        """
+        多个车板上是否有车, 只读取一次车板信息区域
+        车板号为车板信息区域内从 0 开始的偏移（与 has_car 相同）, 返回值与 car_numbers 一一对应
+        """
+        store_info = await self.get_store_info()
+
+        for car_number in car_numbers:
+            if not 0 <= int(car_number) < len(store_info):
+                raise ValueError("car number {} out of the STORE_INFO area [0, {})".format(car_number, len(store_info)))
+
+        return [bool(store_info[int(car_number)]) for car_number in car_numbers]
+
     async def write_agv_mode(self, agv_id, mode):
         """
         写入 agv 的模式
@@ -102,14 +131,12 @@ class Device(BaseDevice):
         agv_id = str(agv_id)
 
         SEND_CONF = self.get_send_conf()["REPORT_AGV_MODE"]
-        SEND_ADDR = SEND_CONF["ADDRESS"]
+        # 一个字只能容纳 8 台 agv 的模式, agv 可以单独配置 ADDRESS
+        SEND_ADDR = SEND_CONF[agv_id].get("ADDRESS", SEND_CONF["ADDRESS"])
 
         SEND_BIT = SEND_CONF[agv_id]["BIT"][mode]
 
-        PRE_VAL = await self.safe_recv(SEND_ADDR)
-        NEW_VAL = PRE_VAL | (1 << SEND_BIT)
-        if PRE_VAL != NEW_VAL:
-            await self.safe_send(SEND_ADDR, NEW_VAL)
+        await self.safe_update_bits(SEND_ADDR, set_mask=1 << SEND_BIT)
 
     async def reset_agv_mode(self, agv_id, mode):
         """
@@ -120,15 +147,11 @@ class Device(BaseDevice):
         agv_id = str(agv_id)
 
         SEND_CONF = self.get_send_conf()["REPORT_AGV_MODE"]
-        SEND_ADDR = SEND_CONF["ADDRESS"]
+        SEND_ADDR = SEND_CONF[agv_id].get("ADDRESS", SEND_CONF["ADDRESS"])
 
         SEND_BIT = SEND_CONF[agv_id]["BIT"][mode]
 
-        PRE_VAL = await self.safe_recv(SEND_ADDR)
-        NEW_VAL = PRE_VAL & ~(1 << SEND_BIT)
-
-        if PRE_VAL != NEW_VAL:
-            await self.safe_send(SEND_ADDR, NEW_VAL)
+        await self.safe_update_bits(SEND_ADDR, clear_mask=1 << SEND_BIT)
 
     async def report_agv_error_code(self, agv_id, error_code):
         """
@@ -152,6 +175,42 @@ class Device(BaseDevice):
         SEND_ADDR = self.get_send_conf()["REPORT_AGV_BATTERY"][agv_id]["ADDRESS"]
         await self.safe_send(SEND_ADDR, battery_info)
 
+    async def report_per_agv_bulk(self, signal_name, agv_values):
+        """
+        批量上报按 agv id 分配地址的信号（{agv_id: value}）
+        相邻地址合并为一次块写入，其余地址合并为一次随机写入
+        """
+        SEND_CONF = self.get_send_conf()[signal_name]
+
+        addr_values = {}
+        for agv_id, value in agv_values.items():
+            agv_conf = SEND_CONF.get(str(agv_id))
+            if agv_conf is None:
+                log.warning("{} 中未配置 agv {} 的地址, 忽略上报值 {}".format(signal_name, agv_id, value))
+                continue
+            addr_values[agv_conf["ADDRESS"]] = value
+
+        if addr_values:
+            await self.safe_send_many(addr_values)
+
+    async def report_battery_bulk(self, battery_mapping):
+        """
+        批量上报电池电量信息 {agv_id: battery_info}
+        """
+        await self.report_per_agv_bulk("REPORT_AGV_BATTERY", battery_mapping)
+
+    async def report_error_code_bulk(self, error_code_mapping):
+        """
+        批量上报 agv 的错误代码 {agv_id: error_code}
+        """
+        await self.report_per_agv_bulk("REPORT_AGV_ERROR", error_code_mapping)
+
+    async def report_target_car_number_bulk(self, car_number_mapping):
+        """
+        批量上报 agv 的目标车板号 {agv_id: car_number}
+        """
+        await self.report_per_agv_bulk("REPORT_CAR_ACTION", car_number_mapping)
+
     async def report_agv_target_car_number(self, agv_id, car_number):
         """
         上报当前 order 的 target location 和 agv id
@@ -204,6 +263,8 @@ class Device(BaseDevice):
         await self.report_agv_reverse_car_number(list(0 for i in range(SEND_LENGTH)))
 
 
+@trace_methods
+@profile_methods
 class SubDeviceModeMinxin:
     """
     子设备的模式判断工具类
@@ -282,6 +343,8 @@ class SubDeviceModeMinxin:
         return device_status_list
 
 
+@trace_methods
+@profile_methods
 class SubDevice(BaseDevice, SubDeviceModeMinxin):
     def __repr__(self) -> str:
         return "{} {}".format(__class__.__name__, self.get_name())
@@ -410,11 +473,7 @@ class SubDevice(BaseDevice, SubDeviceModeMinxin):
         SEND_ADDR = SEND_CONF["ADDRESS"]
         SEND_BIT = SEND_CONF["BIT"]["SAVE_CAR_HANDLE"]
 
-        PRE_VAL = await self.safe_recv(SEND_ADDR)
-        NEW_VAL = PRE_VAL | (1 << SEND_BIT)
-
-        if PRE_VAL != NEW_VAL:
-            await self.safe_send(SEND_ADDR, NEW_VAL)
+        await self.safe_update_bits(SEND_ADDR, set_mask=1 << SEND_BIT)
 
     async def report_take_task_handle_start(self):
         """
@@ -425,11 +484,7 @@ class SubDevice(BaseDevice, SubDeviceModeMinxin):
         SEND_ADDR = SEND_CONF["ADDRESS"]
         SEND_BIT = SEND_CONF["BIT"]["TAKE_CAR_HANDLE"]
 
-        PRE_VAL = await self.safe_recv(SEND_ADDR)
-        NEW_VAL = PRE_VAL | (1 << SEND_BIT)
-
-        if PRE_VAL != NEW_VAL:
-            await self.safe_send(SEND_ADDR, NEW_VAL)
+        await self.safe_update_bits(SEND_ADDR, set_mask=1 << SEND_BIT)
 
     async def report_save_task_handle_finish(self):
         """
@@ -440,11 +495,7 @@ class SubDevice(BaseDevice, SubDeviceModeMinxin):
         SEND_ADDR = SEND_CONF["ADDRESS"]
         SEND_BIT = SEND_CONF["BIT"]["SAVE_CAR_HANDLE"]
 
-        PRE_VAL = await self.safe_recv(SEND_ADDR)
-        NEW_VAL = PRE_VAL & ~(1 << SEND_BIT)
-
-        if PRE_VAL != NEW_VAL:
-            await self.safe_send(SEND_ADDR, NEW_VAL)
+        await self.safe_update_bits(SEND_ADDR, clear_mask=1 << SEND_BIT)
 
     async def report_take_task_handle_finish(self):
         """
@@ -455,11 +506,7 @@ class SubDevice(BaseDevice, SubDeviceModeMinxin):
         SEND_ADDR = SEND_CONF["ADDRESS"]
         SEND_BIT = SEND_CONF["BIT"]["TAKE_CAR_HANDLE"]
 
-        PRE_VAL = await self.safe_recv(SEND_ADDR)
-        NEW_VAL = PRE_VAL & ~(1 << SEND_BIT)
-
-        if PRE_VAL != NEW_VAL:
-            await self.safe_send(SEND_ADDR, NEW_VAL)
+        await self.safe_update_bits(SEND_ADDR, clear_mask=1 << SEND_BIT)
 
     # -----------
     async def report_agv_load_action_start(self):
@@ -1,9 +1,177 @@
+import typing
+import asyncio
+import contextlib
+import contextvars
+
+from utils import log, conf, register_journal, metrics
+from utils.aio_cache import wait_inflight
+from utils.auxiliary import loop_time
 from utils.config import Config
-from utils.protocol.mc.aio_mc_client import AioMcClient
+from utils.journal import RegisterJournal, UNKNOWN_VALUE, ORIGIN_READ, ORIGIN_WRITE
+from utils.protocol.mc.aio_mc_client import AioMcClient, BATCH_READ_MAX_POINTS, RANDOM_WRITE_MAX_POINTS
 
 from . abstract import DeviceAbstract, DeviceConfigAbstract
 
 
+def merge_address_runs(addr_values: dict[int, int]) -> tuple[list[tuple[int, list[int]]], dict[int, int]]:
+    """
+    Merge adjacent addresses into blocks
+    Returns runs of at least 2 addresses as (start_addr, values) and the remaining addresses as a dict
+    """
+    blocks = []
+    singles = {}
+
+    run_start = None
+    run_values = []
+
+    for addr in sorted(addr_values):
+        if run_values and addr == run_start + len(run_values):
+            run_values.append(addr_values[addr])
+            continue
+
+        if len(run_values) > 1:
+            blocks.append((run_start, run_values))
+        elif run_values:
+            singles[run_start] = run_values[0]
+
+        run_start = addr
+        run_values = [addr_values[addr]]
+
+    if len(run_values) > 1:
+        blocks.append((run_start, run_values))
+    elif run_values:
+        singles[run_start] = run_values[0]
+
+    return blocks, singles
+
+
+def merge_read_ranges(ranges: typing.Iterable[tuple[int, int]], max_gap: int = 0,
+                      max_points: int = BATCH_READ_MAX_POINTS) -> list[tuple[int, int]]:
+    """
+    Merge (start_addr, count) ranges into as few batch reads as possible
+    Ranges at most `max_gap` words apart are merged and the gap is read as well,
+    a block never exceeds `max_points` words
+    """
+    blocks: list[tuple[int, int]] = []
+
+    for start_addr, count in sorted(ranges):
+        if blocks:
+            block_start, block_count = blocks[-1]
+            end_addr = max(block_start + block_count, start_addr + count)
+
+            if start_addr - (block_start + block_count) <= max_gap and end_addr - block_start <= max_points:
+                blocks[-1] = (block_start, end_addr - block_start)
+                continue
+
+        blocks.append((start_addr, count))
+
+    return blocks
+
+
+def get_register_journal() -> typing.Optional[RegisterJournal]:
+    return register_journal if conf["JOURNAL"]["ENABLE"] else None
+
+
+JOURNAL_APPEND_ERRORS = metrics.counter(
+    "register_journal_append_errors_total", "Register journal appends that raised, the PLC I/O went on")
+
+IMAGE_READS = metrics.counter(
+    "device_image_reads_total", "Reads under read_from_image(), served from the register image or live", ["result"])
+IMAGE_HITS = IMAGE_READS.labels("image")
+IMAGE_MISSES = IMAGE_READS.labels("live")
+
+
+class ImageRead:
+    """
+    How the reads of a read_from_image() block were served,
+    age is the age of the oldest value served from the image, 0 when every read was live
+    """
+    __slots__ = ("max_age", "age", "hits", "misses")
+
+    def __init__(self, max_age: float) -> None:
+        self.max_age = max_age
+        self.age = 0.0
+        self.hits = 0
+        self.misses = 0
+
+
+_image_read: contextvars.ContextVar[typing.Optional[ImageRead]] = contextvars.ContextVar("image_read", default=None)
+
+
+@contextlib.contextmanager
+def read_from_image(max_age: float) -> typing.Iterator[ImageRead]:
+    """
+    Within the block, safe_recv() answers from the register image when the values are at most `max_age`
+    seconds old, a live read is done otherwise. Concurrent stale reads of a register share one live read,
+    so a burst of requests costs about one read per `max_age`. When IMAGE_SCAN is enabled,
+    Adapter.scan_image also keeps STATUS, COMMAND and STORE_INFO fresh every IMAGE_SCAN.INTERVAL seconds
+    """
+    image_read = ImageRead(max_age)
+    token = _image_read.set(image_read)
+    try:
+        yield image_read
+    finally:
+        _image_read.reset(token)
+
+
+class RegisterImage:
+    """
+    The last value read from or written to every register of a device
+    When a journal is given, every change of a value is appended to it
+    """
+
+    def __init__(self, device_name: str, journal: typing.Optional[RegisterJournal] = None) -> None:
+        self._device_name = device_name
+        self._journal = journal
+        self._values: dict[int, int] = {}
+        # loop_time() of the last read or write of every register, changed or not
+        self._updated_at: dict[int, float] = {}
+
+    def get(self, addr: int, default: typing.Optional[int] = None) -> typing.Optional[int]:
+        return self._values.get(addr, default)
+
+    def get_block(self, start_addr: int, count: int = 1) -> tuple[typing.Optional[float], int | tuple]:
+        """
+        Age in seconds of the oldest register of the block and the values, shaped like safe_recv()
+        The age is None when a register of the block was never read nor written
+        """
+        oldest = None
+
+        for addr in range(start_addr, start_addr + count):
+            updated_at = self._updated_at.get(addr)
+            if updated_at is None:
+                return None, ()
+            if oldest is None or updated_at < oldest:
+                oldest = updated_at
+
+        if count == 1:
+            return loop_time() - oldest, self._values[start_addr]
+        return loop_time() - oldest, tuple(self._values[addr] for addr in range(start_addr, start_addr + count))
+
+    def update(self, start_addr: int, values: int | list | tuple, origin: int = ORIGIN_READ) -> None:
+        if isinstance(values, int):
+            values = (values, )
+
+        now = loop_time()
+
+        for addr, new in enumerate(values, start_addr):
+            self._updated_at[addr] = now
+            old = self._values.get(addr, UNKNOWN_VALUE)
+
+            if old == new:
+                continue
+
+            self._values[addr] = new
+
+            if self._journal is not None:
+                # the journal is a diagnostic, it must never fail the PLC I/O
+                try:
+                    self._journal.append(self._device_name, addr, old, new, origin)
+                except Exception as e:
+                    JOURNAL_APPEND_ERRORS.inc()
+                    log.error("{} journal append failed: {!r}".format(self._device_name, e))
+
+
 class BaseDeviceConfig(DeviceConfigAbstract):
     def __init__(self, conf: Config):
         self._conf = conf
@@ -32,6 +200,9 @@ class BaseDeviceConfig(DeviceConfigAbstract):
 
 class BaseDevice(BaseDeviceConfig, DeviceAbstract):
     _connection_pool = {}
+    # read-modify-write locks by (client, address): the devices of a PLC share its client
+    # and several of them set bits of the same words (e.g. ORDER_HANDLE of the lifts)
+    _word_locks: dict[tuple[AioMcClient, int], asyncio.Lock] = {}
 
     def __init__(self, conf: Config, debug: bool = False):
         super().__init__(conf)
@@ -45,14 +216,117 @@ class BaseDevice(BaseDeviceConfig, DeviceAbstract):
         self._client = __class__._connection_pool.setdefault(
             self._host + str(self._port), AioMcClient(self._host, self._port, debug))
 
+        self._image = RegisterImage(self._name, get_register_journal())
+        # live reads of read_from_image() blocks in flight, by (start_addr, count)
+        self._inflight_reads: dict[tuple[int, int], asyncio.Future] = {}
+
     def get_client(self) -> AioMcClient:
         return self._client
 
+    def get_image(self) -> RegisterImage:
+        return self._image
+
     async def safe_send(self, start_addr: int, values: int | list | tuple) -> None:
-        return await self.get_client().safe_send_register(start_addr, values)
+        await self.get_client().safe_send_register(start_addr, values)
+        self.get_image().update(start_addr, values, ORIGIN_WRITE)
+
+    async def safe_send_many(self, addr_values: dict[int, int]) -> None:
+        """
+        Write many scattered addresses with as few frames as possible:
+        adjacent addresses become block writes, the rest are sent as random writes
+        """
+        blocks, singles = merge_address_runs(addr_values)
+
+        for start_addr, values in blocks:
+            await self.safe_send(start_addr, values)
+
+        if len(singles) == 1:
+            await self.safe_send(*singles.popitem())
+
+        items = list(singles.items())
+        for index in range(0, len(items), RANDOM_WRITE_MAX_POINTS):
+            await self.get_client().safe_send_random_register(dict(items[index:index + RANDOM_WRITE_MAX_POINTS]))
+
+            for addr, value in items[index:index + RANDOM_WRITE_MAX_POINTS]:
+                self.get_image().update(addr, value, ORIGIN_WRITE)
+
+    def get_word_lock(self, addr: int) -> asyncio.Lock:
+        key = (self.get_client(), addr)
+        lock = __class__._word_locks.get(key)
+        if lock is None:
+            lock = __class__._word_locks[key] = asyncio.Lock()
+        return lock
+
+    async def safe_update_bits(self, addr: int, set_mask: int = 0, clear_mask: int = 0) -> int:
+        """
+        Set then clear bits of a word, returns the new value, nothing is written when it does not change
+        The live read and the write are done under the lock of the word, so the concurrent updates
+        of other bits of the word (by another lift) are never overwritten with a stale value
+        """
+        async with self.get_word_lock(addr):
+            old = typing.cast(int, await self.get_client().safe_recv_register(addr))
+            self.get_image().update(addr, old)
+
+            new = (old | set_mask) & ~clear_mask
+            if new != old:
+                await self.safe_send(addr, new)
+
+            return new
 
     async def safe_recv(self, start_addr: int, count: int = 1) -> int | tuple:
-        return await self.get_client().safe_recv_register(start_addr, count)
+        image_read = _image_read.get()
+
+        if image_read is not None:
+            age, values = self.get_image().get_block(start_addr, count)
+
+            if age is not None and age <= image_read.max_age:
+                image_read.hits += 1
+                image_read.age = max(image_read.age, age)
+                IMAGE_HITS.inc()
+                return values
+
+            image_read.misses += 1
+            IMAGE_MISSES.inc()
+
+            return await self._coalesced_recv(start_addr, count)
+
+        rr = await self.get_client().safe_recv_register(start_addr, count)
+        self.get_image().update(start_addr, rr)
+        return rr
+
+    async def _coalesced_recv(self, start_addr: int, count: int) -> int | tuple:
+        """
+        Concurrent stale reads of the same block under read_from_image() share one live read,
+        reads outside of it are never coalesced: they must observe the writes made before them
+        """
+        key = (start_addr, count)
+
+        inflight = self._inflight_reads.get(key)
+        while inflight is not None:
+            done, rr = await wait_inflight(inflight)
+            if done:
+                return rr
+            inflight = self._inflight_reads.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight_reads[key] = future
+
+        try:
+            rr = await self.get_client().safe_recv_register(start_addr, count)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the exception is re-raised here, avoid "exception was never retrieved" warnings
+            future.exception()
+            raise
+        else:
+            self.get_image().update(start_addr, rr)
+            future.set_result(rr)
+            return rr
+        finally:
+            self._inflight_reads.pop(key, None)
 
     async def start(self):
         pass
@@ -0,0 +1,385 @@
+"""
+回放模式: 用寄存器变化日志（utils/journal.py）代替真实 PLC 驱动 Adapter.run
+
+    python -m core.replay ./data/journal/registers.bin --start "2023-07-12 16:00:00" --end "2023-07-12 16:10:00" \
+        --speed 10 --output ./data/replay.json
+
+- 日志中由 PLC 产生的变化（origin=read）按原始时间间隔写入模拟的 PLC 内存
+- Adapter 通过假的 AioMcClient transport 读写该内存, 对 PLC 的写入、REST 调用、订单结果都会被记录
+- --speed 通过缩放事件循环的时钟实现, asyncio.sleep / wait_for 以及基于 utils.auxiliary.loop_time 的计时
+  （Adapter 的轮询间隔与全量同步间隔、AioTTLCache 的 TTL、寄存器镜像的数据年龄）都会同比例加快
+- 以下计时不缩放, 倍速回放时与 1 倍速的行为不同:
+    订单发件箱的保留天数（墙上时间 time.time(), 会持久化）
+    循环耗时、MC 往返、profiler 与 tracing 的耗时（time.perf_counter, 统计的是真实耗时,
+    adapter_loop_overruns_total 因此会少计）
+- 日志中由 Adapter 写入的变化（origin=write）作为期望输出一并保存, 便于与回放结果比较
+- 数据库由 benchmarks/fake_db.py 的内存数据库代替, agv 状态来自 fixtures 中录制的行（见 ReplayFleet）,
+  回放不会访问 conf 中配置的数据库, 同一份日志与 fixtures 的回放结果是确定的
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import selectors
+
+from benchmarks.fake_db import FakeDatabase
+from core.adapter import adapter as adapter_module
+from core.device.implement import BaseDevice
+from utils import log, conf, sig_cfg, aiopg
+from utils.gzrobot import restapi
+from utils.journal import JournalReader, parse_time, ORIGIN_READ, ORIGIN_WRITE
+from utils.aio_outbox import AioOutbox
+from utils.protocol.mc import frame
+from utils.protocol.mc.aio_mc_client import AioMcClient
+from utils.protocol.http.aio_http_client import AioHttpClient, AioHttpClientResponse
+
+
+class ScaledSelector(selectors.DefaultSelector):
+    """
+    select 的超时时间按 speed 缩短, 与 ScaledTimeEventLoop 的时钟配合使用
+    """
+
+    def __init__(self, speed: float) -> None:
+        super().__init__()
+        self._speed = speed
+
+    def select(self, timeout=None):
+        if timeout is not None and timeout > 0:
+            timeout /= self._speed
+        return super().select(timeout)
+
+
+class ScaledTimeEventLoop(asyncio.SelectorEventLoop):
+    """
+    时钟以 speed 倍速流逝的事件循环, asyncio.sleep、call_later、wait_for 以及 loop_time() 都会同比例加快
+    """
+
+    def __init__(self, speed: float = 1) -> None:
+        super().__init__(ScaledSelector(speed))
+        self._speed = speed
+        self._time_origin = time.monotonic()
+
+    def time(self) -> float:
+        return self._time_origin + (time.monotonic() - self._time_origin) * self._speed
+
+
+class ReplayRecorder:
+    """
+    记录回放期间 Adapter 的所有输出, 时间为回放开始后经过的（回放时钟）秒数
+    """
+
+    def __init__(self) -> None:
+        self._started_at = 0.0
+        self._events = []
+
+    def start(self) -> None:
+        self._started_at = asyncio.get_running_loop().time()
+
+    def get_events(self) -> list:
+        return self._events
+
+    def record(self, event_type: str, **kwargs) -> None:
+        self._events.append({
+            "time": round(asyncio.get_running_loop().time() - self._started_at, 3),
+            "type": event_type,
+            **kwargs
+        })
+
+
+class ReplayPlc:
+    """
+    模拟的 PLC 内存（D 寄存器）, 未写入过的地址读到 0
+    """
+
+    def __init__(self, name: str, recorder: ReplayRecorder) -> None:
+        self._name = name
+        self._recorder = recorder
+        self._memory: dict[int, int] = {}
+
+    def __repr__(self) -> str:
+        return "<{} {}>".format(__class__.__name__, self._name)
+
+    def set(self, addr: int, value: int) -> None:
+        self._memory[addr] = value
+
+    def handle(self, request: frame.McRequest) -> bytes:
+        if request.command == frame.COMMAND_BATCH_READ:
+            return frame.encode_response(request, (
+                self._memory.get(addr, 0) for addr in range(request.start_addr, request.start_addr + request.count)))
+
+        if request.command == frame.COMMAND_BATCH_WRITE:
+            points = tuple(enumerate(request.values, request.start_addr))
+        elif request.command == frame.COMMAND_RANDOM_WRITE:
+            points = tuple((addr, value) for _, addr, value in request.points)
+        else:
+            return frame.encode_response(request, end_code=frame.END_CODE_UNSUPPORTED_COMMAND)
+
+        for addr, value in points:
+            self._memory[addr] = value
+
+        self._recorder.record("plc_write", plc=self._name, points=[list(point) for point in points])
+        return frame.encode_response(request)
+
+
+class ReplayTransport:
+    """
+    代替 AioTcpClient 的假连接, 请求直接交给 ReplayPlc 处理
+    """
+
+    def __init__(self, plc: ReplayPlc) -> None:
+        self._plc = plc
+        self._buffer = bytearray()
+        self._closing = True
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    async def open(self) -> None:
+        self._closing = False
+
+    async def close(self) -> None:
+        self._closing = True
+
+    async def write(self, data) -> None:
+        self._buffer += self._plc.handle(frame.decode_request(bytes(data)))
+
+    async def read(self, n=-1) -> bytes:
+        # 让出控制权, 与真实连接一样每次读取都是一个调度点
+        await asyncio.sleep(0)
+
+        if n < 0:
+            n = len(self._buffer)
+
+        rr = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return rr
+
+    async def readexactly(self, n) -> bytes:
+        if len(self._buffer) < n:
+            raise asyncio.IncompleteReadError(bytes(self._buffer), n)
+        return await self.read(n)
+
+
+class ReplayHttpClient(AioHttpClient):
+    """
+    记录所有 REST 调用并返回固定的响应, 不发起真实请求
+
+    fixtures 的键为 "METHOD /path/"（不含查询参数）, 值为响应的 json
+    创建订单的接口默认返回递增的订单号, 其它接口默认返回 {"code": 0, "data": []}
+    """
+
+    def __init__(self, recorder: ReplayRecorder, fixtures: dict | None = None) -> None:
+        super().__init__()
+        self._recorder = recorder
+        self._fixtures = fixtures or {}
+        self._order_id = 0
+
+    def _respond(self, method: str, url, kwargs) -> dict:
+        path = str(url).split("?")[0]
+        self._recorder.record("rest", method=method, url=str(url), json=kwargs.get("json"))
+
+        fixture = self._fixtures.get("{} {}".format(method, path))
+        if fixture is not None:
+            return fixture
+
+        if method == "POST" and path == "/api/om/order/":
+            self._order_id += 1
+            return {"code": 0, "data": [{"in_order_id": self._order_id}]}
+
+        return {"code": 0, "data": []}
+
+    async def request(self, method: str, url, **kwargs):
+        body = json.dumps(self._respond(method, url, kwargs)).encode("utf-8")
+        return AioHttpClientResponse(
+            ok=True, url=url, status=200, request_info=None, headers={}, body=body, json_loads=self._json_loads)
+
+    async def close(self):
+        pass
+
+
+class ReplayFleet:
+    """
+    录制时数据库中的 agv 状态, 由 FakeDatabase 回答 Adapter 的查询, fixtures 的键为:
+        "DB agv_state"        agv_state 表的行（列表）, 默认没有 agv
+        "DB active_orders"    有进行中订单的 agv id（列表）
+    """
+
+    def __init__(self, fixtures: dict | None = None) -> None:
+        fixtures = fixtures or {}
+        self.rows = {row["agv_id"]: dict(row) for row in fixtures.get("DB agv_state", [])}
+        self.active_orders = set(fixtures.get("DB active_orders", []))
+
+
+class ReplayEngine:
+    """
+    按日志的时间线驱动所有设备的模拟 PLC, 并在指定的设备配置上运行 Adapter
+    """
+
+    def __init__(self, journal_path: str, start: float | None = None, end: float | None = None,
+                 backup_count: int = 10, tail: float = 5, fixtures: dict | None = None,
+                 outbox_path: str = "./data/replay/outbox.sqlite3") -> None:
+        self._reader = JournalReader(journal_path, backup_count)
+        self._start = start
+        self._end = end
+        self._tail = tail
+        self._outbox_path = outbox_path
+
+        self._recorder = ReplayRecorder()
+        self._http_client = ReplayHttpClient(self._recorder, fixtures)
+        self._database = FakeDatabase(ReplayFleet(fixtures))
+        self._plc_mapping: dict[str, ReplayPlc] = {}
+        self._expected_writes = []
+
+    def get_recorder(self) -> ReplayRecorder:
+        return self._recorder
+
+    def install(self) -> None:
+        """
+        为每个设备配置准备模拟 PLC, 并替换 restapi 的 http 客户端、数据库、订单发件箱
+        必须在创建 Adapter 之前调用
+        """
+        for device_conf in sig_cfg["DEVICE"]:
+            host, port = device_conf["HOST"], device_conf["PORT"]
+            plc = ReplayPlc("{}:{}".format(host, port), self._recorder)
+
+            BaseDevice._connection_pool[host + str(port)] = AioMcClient(host, port, transport=ReplayTransport(plc))
+
+            self._plc_mapping[device_conf["NAME"]] = plc
+            for sub_device_conf in device_conf.get("SUB_DEVICE", []):
+                self._plc_mapping[sub_device_conf["NAME"]] = plc
+
+        # 回放不写入生产环境的寄存器日志, 也不需要数据库通知
+        conf["JOURNAL"]["ENABLE"] = False
+        conf["DATABASE_NOTIFY"]["ENABLE"] = False
+        conf["GP_CACHE"]["NOTIFY"] = False
+
+        restapi.aio_requests = self._http_client
+        self._database.install(aiopg)
+
+        if os.path.exists(self._outbox_path):
+            os.remove(self._outbox_path)
+
+        outbox = AioOutbox(path=self._outbox_path, handler=adapter_module.submit_order, workers=1)
+        outbox.add_callback(self.on_order_status)
+        adapter_module.order_outbox = outbox
+
+    def on_order_status(self, key, status, payload, result):
+        self._recorder.record("order", key=key, status=str(status), payload=payload, result=repr(result))
+
+    async def feed(self) -> None:
+        """
+        start 之前的变化立即写入, 用于还原回放开始时的寄存器状态, 之后按时间线写入
+        """
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        first_timestamp = self._start
+
+        for record in self._reader.query(end=self._end):
+            plc = self._plc_mapping.get(record.device)
+
+            if plc is None:
+                continue
+
+            if self._start is not None and record.timestamp < self._start:
+                if record.origin == ORIGIN_READ:
+                    plc.set(record.address, record.new)
+                continue
+
+            if first_timestamp is None:
+                first_timestamp = record.timestamp
+
+            delay = (record.timestamp - first_timestamp) - (loop.time() - started_at)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if record.origin == ORIGIN_READ:
+                plc.set(record.address, record.new)
+            elif record.origin == ORIGIN_WRITE:
+                self._expected_writes.append({
+                    "time": round(record.timestamp - first_timestamp, 3),
+                    "device": record.device,
+                    "address": record.address,
+                    "value": record.new,
+                })
+
+    async def run(self) -> dict:
+        from core.adapter import Adapter
+
+        self.install()
+        self._recorder.start()
+
+        for device_conf in sig_cfg["DEVICE"]:
+            await Adapter(device_conf).run()
+
+        await self.feed()
+        await asyncio.sleep(self._tail)
+
+        await adapter_module.order_outbox.close()
+        self._database.uninstall()
+
+        events = self._recorder.get_events()
+        return {
+            "summary": {
+                "plc_writes": sum(1 for event in events if event["type"] == "plc_write"),
+                "expected_writes": len(self._expected_writes),
+                "rest_calls": sum(1 for event in events if event["type"] == "rest"),
+                "orders": sum(1 for event in events if event["type"] == "order"),
+            },
+            "events": events,
+            "expected_writes": self._expected_writes,
+        }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Replay a register journal through Adapter.run")
+    parser.add_argument("journal", help="register journal file, rotated files are read as well")
+    parser.add_argument("--start", type=parse_time, help="epoch seconds or ISO time")
+    parser.add_argument("--end", type=parse_time, help="epoch seconds or ISO time")
+    parser.add_argument("--speed", type=float, default=1, help="replay speed, e.g. 10 for 10x")
+    parser.add_argument("--tail", type=float, default=5, help="seconds to keep running after the last record")
+    parser.add_argument("--backup-count", type=int, default=10)
+    parser.add_argument("--fixtures", help="json file of canned REST responses, {\"METHOD /path/\": response}, "
+                                           "and database rows, {\"DB agv_state\": [row, ...]} (see ReplayFleet)")
+    parser.add_argument("--output", default="./data/replay/output.json")
+    args = parser.parse_args(argv)
+
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures, mode="r", encoding="UTF-8") as f:
+            fixtures = json.load(f)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+
+    engine = ReplayEngine(
+        args.journal,
+        start=args.start,
+        end=args.end,
+        backup_count=args.backup_count,
+        tail=args.tail,
+        fixtures=fixtures,
+        outbox_path=os.path.join(output_dir or ".", "outbox.sqlite3"),
+    )
+
+    loop = ScaledTimeEventLoop(args.speed)
+    try:
+        rr = loop.run_until_complete(engine.run())
+    finally:
+        # Adapter 的任务永远不会结束, 回放完成后统一取消
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+
+    with open(args.output, mode="w", encoding="UTF-8") as f:
+        json.dump(rr, f, indent=2, ensure_ascii=False)
+
+    log.info("replay finished: {}, output: {}".format(rr["summary"], args.output))
+
+
+if __name__ == "__main__":
+    main()
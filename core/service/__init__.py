@@ -2,6 +2,7 @@ from aiohttp import web
 
 from . import views
 from .urls import routes
+from .middlewares import tracing_middleware, metrics_middleware
 
-app = web.Application()
+app = web.Application(middlewares=[tracing_middleware, metrics_middleware])
 app.add_routes(routes)
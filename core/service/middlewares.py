@@ -0,0 +1,68 @@
+import time
+
+from aiohttp import web
+
+from utils import metrics
+from utils.tracing import tracer
+
+
+HTTP_SERVER_SECONDS = metrics.histogram(
+    "http_server_request_seconds", "Latency of the http handlers", ["method", "route"])
+HTTP_SERVER_RESPONSES = metrics.counter(
+    "http_server_responses_total", "Http responses by status", ["method", "route", "status"])
+
+
+def get_route_name(request: web.Request) -> str:
+    """
+    路由模板（如 /car/{car_number}/）, 避免每个车板号都产生一组指标
+    """
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else "unmatched"
+
+
+@web.middleware
+async def tracing_middleware(request: web.Request, handler):
+    """
+    每个请求开启一条链路, 请求头带有 X-Trace-Id 时沿用该 id 并强制采样（每秒最多 TRACING.FORCE_LIMIT 条,
+    超出的按 SAMPLE_RATE 采样）, 采样的请求在响应头中返回 X-Trace-Id
+    """
+    trace_id = request.headers.get("X-Trace-Id")
+
+    with tracer.start_trace(
+        "{} {}".format(request.method, get_route_name(request)),
+        trace_id=trace_id,
+        sampled=True if trace_id else None,
+        method=request.method,
+        path=request.path,
+    ) as span:
+        if span is None:
+            return await handler(request)
+
+        try:
+            response = await handler(request)
+        except web.HTTPException as e:
+            span.set("status", e.status)
+            raise
+
+        span.set("status", response.status)
+        if span.trace.sampled:
+            response.headers["X-Trace-Id"] = span.trace.trace_id
+        return response
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    started_at = time.perf_counter()
+    status = 500
+
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = get_route_name(request)
+        HTTP_SERVER_SECONDS.labels(request.method, route).observe(time.perf_counter() - started_at)
+        HTTP_SERVER_RESPONSES.labels(request.method, route, status).inc()
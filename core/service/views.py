@@ -4,20 +4,140 @@ import asyncio
 
 from aiohttp import web
 
-from utils import log
+from utils import log, conf, metrics
+from utils.profiler import profiler
 
 from core.adapter import DeviceAdapterManager
-from core.device import Device, SubDevice
+from core.device import Device, SubDevice, ImageRead, read_from_image
 
 from .resp import JsonResponse
 from .urls import routes
 
 
+IMAGE_MAX_AGE = conf["IMAGE_MAX_AGE"]
+
+
+def set_data_age(response: web.Response, image_read: ImageRead) -> web.Response:
+    """
+    响应头 X-Data-Age: 返回的寄存器数据的时效（秒）, 0 表示实时读取
+    """
+    response.headers["X-Data-Age"] = "{:.3f}".format(image_read.age)
+    return response
+
+
 @routes.get("/")
 async def index(request: web.Request):
     return "hello world"
 
 
+@routes.get("/metrics")
+async def get_metrics(request: web.Request):
+    """
+    Prometheus 文本格式的指标
+    """
+    return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+@routes.get("/admin/profiler/")
+async def get_profiler(request: web.Request):
+    """
+    查看性能分析结果:
+        ?format=report       按耗时排序的报告（默认）
+        ?format=collapsed    折叠栈文本, 可用 flamegraph.pl / speedscope 打开, weight 可选
+                             wall_seconds、mc_seconds、mc_calls、db_seconds、db_calls、rest_seconds、rest_calls
+    """
+    try:
+
+        if request.query.get("format") == "collapsed":
+            return web.Response(text=profiler.get_collapsed(request.query.get("weight", "wall_seconds")))
+
+        return await JsonResponse(
+            code=0,
+            data={
+                "status": profiler.get_status(),
+                "report": profiler.get_report(int(request.query.get("limit", conf["PROFILER"]["REPORT_LIMIT"]))),
+            }
+        )
+
+    except ValueError as e:
+        return await JsonResponse(
+            code=1,
+            err="请求失败, 无效的参数: {}".format(e)
+        )
+
+    except Exception as e:
+        asyncio.get_running_loop().call_exception_handler({"exception": e})
+        return await JsonResponse(
+            code=1,
+            err="请求失败, 在请求过程中发生了一些错误"
+        )
+
+
+@routes.post("/admin/profiler/")
+async def switch_profiler(request: web.Request):
+    """
+    开启或关闭性能分析:
+        {
+            "action": "start",
+            "duration": 60,        # 可选, 持续秒数, 到期自动关闭
+            "sample_rate": 0.1     # 可选, 采样的任务轮次比例
+        }
+        {
+            "action": "stop",
+            "dump": true,          # 可选, 将折叠栈写入 PROFILER.DUMP_DIR
+            "weight": "mc_seconds" # 可选, 折叠栈的权重
+        }
+    """
+    try:
+
+        req_data = await request.json()
+
+        action = req_data["action"]
+
+        if action == "start":
+            duration = req_data.get("duration", conf["PROFILER"]["DURATION"])
+            sample_rate = req_data.get("sample_rate", conf["PROFILER"]["SAMPLE_RATE"])
+
+            profiler.start(duration=duration, sample_rate=sample_rate)
+
+            return await JsonResponse(
+                code=0,
+                data=profiler.get_status(),
+                msg="请求成功, 已开启性能分析, 持续 {}s, 采样比例 {}".format(duration, sample_rate)
+            )
+
+        if action == "stop":
+            profiler.stop()
+
+            path = None
+            if req_data.get("dump"):
+                path = profiler.dump(conf["PROFILER"]["DUMP_DIR"], req_data.get("weight", "wall_seconds"))
+
+            return await JsonResponse(
+                code=0,
+                data={"status": profiler.get_status(), "path": path},
+                msg="请求成功, 已关闭性能分析" + (", 折叠栈已写入 {}".format(path) if path else "")
+            )
+
+        return await JsonResponse(
+            code=1,
+            err="请求失败, 无效的动作 {}, 期望得到 start 或者 stop".format(action)
+        )
+
+    except ValueError as e:
+        return await JsonResponse(
+            code=1,
+            err="请求失败, 无效的参数: {}".format(e)
+        )
+
+    except Exception as e:
+        asyncio.get_running_loop().call_exception_handler({"exception": e})
+        return await JsonResponse(
+            code=1,
+            err="请求失败, 在请求过程中发生了一些错误"
+        )
+
+
 @routes.get("/car/{car_number}/")
 async def has_car(request: web.Request):
     """
@@ -30,12 +150,68 @@ async def has_car(request: web.Request):
         # 获取基础设备
         device = typing.cast(Device, DeviceAdapterManager.get("basic"))
 
-        rr = await device.has_car(car_number)
+        # 寄存器镜像足够新时直接使用, 否则实时读取
+        with read_from_image(IMAGE_MAX_AGE["HAS_CAR"]) as image_read:
+            rr = await device.has_car(car_number)
 
-        return await JsonResponse(
+        return set_data_age(await JsonResponse(
             code=0,
             msg="查询车板号 {} 上是否有车 {}".format(car_number, rr),
             data=rr
+        ), image_read)
+
+    except Exception as e:
+        asyncio.get_running_loop().call_exception_handler({"exception": e})
+        return await JsonResponse(
+            code=1,
+            err="请求失败, 在请求过程中发生了一些错误"
+        )
+
+
+@routes.get("/cars/")
+async def has_cars(request: web.Request):
+    """
+    批量查询车板身上是否有货, 整个车板信息区域只读取一次
+    车板号与 /car/{car_number}/ 相同, 是车板信息区域内从 0 开始的偏移: 0 ~ STORE_INFO.LENGTH - 1
+
+        ?car_numbers=1,2,5     指定车板号
+        ?start=0&end=49        车板号区间（包含 end）, 默认 start=0、end=STORE_INFO.LENGTH - 1
+        ?format=array          occupied 为 0/1 数组, 与车板号一一对应（默认）
+        ?format=bitmap         bitmap 为十六进制字符串, 第 i 位（最低位为第 0 位）对应 car_numbers[i],
+                               按区间查询时对应车板号 start + i; data 中总会返回 car_numbers 或 start/end
+    """
+    try:
+
+        # 获取基础设备
+        device = typing.cast(Device, DeviceAdapterManager.get("basic"))
+
+        with read_from_image(IMAGE_MAX_AGE["CARS"]) as image_read:
+            if "car_numbers" in request.query:
+                car_numbers = [int(car_number) for car_number in request.query["car_numbers"].split(",") if car_number]
+                rr = await device.has_cars(car_numbers)
+                data = {"car_numbers": car_numbers}
+            else:
+                start = int(request.query.get("start", 0))
+                end = int(request.query.get("end", device.get_recv_conf()["STORE_INFO"]["LENGTH"] - 1))
+                if start > end:
+                    raise ValueError("start {} is greater than end {}".format(start, end))
+                rr = await device.has_cars(range(start, end + 1))
+                data = {"start": start, "end": end}
+
+        if request.query.get("format") == "bitmap":
+            data["bitmap"] = "{:x}".format(sum(1 << index for index, occupied in enumerate(rr) if occupied))
+        else:
+            data["occupied"] = [int(occupied) for occupied in rr]
+
+        return set_data_age(await JsonResponse(
+            code=0,
+            data=data
+        ), image_read)
+
+    except ValueError as e:
+        return await JsonResponse(
+            code=1,
+            err="请求失败, 无效的车板号: {}".format(e)
         )
 
     except Exception as e:
@@ -191,18 +367,19 @@ async def heartbeat(request: web.Request):
 
         device = typing.cast(SubDevice, DeviceAdapterManager.get(device_name))
 
-        is_stop = device.mode_is_stop()
+        with read_from_image(IMAGE_MAX_AGE["HEARTBEAT"]) as image_read:
+            is_stop = await device.mode_is_stop()
 
         if is_stop:
-            return await JsonResponse(
+            return set_data_age(await JsonResponse(
                 code=0,
                 msg="轿厢 {} 已暂停, 心跳区域生效".format(device_name)
-            )
+            ), image_read)
 
-        return await JsonResponse(
+        return set_data_age(await JsonResponse(
             code=1,
             msg="轿厢 {} 未暂停, 不触发区域心跳".format(device_name)
-        )
+        ), image_read)
 
     except KeyError as e:
         asyncio.get_running_loop().call_exception_handler({"exception": e})
@@ -238,7 +415,9 @@ async def ssio_request_in(request: web.Request):
 
         device = typing.cast(SubDevice, DeviceAdapterManager.get(device_name))
 
-        is_ready = int(await device.ready_docking())
+        # 仅就绪状态可以使用寄存器镜像, 后续的写入始终是实时的
+        with read_from_image(IMAGE_MAX_AGE["REQUEST_IN"]) as image_read:
+            is_ready = int(await device.ready_docking())
 
         if is_ready:
 
@@ -256,15 +435,15 @@ async def ssio_request_in(request: web.Request):
 
             # --------------------
 
-            return await JsonResponse(
+            return set_data_age(await JsonResponse(
                 code=0,
                 msg="请求成功, 轿厢 {} 已就绪、允许进入".format(device_name)
-            )
+            ), image_read)
 
-        return await JsonResponse(
+        return set_data_age(await JsonResponse(
             code=1,
             msg="请求成功, 轿厢 {} 未就绪、不允许进入".format(device_name)
-        )
+        ), image_read)
 
     except KeyError as e:
         asyncio.get_running_loop().call_exception_handler({"exception": e})
@@ -1,8 +1,10 @@
 import asyncio
 import traceback
 
-from utils import log, sig_cfg
+from utils import log, conf, sig_cfg, aio_requests, register_journal, tracer
+from utils.loop_monitor import LoopMonitor
 from core.adapter import Adapter
+from core.adapter.adapter import order_outbox
 from core.service import app, web
 
 
@@ -16,17 +18,46 @@ def exception_handler(_, context):
         log.error("调度任务被取消, 可能造成的原因是程序已被强制关闭")
 
     if isinstance(exception, Exception):
-        log.error(traceback.format_exc())
+        # 异常处理器不在 except 块中执行, format_exc() 拿不到这个异常
+        log.error("".join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+
+
+loop_monitor = LoopMonitor(
+    interval=conf["LOOP_MONITOR"]["INTERVAL"],
+    threshold=conf["LOOP_MONITOR"]["STALL_THRESHOLD"],
+    window=conf["LOOP_MONITOR"]["WINDOW"],
+    stack_limit=conf["LOOP_MONITOR"]["STACK_LIMIT"],
+)
 
 
 async def main(_):
 
     asyncio.get_running_loop().set_exception_handler(exception_handler)
 
-    for conf in sig_cfg["DEVICE"]:
-        await Adapter(conf).run()
+    # 监控事件循环的调度延迟, 循环被阻塞时记录阻塞它的调用栈
+    loop_monitor.start()
+
+    # 预先建立到 restapi 的长连接
+    await aio_requests.warm_up(connections=conf["RESTAPI_POOL"]["WARM_UP"])
+
+    adapters = [Adapter(device_conf) for device_conf in sig_cfg["DEVICE"]]
+    for adapter in adapters:
+        await adapter.run()
+
+    yield
+
+    # 先停止 Adapter 的所有循环, 之后再关闭它们使用的订单发件箱、http 客户端与寄存器日志
+    loops = [adapter.get_loops() for adapter in adapters if adapter.get_loops() is not None]
+    for adapter_loops in loops:
+        adapter_loops.cancel()
+    await asyncio.gather(*loops, return_exceptions=True)
 
-        yield
+    await loop_monitor.close()
+    await order_outbox.close()
+    await aio_requests.close()
+    # 等待写日志线程写完剩余的记录, 不阻塞事件循环
+    await asyncio.get_running_loop().run_in_executor(None, register_journal.close)
+    await asyncio.get_running_loop().run_in_executor(None, tracer.close)
 
 if __name__ == "__main__":
     app.cleanup_ctx.append(main)
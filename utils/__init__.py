@@ -1,11 +1,42 @@
 from logging import Logger
 from .config import Config
 from .logrus import Logrus
-from .aio_postgresql import AioPostgresql
+from .journal import RegisterJournal
+from .aio_postgresql import AioPostgresql, AioPgListener
 from .protocol.http.aio_http_client import AioHttpClient
+from .tracing import tracer, FileSpanExporter
 
 conf: Config = Config("./conf/config.json")
 sig_cfg: Config = Config("./conf/private/signal.json")
 log: Logger = Logrus("./conf/private/log.json").get_logger()
 aiopg: AioPostgresql = AioPostgresql(conf_dict=conf["DATABASE"])
-aio_requests: AioHttpClient = AioHttpClient(base_url=conf["RESTAPI"], keep_alive=False, timeout=60)
+aiopg_listener: AioPgListener = AioPgListener(
+    conf_dict=conf["DATABASE"],
+    keepalive=conf["DATABASE_NOTIFY"]["KEEPALIVE"],
+    reconnect_interval=conf["DATABASE_NOTIFY"]["RECONNECT_INTERVAL"],
+)
+aio_requests: AioHttpClient = AioHttpClient(
+    base_url=conf["RESTAPI"],
+    keep_alive=True,
+    timeout=60,
+    limit_per_host=conf["RESTAPI_POOL"]["LIMIT_PER_HOST"],
+    keepalive_timeout=conf["RESTAPI_POOL"]["KEEPALIVE_TIMEOUT"],
+    ttl_dns_cache=conf["RESTAPI_POOL"]["TTL_DNS_CACHE"],
+)
+register_journal: RegisterJournal = RegisterJournal(
+    path=conf["JOURNAL"]["PATH"],
+    max_bytes=conf["JOURNAL"]["MAX_BYTES"],
+    backup_count=conf["JOURNAL"]["BACKUP_COUNT"],
+    flush_interval=conf["JOURNAL"]["FLUSH_INTERVAL"],
+)
+tracer.configure(
+    exporter=FileSpanExporter(
+        path=conf["TRACING"]["PATH"],
+        max_bytes=conf["TRACING"]["MAX_BYTES"],
+        backup_count=conf["TRACING"]["BACKUP_COUNT"],
+    ),
+    enable=conf["TRACING"]["ENABLE"],
+    sample_rate=conf["TRACING"]["SAMPLE_RATE"],
+    slow_threshold=conf["TRACING"]["SLOW_THRESHOLD"],
+    force_limit=conf["TRACING"]["FORCE_LIMIT"],
+)
@@ -0,0 +1,168 @@
+import asyncio
+import functools
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from .auxiliary import loop_time
+
+
+_ALL = object()
+
+
+async def wait_inflight(inflight: asyncio.Future) -> tuple[bool, Any]:
+    """
+    Wait for the result of a load started by another task, returns (True, result)
+    or (False, None) when that load was cancelled: the waiter must then load itself.
+    Only the cancellation of the waiting task itself is propagated as CancelledError
+    """
+    try:
+        return True, await asyncio.shield(inflight)
+    except asyncio.CancelledError:
+        task = asyncio.current_task()
+        if inflight.cancelled() and not (task is not None and task.cancelling()):
+            return False, None
+        raise
+
+
+class AioTTLCache:
+    """
+    An asyncio cache with TTL expiry and an LRU bound
+
+    Concurrent misses of the same key are coalesced (single-flight):
+    only the first caller runs the loader, the others wait for its result.
+    Exceptions raised by the loader are propagated to all waiters and never cached
+    The TTL is measured with the clock of the event loop (utils.auxiliary.loop_time)
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 128, name: Optional[str] = None) -> None:
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._name = name
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # generation of every key with a load in flight, bumped by set() / invalidate():
+        # a load that started before a write must not store its (older) result
+        self._generations: Dict[Hashable, int] = {}
+        self._stats: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "evictions": 0,
+        }
+
+    def __repr__(self) -> str:
+        return "<{} {} ttl={} size={}/{}>".format(
+            __class__.__name__, self._name, self._ttl, len(self._data), self._maxsize)
+
+    def get_name(self) -> Optional[str]:
+        return self._name
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["size"] = len(self._data)
+        return stats
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+
+        if item is None:
+            return default
+
+        expires_at, value = item
+        if expires_at < loop_time():
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def _bump(self, key: Hashable = _ALL) -> None:
+        if key is _ALL:
+            for inflight_key in self._generations:
+                self._generations[inflight_key] += 1
+        elif key in self._generations:
+            self._generations[key] += 1
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._bump(key)
+        self._data[key] = (loop_time() + self._ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def invalidate(self, key: Hashable = _ALL) -> None:
+        """
+        Drop one key, or every key when called without arguments
+        A load that is already in flight completes for its callers but its result is not stored
+        """
+        self._bump(key)
+
+        if key is _ALL:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key, _ALL)
+
+        if value is not _ALL:
+            self._stats["hits"] += 1
+            return value
+
+        # when the leading load is cancelled (e.g. by a timeout of its caller) the waiters are not,
+        # one of them starts the load again
+        inflight = self._inflight.get(key)
+        while inflight is not None:
+            self._stats["coalesced"] += 1
+            done, value = await wait_inflight(inflight)
+            if done:
+                return value
+            inflight = self._inflight.get(key)
+
+        self._stats["misses"] += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self._generations[key] = generation = 0
+
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # the exception is re-raised here, avoid "exception was never retrieved" warnings
+            future.exception()
+            raise
+        else:
+            if self._generations[key] == generation:
+                self.set(key, value)
+            else:
+                # written while loading, the written value is newer than the loaded one
+                value = self.get(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+            self._generations.pop(key, None)
+
+
+def aio_cached(ttl: float, maxsize: int = 128):
+    """
+    Cache the result of a coroutine function by its arguments
+    The cache is available as `fn.cache` for invalidation and statistics
+    """
+    def inner(coro):
+        cache = AioTTLCache(ttl, maxsize, name=coro.__name__)
+
+        @functools.wraps(coro)
+        async def wrapper(*args, **kwargs):
+            key = args + tuple(sorted(kwargs.items()))
+            return await cache.get_or_load(key, lambda: coro(*args, **kwargs))
+
+        setattr(wrapper, "cache", cache)
+        return wrapper
+    return inner
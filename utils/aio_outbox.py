@@ -0,0 +1,242 @@
+import os
+import enum
+import json
+import time
+import asyncio
+import sqlite3
+import threading
+import traceback
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from . import log
+
+
+OutboxHandler = Callable[[Dict[str, Any]], Awaitable[Any]]
+OutboxCallback = Callable[[str, str, Dict[str, Any], Any], Any]
+
+
+class OUTBOX_STATUS(enum.StrEnum):
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class AioOutbox:
+    """
+    A durable local outbox backed by SQLite
+
+    enqueue() only persists the message and returns, a pool of workers submits it
+    through `handler` in the background, retrying with exponential backoff (capped at `max_backoff`).
+    With max_retries=0 a message is retried until it is done, otherwise it is marked failed after
+    `max_retries` attempts. A message is rejected while a message with the same idempotency key is still pending,
+    once that one is done or has finally failed the key is accepted again. Pending messages survive restarts.
+
+    Callbacks are called as callback(key, status, payload, result_or_error) after each attempt
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          idempotency_key TEXT NOT NULL,
+          payload TEXT NOT NULL,
+          status TEXT NOT NULL,
+          attempts INTEGER NOT NULL DEFAULT 0,
+          result TEXT,
+          created_at REAL NOT NULL,
+          updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS outbox_key_index ON outbox (idempotency_key, created_at);
+        CREATE INDEX IF NOT EXISTS outbox_status_index ON outbox (status);
+    """
+
+    def __init__(
+        self,
+        path: str,
+        handler: OutboxHandler,
+        workers: int = 2,
+        max_retries: int = 5,
+        backoff: float = 1,
+        max_backoff: float = 30,
+        retention_days: float = 7,
+    ) -> None:
+        self._path = path
+        self._handler = handler
+        self._workers = workers
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._retention_days = retention_days
+
+        self._conn: Optional[sqlite3.Connection] = None
+        # sqlite3 is called from the default executor, the connection must be used serially
+        self._conn_lock = threading.Lock()
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._callbacks: List[OutboxCallback] = []
+
+    def __repr__(self) -> str:
+        return "<{} {}>".format(__class__.__name__, self._path)
+
+    def add_callback(self, callback: OutboxCallback) -> None:
+        self._callbacks.append(callback)
+
+    def is_started(self) -> bool:
+        return bool(self._tasks)
+
+    async def start(self) -> None:
+        """
+        Open the database, requeue the messages left pending by the previous run and start the workers
+        Calling start() more than once has no effect
+        """
+        if self.is_started():
+            return
+
+        await asyncio.to_thread(self._open)
+
+        self._queue = asyncio.Queue()
+        for row_id in await asyncio.to_thread(self._pending_ids):
+            self._queue.put_nowait(row_id)
+
+        for index in range(self._workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name="{}-worker-{}".format(self, index)))
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        if self._conn is not None:
+            await asyncio.to_thread(self._conn.close)
+            self._conn = None
+
+    async def enqueue(self, key: str, payload: Dict[str, Any]) -> bool:
+        """
+        Persist a message, returns False if a message with the same key is still pending
+        """
+        assert self._queue is not None, "{} is not started".format(self)
+
+        row_id = await asyncio.to_thread(self._insert, key, payload)
+
+        if row_id is None:
+            return False
+
+        self._queue.put_nowait(row_id)
+        return True
+
+    # ---- sqlite, executed in the default executor
+
+    def _open(self) -> None:
+        dirname = os.path.dirname(self._path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        self._conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        with self._conn_lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self._SCHEMA)
+            self._conn.execute(
+                "DELETE FROM outbox WHERE status != ? AND updated_at < ?",
+                (OUTBOX_STATUS.PENDING, time.time() - self._retention_days * 86400)
+            )
+
+    def _pending_ids(self) -> List[int]:
+        assert self._conn is not None
+        with self._conn_lock:
+            rows = self._conn.execute(
+                "SELECT id FROM outbox WHERE status = ? ORDER BY id", (OUTBOX_STATUS.PENDING, )
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def _insert(self, key: str, payload: Dict[str, Any]) -> Optional[int]:
+        assert self._conn is not None
+        now = time.time()
+
+        with self._conn_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                duplicate = self._conn.execute(
+                    "SELECT id FROM outbox WHERE idempotency_key = ? AND status = ? LIMIT 1",
+                    (key, OUTBOX_STATUS.PENDING)
+                ).fetchone()
+
+                if duplicate is not None:
+                    self._conn.execute("COMMIT")
+                    return None
+
+                cursor = self._conn.execute(
+                    "INSERT INTO outbox (idempotency_key, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, json.dumps(payload), OUTBOX_STATUS.PENDING, now, now)
+                )
+                self._conn.execute("COMMIT")
+                return cursor.lastrowid
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _load(self, row_id: int) -> Optional[tuple]:
+        assert self._conn is not None
+        with self._conn_lock:
+            return self._conn.execute(
+                "SELECT idempotency_key, payload, attempts FROM outbox WHERE id = ? AND status = ?",
+                (row_id, OUTBOX_STATUS.PENDING)
+            ).fetchone()
+
+    def _update(self, row_id: int, status: str, attempts: int, result: Any) -> None:
+        assert self._conn is not None
+        with self._conn_lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, result = ?, updated_at = ? WHERE id = ?",
+                (status, attempts, json.dumps(result, default=str), time.time(), row_id)
+            )
+
+    # ---- workers
+
+    async def _notify(self, key: str, status: str, payload: Dict[str, Any], result: Any) -> None:
+        for callback in self._callbacks:
+            try:
+                rr = callback(key, status, payload, result)
+                if asyncio.iscoroutine(rr):
+                    await rr
+            except Exception:
+                log.error("{} callback error: {}".format(self, traceback.format_exc()))
+
+    async def _worker(self) -> None:
+        assert self._queue is not None
+
+        while True:
+            row_id = await self._queue.get()
+            try:
+                await self._process(row_id)
+            except Exception:
+                log.error("{}: {}".format(self, traceback.format_exc()))
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, row_id: int) -> None:
+        row = await asyncio.to_thread(self._load, row_id)
+
+        if row is None:
+            return
+
+        key, payload, attempts = row
+        payload = json.loads(payload)
+
+        while True:
+            attempts += 1
+            try:
+                result = await self._handler(payload)
+            except Exception as e:
+                if self._max_retries and attempts >= self._max_retries:
+                    await asyncio.to_thread(self._update, row_id, OUTBOX_STATUS.FAILED, attempts, repr(e))
+                    await self._notify(key, OUTBOX_STATUS.FAILED, payload, e)
+                    return
+
+                await asyncio.to_thread(self._update, row_id, OUTBOX_STATUS.PENDING, attempts, repr(e))
+                await self._notify(key, OUTBOX_STATUS.PENDING, payload, e)
+                await asyncio.sleep(min(self._backoff * 2 ** (attempts - 1), self._max_backoff))
+            else:
+                await asyncio.to_thread(self._update, row_id, OUTBOX_STATUS.DONE, attempts, result)
+                await self._notify(key, OUTBOX_STATUS.DONE, payload, result)
+                return
@@ -1,15 +1,34 @@
+import time
 import asyncio
-from typing import Any, Optional, Dict
+import contextlib
+from typing import Any, Callable, Optional, Dict, List, Iterable
 
 import asyncpg
 
 from .auxiliary import FoxType
+from . import metrics
+from .profiler import profiler
+
+
+DB_STATEMENT_SECONDS = metrics.histogram(
+    "db_statement_seconds", "Latency of the named database statements", ["statement"])
+DB_STATEMENT_ERRORS = metrics.counter(
+    "db_statement_errors_total", "Named database statements that raised", ["statement"])
 
 
 class AioPostgresql(metaclass=FoxType):
+    """
+    Statements registered by name are sent through asyncpg's per-connection statement cache,
+    so each of them is parsed and planned once per pooled connection and then only executed.
+    (asyncpg PreparedStatement objects cannot outlive a pool acquire, the cache is the supported way to reuse them)
+    Every named statement keeps its own timing counters, see get_statement_stats()
+    """
+
     def __init__(self, conf_dict: Dict[str, Any]) -> None:
         self.conf_dict = conf_dict
         self.connect_pool: Optional[asyncpg.Pool] = None
+        self._statements: Dict[str, str] = {}
+        self._statement_stats: Dict[str, Dict[str, float]] = {}
 
     def get_conf_dict(self) -> Dict[str, Any]:
         return self.conf_dict
@@ -28,21 +47,107 @@ class AioPostgresql(metaclass=FoxType):
         from . import log
         while self.connect_pool is None:
             try:
-                self.connect_pool = await asyncpg.create_pool(**self.get_conf_dict())
+                conf = dict(self.get_conf_dict())
+                # the registered statements must always fit into the statement cache
+                conf["statement_cache_size"] = max(conf.get("statement_cache_size", 100), len(self._statements) * 2)
+                self.connect_pool = await asyncpg.create_pool(**conf)
             except Exception as e:
                 log.error("{} connection pool create faild, retrying ..\n{}".format(self, e))
                 await asyncio.sleep(3)
         return self.connect_pool
 
+    # ---- named statements
+
+    def register(self, name: str, query: str) -> str:
+        """
+        Register a statement by name, returns the name so it can be kept as a module constant
+        """
+        assert name not in self._statements or self._statements[name] == query, \
+            "{} statement {} is already registered with another query".format(self, name)
+
+        self._statements[name] = query
+        self._statement_stats.setdefault(name, {"calls": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0})
+        return name
+
+    def get_statement(self, name: str) -> str:
+        return self._statements[name]
+
+    def get_statement_stats(self) -> Dict[str, Dict[str, float]]:
+        return {name: dict(stats) for name, stats in self._statement_stats.items()}
+
+    @contextlib.contextmanager
+    def _timing(self, name: str):
+        stats = self._statement_stats[name]
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            stats["errors"] += 1
+            DB_STATEMENT_ERRORS.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            stats["calls"] += 1
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+            DB_STATEMENT_SECONDS.labels(name).observe(elapsed)
+            profiler.add("db", elapsed)
+
+    async def execute_named(self, name: str, *args, timeout: Optional[float] = None) -> str:
+        with self._timing(name):
+            return await self.execute(self.get_statement(name), *args, timeout=timeout)
+
+    async def executemany_named(self, name: str, args: Iterable, *, timeout: Optional[float] = None):
+        with self._timing(name):
+            return await self.executemany(self.get_statement(name), args, timeout=timeout)
+
+    async def fetch_named(self, name: str, *args, timeout=None, record_class=None) -> list:
+        with self._timing(name):
+            return await self.fetch(self.get_statement(name), *args, timeout=timeout, record_class=record_class)
+
+    async def fetchval_named(self, name: str, *args, column=0, timeout=None):
+        with self._timing(name):
+            return await self.fetchval(self.get_statement(name), *args, column=column, timeout=timeout)
+
+    async def fetchrow_named(self, name: str, *args, timeout=None, record_class=None):
+        with self._timing(name):
+            return await self.fetchrow(self.get_statement(name), *args, timeout=timeout, record_class=record_class)
+
+    # ---- raw queries
+
     async def execute(self, query: str, *args, timeout: Optional[float] = None) -> str:
         async with (await self.get_connect_pool()).acquire() as conn:
             async with conn.transaction():
                 return await conn.execute(query, *args, timeout=timeout)
 
-    async def executemany(self, command: str, args, *, timeout: Optional[float] = None):
+    async def executemany(self, command: str, args: Iterable, *, timeout: Optional[float] = None):
+        """
+        Execute the command once per argument tuple, in one transaction and one network round trip
+        """
         async with (await self.get_connect_pool()).acquire() as conn:
             async with conn.transaction():
-                return await conn.execute(command, *args, timeout=timeout)
+                return await conn.executemany(command, args, timeout=timeout)
+
+    async def copy_records(
+        self,
+        table_name: str,
+        records: Iterable,
+        *,
+        columns: Optional[List[str]] = None,
+        schema_name: Optional[str] = None,
+        timeout: Optional[float] = None
+    ) -> str:
+        """
+        Bulk insert through the COPY protocol, much faster than INSERT for large batches
+        """
+        async with (await self.get_connect_pool()).acquire() as conn:
+            return await conn.copy_records_to_table(
+                table_name,
+                records=records,
+                columns=columns,
+                schema_name=schema_name,
+                timeout=timeout
+            )
 
     async def fetch(self, query, *args, timeout=None, record_class=None) -> list:
         return await (await self.get_connect_pool())\
@@ -55,3 +160,97 @@ class AioPostgresql(metaclass=FoxType):
     async def fetchrow(self, query, *args, timeout=None, record_class=None):
         return await (await self.get_connect_pool())\
             .fetchrow(query, *args, timeout=timeout, record_class=record_class)
+
+
+class AioPgListener(metaclass=FoxType):
+    """
+    A change-feed based on PostgreSQL LISTEN/NOTIFY
+
+    Uses a dedicated connection outside of the pool, reconnects automatically
+    and pings the server every `keepalive` seconds to detect half-open links.
+    Callbacks are called as callback(payload), coroutine callbacks are scheduled as tasks.
+    Reconnect callbacks are called without arguments after every (re)connection,
+    notifications sent while disconnected are lost, so that is the place to resynchronize.
+    """
+
+    def __init__(self, conf_dict: Dict[str, Any], keepalive: float = 10, reconnect_interval: float = 3) -> None:
+        self.conf_dict = conf_dict
+        self._keepalive = keepalive
+        self._reconnect_interval = reconnect_interval
+        self._callbacks: Dict[str, List[Callable]] = {}
+        self._reconnect_callbacks: List[Callable] = []
+        self._connection: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def __auto_run__(self):
+        self.config_handle()
+
+    def config_handle(self):
+        conf = {}
+        for k, v in self.conf_dict.items():
+            conf[k.lower()] = v
+
+        self.conf_dict = conf
+
+    def get_conf_dict(self) -> Dict[str, Any]:
+        return self.conf_dict
+
+    def add_callback(self, channel: str, callback: Callable) -> None:
+        """
+        Must be called before start(), channels are subscribed when connecting
+        """
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def add_reconnect_callback(self, callback: Callable) -> None:
+        self._reconnect_callbacks.append(callback)
+
+    def is_connected(self) -> bool:
+        return self._connection is not None and not self._connection.is_closed()
+
+    def start(self) -> None:
+        """
+        Start listening in the background, calling start() more than once has no effect
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self.run_forever())
+
+    def _call(self, callback: Callable, *args) -> None:
+        try:
+            rr = callback(*args)
+            if asyncio.iscoroutine(rr):
+                asyncio.create_task(rr)
+        except Exception as e:
+            asyncio.get_running_loop().call_exception_handler({"exception": e})
+
+    def _dispatch(self, connection, pid, channel, payload) -> None:
+        for callback in self._callbacks.get(channel, []):
+            self._call(callback, payload)
+
+    async def run_forever(self) -> None:
+        from . import log
+        while True:
+            try:
+                self._connection = await asyncpg.connect(**self.get_conf_dict())
+
+                for channel in self._callbacks:
+                    await self._connection.add_listener(channel, self._dispatch)
+
+                log.info("{} listening on {}".format(self, list(self._callbacks)))
+
+                for callback in self._reconnect_callbacks:
+                    self._call(callback)
+
+                while not self._connection.is_closed():
+                    await asyncio.sleep(self._keepalive)
+                    await self._connection.execute("SELECT 1", timeout=self._keepalive)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error("{} connection lost, reconnecting ..\n{!r}".format(self, e))
+            finally:
+                if self._connection is not None:
+                    self._connection.terminate()
+                    self._connection = None
+
+            await asyncio.sleep(self._reconnect_interval)
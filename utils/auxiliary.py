@@ -1,3 +1,18 @@
+import time
+import asyncio
+
+
+def loop_time() -> float:
+    """
+    The clock of the running event loop, time.monotonic() outside of a loop
+    Timers measured with it follow a loop with a scaled clock (core.replay) like asyncio.sleep does
+    """
+    try:
+        return asyncio.get_running_loop().time()
+    except RuntimeError:
+        return time.monotonic()
+
+
 class FoxType(type):
     """
     Custom metaclass:
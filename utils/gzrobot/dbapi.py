@@ -1,102 +1,218 @@
-from utils import aiopg
+from utils import aiopg, conf
+from utils.aio_cache import AioTTLCache
+
+
+GP_CACHE_CONF = conf["GP_CACHE"]
+
+# 全局参数的进程内缓存, 键为 gp_name, 值为查询到的行（不存在时为空列表）
+gp_cache = AioTTLCache(ttl=GP_CACHE_CONF["TTL"], maxsize=GP_CACHE_CONF["MAXSIZE"], name="globalparameters")
+
+
+UPDATE_IO_STATE = aiopg.register("update_io_state", """
+    UPDATE layer1_agv.io_state
+    SET
+       last_updated_timestamp = now(),
+      io_status_id = 22
+    WHERE
+      io_id = $1;
+""")
+
 
 async def update_io_state(io_id):
-    UPDATE_IO_STATE = """
-        UPDATE layer1_agv.io_state
-        SET
-           last_updated_timestamp = now(),
-          io_status_id = 22
-        WHERE
-          io_id = $1;
+    return await aiopg.execute_named(UPDATE_IO_STATE, io_id)
+
+
+UPDATE_IO_STATES = aiopg.register("update_io_states", """
+    UPDATE layer1_agv.io_state
+    SET
+       last_updated_timestamp = now(),
+      io_status_id = 22
+    WHERE
+      io_id = ANY($1::int[]);
+""")
+
+
+async def update_io_states(io_id_list):
+    """
+    同 update_io_state, 一条语句更新多个 io
     """
+    return await aiopg.execute_named(UPDATE_IO_STATES, [int(io_id) for io_id in io_id_list])
+
 
-    return await aiopg.execute(UPDATE_IO_STATE, io_id)
+UPSERT_GP = aiopg.register("upsert_gp", """
+    INSERT INTO
+      layer4_1_om.globalparameters(gp_name, gp_value, gp_value_type)
+    VALUES
+        ($1, $2, 'str') ON CONFLICT (gp_name) DO
+    UPDATE
+        SET
+            gp_value = $2;
+""")
 
 
 async def upsert_gp(key, value):
-    UPSERT_GLOBAL_PARAMETERS = """
-        INSERT INTO
-          layer4_1_om.globalparameters(gp_name, gp_value, gp_value_type)
-        VALUES
-            ($1, $2, 'str') ON CONFLICT (gp_name) DO
-        UPDATE
-            SET
-                gp_value = $2;
+    rr = await aiopg.execute_named(UPSERT_GP, key, value)
+    gp_cache.set(key, [{"gp_value": value}])
+    return rr
+
+
+async def upsert_gp_many(items):
     """
-    return await aiopg.execute(UPSERT_GLOBAL_PARAMETERS, key, value)
+    批量写入全局参数, items 为 {key: value} 或 [(key, value), ...]
+    """
+    if isinstance(items, dict):
+        items = items.items()
+    items = list(items)
+
+    rr = await aiopg.executemany_named(UPSERT_GP, items)
+    for key, value in items:
+        gp_cache.set(key, [{"gp_value": value}])
+    return rr
 
 
 async def gp_is_exists(key):
-    SELECT_GLOBAL_PARAMTERS = """
-        SELECT
-          gp_id
-        FROM
-          layer4_1_om.globalparameters
-        WHERE
-          gp_name = $1
-        LIMIT
-          1;
-    """
-    return bool(await aiopg.fetch(SELECT_GLOBAL_PARAMTERS, key))
+    return bool(await get_gp(key))
 
 
-async def delete_gp(key):
-    DELETE_GLOBAL_PARAMTERS = """
+DELETE_GP = aiopg.register("delete_gp", """
     DELETE FROM layer4_1_om.globalparameters
     WHERE
       gp_name = $1;
+""")
+
+
+async def delete_gp(key):
+    rr = await aiopg.execute_named(DELETE_GP, key)
+    gp_cache.set(key, [])
+    return rr
+
+
+GET_GP_VALUE = aiopg.register("get_gp_value", """
+    SELECT
+      gp_id,
+      gp_value
+    FROM
+      layer4_1_om.globalparameters
+    WHERE
+      gp_name = $1
+    LIMIT
+      1;
+""")
+
+
+async def get_gp(key):
+    """
+    查询全局参数, 优先读取进程内缓存
+    upsert_gp / delete_gp 会同步更新缓存, 其它进程的修改在 TTL 过期或收到 NOTIFY 后生效
     """
+    async def load():
+        return [dict(row) for row in await aiopg.fetch_named(GET_GP_VALUE, key)]
 
-    return await aiopg.execute(DELETE_GLOBAL_PARAMTERS, key)
+    return await gp_cache.get_or_load(key, load)
 
 
 async def get_gp_value(key):
-    SELECT_GLOBAL_PARAMTERS_VALUE = """
-        SELECT
-          gp_value
-        FROM
-          layer4_1_om.globalparameters
-        WHERE
-          gp_name = $1
-        LIMIT
-          1;
-    """
-    rr = await aiopg.fetch(SELECT_GLOBAL_PARAMTERS_VALUE, key)
+    rr = await get_gp(key)
     return rr[0].get("gp_value")
 
 
+def on_gp_changed(payload):
+    """
+    全局参数变化的 NOTIFY 回调, payload 为 gp_name
+    """
+    gp_cache.invalidate(payload)
+
+
+def on_gp_listener_reconnect():
+    """
+    断线期间可能错过了 NOTIFY, 重连后清空全部缓存
+    """
+    gp_cache.invalidate()
+
+
+def get_gp_cache_stats():
+    return gp_cache.get_stats()
+
+
+async def install_gp_notify_trigger(channel):
+    """
+    安装全局参数变化的 NOTIFY 触发器, payload 为 gp_name, 可重复执行
+    """
+    channel = channel.replace("'", "''")
+
+    INSTALL_TRIGGER = """
+        CREATE OR REPLACE FUNCTION layer4_1_om.notify_gp_changed() RETURNS trigger AS $$
+        BEGIN
+          IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify(TG_ARGV[0], OLD.gp_name);
+            RETURN OLD;
+          END IF;
+          PERFORM pg_notify(TG_ARGV[0], NEW.gp_name);
+          IF TG_OP = 'UPDATE' AND OLD.gp_name IS DISTINCT FROM NEW.gp_name THEN
+            PERFORM pg_notify(TG_ARGV[0], OLD.gp_name);
+          END IF;
+          RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS globalparameters_notify ON layer4_1_om.globalparameters;
+        CREATE TRIGGER globalparameters_notify
+          AFTER INSERT OR UPDATE OR DELETE ON layer4_1_om.globalparameters
+          FOR EACH ROW EXECUTE FUNCTION layer4_1_om.notify_gp_changed('{channel}');
+    """.format(channel=channel)
+
+    return await aiopg.execute(INSTALL_TRIGGER)
+
+
+AGV_HAS_REST_TASK = aiopg.register("agv_has_rest_task", """
+    SELECT
+      agv_management_status_id
+    FROM
+      layer1_agv.agv_state
+    WHERE
+      agv_id = $1
+    LIMIT
+      1;
+""")
+
+
 async def agv_has_rest_task(agv_id):
     agv_id = int(agv_id)
-    SELECT_AGV_STATE = """
-        SELECT
-          agv_management_status_id
-        FROM
-          layer1_agv.agv_state
-        WHERE
-          agv_id = $1
-        LIMIT
-      1;
-    """
-    rr = await aiopg.fetch(SELECT_AGV_STATE, agv_id)
+    rr = await aiopg.fetch_named(AGV_HAS_REST_TASK, agv_id)
     return rr[0].get("agv_management_status_id") == 7
 
 
+AGV_HAS_CHARGING_TASK = aiopg.register("agv_has_charging_task", """
+    SELECT
+      is_charging
+    FROM
+      layer1_agv.agv_state
+    WHERE
+      agv_id = $1
+    LIMIT
+      1;
+""")
+
+
 async def agv_has_charging_task(agv_id):
     agv_id = int(agv_id)
-    SELECT_AGV_STATE = """
-        SELECT
-          is_charging
-        FROM
-          layer1_agv.agv_state
-        WHERE
-          agv_id = $1
-        LIMIT
-      1;
-    """
-    rr = await aiopg.fetch(SELECT_AGV_STATE, agv_id)
+    rr = await aiopg.fetch_named(AGV_HAS_CHARGING_TASK, agv_id)
     return rr[0].get("is_charging")
 
 
+GET_ALL_AGV_STATE = aiopg.register("get_all_agv_state", """
+    SELECT
+      layer2_pallet.agv_dispatch_state.agv_id,
+      can_be_connected,
+      network_connected,
+      dispatch_task_active,
+      fault_happened
+    FROM
+      layer1_agv.agv_state
+      INNER JOIN layer2_pallet.agv_dispatch_state ON layer1_agv.agv_state.agv_id = layer2_pallet.agv_dispatch_state.agv_id;
+""")
+
+
 async def get_all_agv_state():
     """
     network_connected: 在线状态
@@ -104,38 +220,147 @@ async def get_all_agv_state():
     dispatch_task_active: 有调度任务（包含充电任务）
     fault_happened: 有报错
     """
-    SELECT_AGV_STATE = """
-        SELECT
-          layer2_pallet.agv_dispatch_state.agv_id,
-          can_be_connected,
-          network_connected,
-          dispatch_task_active,
-          fault_happened
-        FROM
-          layer1_agv.agv_state
-          INNER JOIN layer2_pallet.agv_dispatch_state ON layer1_agv.agv_state.agv_id = layer2_pallet.agv_dispatch_state.agv_id;
+    return await aiopg.fetch_named(GET_ALL_AGV_STATE)
+
+
+GET_AGV_STATE = aiopg.register("get_agv_state", """
+    SELECT
+      layer2_pallet.agv_dispatch_state.agv_id,
+      can_be_connected,
+      network_connected,
+      dispatch_task_active,
+      fault_happened
+    FROM
+      layer1_agv.agv_state
+      INNER JOIN layer2_pallet.agv_dispatch_state ON layer1_agv.agv_state.agv_id = layer2_pallet.agv_dispatch_state.agv_id
+    WHERE
+      layer1_agv.agv_state.agv_id = $1;
+""")
+
+
+async def get_agv_state(agv_id):
+    """
+    同 get_all_agv_state, 只查询单个 agv
+    """
+    agv_id = int(agv_id)
+
+    return await aiopg.fetchrow_named(GET_AGV_STATE, agv_id)
+
+
+async def install_agv_state_notify_triggers(channel):
+    """
+    安装 agv 状态变化的 NOTIFY 触发器, payload 为 agv_id
+    只在 get_all_agv_state 关心的字段发生变化时通知, 可重复执行
     """
-    return await aiopg.fetch(SELECT_AGV_STATE)
+    channel = channel.replace("'", "''")
+
+    INSTALL_TRIGGERS = """
+        CREATE OR REPLACE FUNCTION layer1_agv.notify_agv_state_changed() RETURNS trigger AS $$
+        BEGIN
+          PERFORM pg_notify(TG_ARGV[0], NEW.agv_id::text);
+          RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS agv_state_insert_notify ON layer1_agv.agv_state;
+        CREATE TRIGGER agv_state_insert_notify
+          AFTER INSERT ON layer1_agv.agv_state
+          FOR EACH ROW EXECUTE FUNCTION layer1_agv.notify_agv_state_changed('{channel}');
+
+        DROP TRIGGER IF EXISTS agv_state_update_notify ON layer1_agv.agv_state;
+        CREATE TRIGGER agv_state_update_notify
+          AFTER UPDATE OF can_be_connected, network_connected, fault_happened ON layer1_agv.agv_state
+          FOR EACH ROW
+          WHEN (
+            OLD.can_be_connected IS DISTINCT FROM NEW.can_be_connected
+            OR OLD.network_connected IS DISTINCT FROM NEW.network_connected
+            OR OLD.fault_happened IS DISTINCT FROM NEW.fault_happened
+          )
+          EXECUTE FUNCTION layer1_agv.notify_agv_state_changed('{channel}');
+
+        DROP TRIGGER IF EXISTS agv_dispatch_state_insert_notify ON layer2_pallet.agv_dispatch_state;
+        CREATE TRIGGER agv_dispatch_state_insert_notify
+          AFTER INSERT ON layer2_pallet.agv_dispatch_state
+          FOR EACH ROW EXECUTE FUNCTION layer1_agv.notify_agv_state_changed('{channel}');
+
+        DROP TRIGGER IF EXISTS agv_dispatch_state_update_notify ON layer2_pallet.agv_dispatch_state;
+        CREATE TRIGGER agv_dispatch_state_update_notify
+          AFTER UPDATE OF dispatch_task_active ON layer2_pallet.agv_dispatch_state
+          FOR EACH ROW
+          WHEN (OLD.dispatch_task_active IS DISTINCT FROM NEW.dispatch_task_active)
+          EXECUTE FUNCTION layer1_agv.notify_agv_state_changed('{channel}');
+
+        -- 订单状态变化会影响 agv 的「运行中」模式（agv_has_active_order）
+        CREATE OR REPLACE FUNCTION layer4_1_om.notify_order_agv_changed() RETURNS trigger AS $$
+        DECLARE
+          changed_agv_id bigint;
+        BEGIN
+          FOREACH changed_agv_id IN ARRAY COALESCE(NEW.agv_list, '{{}}') LOOP
+            PERFORM pg_notify(TG_ARGV[0], changed_agv_id::text);
+          END LOOP;
+          IF TG_OP = 'UPDATE' THEN
+            FOREACH changed_agv_id IN ARRAY COALESCE(OLD.agv_list, '{{}}') LOOP
+              PERFORM pg_notify(TG_ARGV[0], changed_agv_id::text);
+            END LOOP;
+          END IF;
+          RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS order_agv_notify ON layer4_1_om.order;
+        CREATE TRIGGER order_agv_notify
+          AFTER INSERT OR UPDATE OF status, agv_list ON layer4_1_om.order
+          FOR EACH ROW EXECUTE FUNCTION layer4_1_om.notify_order_agv_changed('{channel}');
+    """.format(channel=channel)
+
+    return await aiopg.execute(INSTALL_TRIGGERS)
+
+
+AGV_HAS_ACTIVE_ORDER = aiopg.register("agv_has_active_order", """
+    SELECT
+      order_id
+    FROM
+      layer4_1_om.order
+    WHERE
+      $1 = ANY (agv_list)
+      AND status NOT IN (
+        'finish',
+        'error',
+        'cancel_finish',
+        'waiting_cancel',
+        'waiting_manually_finish',
+        'manually_finish',
+        'error_hidden'
+      )
+""")
+
 
 async def agv_has_active_order(agv_id):
     agv_id = int(agv_id)
 
-    SELECT_AGV_ORDER = """
-        SELECT
-          order_id
-        FROM
-          layer4_1_om.order
-        WHERE
-          $1 = ANY (agv_list)
-          AND status NOT IN (
-            'finish',
-            'error',
-            'cancel_finish',
-            'waiting_cancel',
-            'waiting_manually_finish',
-            'manually_finish',
-            'error_hidden'
-          )
-    """
+    return await aiopg.fetch_named(AGV_HAS_ACTIVE_ORDER, agv_id)
 
-    return await aiopg.fetch(SELECT_AGV_ORDER, agv_id)
+
+GET_AGV_ID_WITH_ACTIVE_ORDER = aiopg.register("get_agv_id_with_active_order", """
+    SELECT DISTINCT
+      unnest(agv_list) AS agv_id
+    FROM
+      layer4_1_om.order
+    WHERE
+      status NOT IN (
+        'finish',
+        'error',
+        'cancel_finish',
+        'waiting_cancel',
+        'waiting_manually_finish',
+        'manually_finish',
+        'error_hidden'
+      )
+""")
+
+
+async def get_agv_id_set_with_active_order():
+    """
+    同 agv_has_active_order, 一次查询出所有有存活订单的 agv
+    """
+    return {row["agv_id"] for row in await aiopg.fetch_named(GET_AGV_ID_WITH_ACTIVE_ORDER)}
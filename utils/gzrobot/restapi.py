@@ -1,8 +1,12 @@
+import asyncio
 import datetime
 import json
 import typing
 
-from utils import aio_requests, log
+from utils import aio_requests, log, conf, metrics
+from utils.aio_cache import aio_cached
+
+CACHE_CONF = conf["REST_CACHE"]
 
 
 async def _common_get(url):
@@ -35,6 +39,34 @@ async def _common_post(url, body):
     return resj
 
 
+async def fan_out(coro_fn, args_list, limit=None, timeout=None):
+    """
+    有界并发地调用 coro_fn(arg), 返回 {arg: result}
+    单个调用失败或超时只记录日志、不影响其他调用, 失败项不会出现在结果中
+    """
+    FANOUT_CONF = conf["REST_FANOUT"]
+    limit = limit or FANOUT_CONF["LIMIT"]
+    timeout = timeout or FANOUT_CONF["TIMEOUT"]
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def call(arg):
+        async with semaphore:
+            return await asyncio.wait_for(coro_fn(arg), timeout)
+
+    args_list = list(args_list)
+    results = await asyncio.gather(*(call(arg) for arg in args_list), return_exceptions=True)
+
+    rr = {}
+    for arg, result in zip(args_list, results):
+        if isinstance(result, BaseException):
+            log.error("{}({}) failed: {!r}".format(coro_fn.__name__, arg, result))
+            continue
+        rr[arg] = result
+
+    return rr
+
+
 async def create_order(order_name, ts_name, parameters):
     url = "/api/om/order/"
 
@@ -65,21 +97,38 @@ async def clear_agv_error(agv_list):
     }
 
     resj = await _common_post(url, req_body)
+
+    # 清错后 agv 的错误信息已经变化
+    invalidate_agv_cache()
+
     return resj
 
 
+@aio_cached(ttl=CACHE_CONF["AGV_INFO_TTL"], maxsize=CACHE_CONF["MAXSIZE"])
 async def get_all_agv_info():
     url = "/api/engine/basic-data/agvs/"
     resj = await _common_get(url)
     return resj["data"] or []
 
 
+@aio_cached(ttl=CACHE_CONF["AGV_ERROR_TTL"], maxsize=CACHE_CONF["MAXSIZE"])
 async def get_agv_error_info(agv_id):
     url = "/api/engine/errors/agvs/{}/".format(agv_id)
     resj = await _common_get(url)
     return resj["data"] or []
 
 
+@aio_cached(ttl=CACHE_CONF["AGV_ERROR_TTL"], maxsize=CACHE_CONF["MAXSIZE"])
+async def get_all_agv_error_info():
+    """
+    一次性获取所有 agv 的错误信息（需要引擎支持, 见 REST_FANOUT.BULK_ERRORS）
+    """
+    url = "/api/engine/errors/agvs/"
+    resj = await _common_get(url)
+    return resj["data"] or []
+
+
+@aio_cached(ttl=CACHE_CONF["LOCATION_TTL"], maxsize=CACHE_CONF["MAXSIZE"])
 async def query_children_location(location_id):
     # 3315
     url = "/api/dispatch/universal/basic-data/locations/child_location_info/?parent_id={}".format(
@@ -90,6 +139,70 @@ async def query_children_location(location_id):
 # ------- extend -------
 
 
+def get_cache_list():
+    return [
+        get_all_agv_info.cache,
+        get_agv_error_info.cache,
+        get_all_agv_error_info.cache,
+        query_children_location.cache,
+    ]
+
+
+def invalidate_agv_cache():
+    """
+    agv 的状态信息被修改后调用、下一次读取将重新请求
+    """
+    get_all_agv_info.cache.invalidate()
+    get_agv_error_info.cache.invalidate()
+    get_all_agv_error_info.cache.invalidate()
+
+
+def get_cache_stats():
+    return {cache.get_name(): cache.get_stats() for cache in get_cache_list()}
+
+
 async def get_all_agv_id():
     data = await get_all_agv_info()
     return list(map(lambda d: d["agv_id"], data))
+
+
+async def get_agv_error_info_many(agv_id_list):
+    """
+    批量获取多个 agv 的错误信息, 返回 {agv_id: [error, ...]}
+    引擎支持批量接口时只发起一次请求, 否则逐个 agv 并发查询
+    查询失败的 agv 不会出现在结果中
+    """
+    agv_id_list = list(agv_id_list)
+
+    if not agv_id_list:
+        return {}
+
+    if conf["REST_FANOUT"]["BULK_ERRORS"]:
+        try:
+            rr = {agv_id: [] for agv_id in agv_id_list}
+            for error_info in await get_all_agv_error_info():
+                if error_info.get("agv_id") in rr:
+                    rr[error_info["agv_id"]].append(error_info)
+            return rr
+        except Exception as e:
+            log.error("bulk agv error query failed, fallback to per agv query: {!r}".format(e))
+
+    return await fan_out(get_agv_error_info, agv_id_list)
+
+
+REST_CACHE_STATS = metrics.gauge("rest_cache", "Counters of the REST response caches", ["cache", "stat"])
+REST_POOL_STATS = metrics.gauge("rest_pool", "Connection pool usage of the REST client", ["stat"])
+
+
+def collect_metrics():
+    for name, stats in get_cache_stats().items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                REST_CACHE_STATS.labels(name, key).set(value)
+
+    for key, value in aio_requests.get_pool_stats().items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            REST_POOL_STATS.labels(key).set(value)
+
+
+metrics.add_collector(collect_metrics)
@@ -0,0 +1,388 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import argparse
+import datetime
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from . import metrics
+
+
+# magic, version, length of the device table
+HEADER = struct.Struct("<4sHH")
+HEADER_SIZE = 4096
+HEADER_MAGIC = b"RJNL"
+HEADER_VERSION = 2
+
+# timestamp, device id, origin, address, old value, new value
+RECORD = struct.Struct("<dHBIii")
+
+# the value was read from the device / written to the device by the adapter
+ORIGIN_READ = 0
+ORIGIN_WRITE = 1
+ORIGIN_NAMES = ("read", "write")
+
+# old value of the first observation of an address
+UNKNOWN_VALUE = -1
+
+# updated by a collector: the errors are counted by the writer thread, metrics are only updated from the loop thread
+JOURNAL_STATS = metrics.gauge("register_journal", "Pending records, dropped records and write errors of the journal",
+                              ["stat"])
+
+
+class JournalRecord(NamedTuple):
+    timestamp: float
+    device: str
+    origin: int
+    address: int
+    old: int
+    new: int
+
+    def __str__(self) -> str:
+        return "{} {} {} D{} {} -> {}".format(
+            datetime.datetime.fromtimestamp(self.timestamp).isoformat(sep=" ", timespec="milliseconds"),
+            self.device, ORIGIN_NAMES[self.origin], self.address, self.old, self.new)
+
+
+def _read_device_table(buffer) -> List[str]:
+    magic, version, length = HEADER.unpack_from(buffer, 0)
+
+    if magic != HEADER_MAGIC or version != HEADER_VERSION:
+        raise ValueError("Not a register journal file (magic={!r}, version={})".format(magic, version))
+
+    return json.loads(bytes(buffer[HEADER.size:HEADER.size + length]))
+
+
+def _pack_header(device_table: List[str]) -> bytes:
+    table = json.dumps(device_table, ensure_ascii=False).encode("utf-8")
+
+    if HEADER.size + len(table) > HEADER_SIZE:
+        raise ValueError("Too many devices for the journal header: {}".format(len(device_table)))
+
+    return (HEADER.pack(HEADER_MAGIC, HEADER_VERSION, len(table)) + table).ljust(HEADER_SIZE, b"\0")
+
+
+def _rotated_paths(path: str, backup_count: int) -> List[str]:
+    """
+    The journal files from the oldest to the newest
+    """
+    paths = ["{}.{}".format(path, index) for index in range(backup_count, 0, -1)] + [path]
+    return [path for path in paths if os.path.exists(path)]
+
+
+class RegisterJournal:
+    """
+    An append-only binary journal of register transitions
+
+    Every record has a fixed size (RECORD), so a file can be memory-mapped and searched by timestamp.
+    Device names are stored once in a fixed size header as a table, records only keep the index.
+    The file is rotated like RotatingFileHandler when it would exceed `max_bytes`.
+
+    append() only queues the record and never raises: the journal is a diagnostic, it must not fail
+    nor block the PLC I/O of the event loop. A writer thread writes the queued records every
+    `flush_interval` seconds, write errors are logged and counted, at most `max_pending` records are queued
+    (the oldest are dropped while the file cannot be written)
+    """
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024, backup_count: int = 10,
+                 flush_interval: float = 1, max_pending: int = 100000) -> None:
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._flush_interval = flush_interval
+
+        self._file = None
+        self._size = 0
+        self._device_table: List[str] = []
+        self._device_ids: Dict[str, int] = {}
+
+        # timestamp, device, origin, address, old, new
+        self._pending: Deque[Tuple[float, str, int, int, int, int]] = deque()
+        self._max_pending = max_pending
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._stats: Dict[str, int] = {"dropped": 0, "errors": 0}
+        # the writes are failing, only the first error and the recovery are logged
+        self._failing = False
+
+        metrics.add_collector(self.collect_metrics)
+
+    def __repr__(self) -> str:
+        return "<{} {}>".format(__class__.__name__, self._path)
+
+    def get_path(self) -> str:
+        return self._path
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        return stats
+
+    def collect_metrics(self) -> None:
+        for key, value in self.get_stats().items():
+            JOURNAL_STATS.labels(key).set(value)
+
+    def _open(self) -> None:
+        dirname = os.path.dirname(self._path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        if os.path.exists(self._path) and os.path.getsize(self._path) >= HEADER_SIZE:
+            with open(self._path, mode="rb") as f:
+                try:
+                    device_table = _read_device_table(f.read(HEADER_SIZE))
+                except ValueError:
+                    device_table = None
+
+            if device_table is None:
+                # a journal of another version, kept as a rotated file
+                self._rotate_files()
+                self._open()
+                return
+
+            for name in device_table:
+                if name not in self._device_ids:
+                    self._device_ids[name] = len(self._device_table)
+                    self._device_table.append(name)
+
+            self._file = open(self._path, mode="r+b")
+            # drop a record that was only partially written before a crash
+            size = os.path.getsize(self._path)
+            self._size = size - (size - HEADER_SIZE) % RECORD.size
+            self._file.truncate(self._size)
+            self._write_header()
+            self._file.seek(self._size)
+        else:
+            self._file = open(self._path, mode="w+b")
+            self._file.write(_pack_header(self._device_table))
+            self._size = HEADER_SIZE
+
+    def _write_header(self) -> None:
+        assert self._file is not None
+        self._file.flush()
+        os.pwrite(self._file.fileno(), _pack_header(self._device_table), 0)
+
+    def _rotate_files(self) -> None:
+        for index in range(self._backup_count - 1, 0, -1):
+            src = "{}.{}".format(self._path, index)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self._path, index + 1))
+
+        if self._backup_count > 0:
+            os.replace(self._path, "{}.1".format(self._path))
+        else:
+            os.remove(self._path)
+
+    def _rotate(self) -> None:
+        self._close_file()
+        self._rotate_files()
+        self._open()
+
+    def get_device_id(self, device: str) -> int:
+        device_id = self._device_ids.get(device)
+
+        if device_id is None:
+            device_id = self._device_ids[device] = len(self._device_table)
+            self._device_table.append(device)
+
+            if self._file is not None:
+                self._write_header()
+
+        return device_id
+
+    def append(self, device: str, address: int, old: int, new: int, origin: int = ORIGIN_READ,
+               timestamp: Optional[float] = None) -> None:
+        """
+        Queue a record for the writer thread
+        """
+        if len(self._pending) >= self._max_pending:
+            self._pending.popleft()
+            self._stats["dropped"] += 1
+
+        self._pending.append((time.time() if timestamp is None else timestamp, device, origin, address, old, new))
+
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name="register-journal", daemon=True)
+            self._writer.start()
+
+    def _write(self, timestamp: float, device: str, origin: int, address: int, old: int, new: int) -> None:
+        if self._file is None:
+            self._open()
+        elif self._size + RECORD.size > self._max_bytes:
+            self._rotate()
+
+        assert self._file is not None
+
+        self._file.write(RECORD.pack(timestamp, self.get_device_id(device), origin, address, old, new))
+        self._size += RECORD.size
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._flush_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the queued records, errors are logged and counted but never raised
+        """
+        with self._writer_lock:
+            try:
+                while self._pending:
+                    record = self._pending.popleft()
+                    try:
+                        self._write(*record)
+                    except Exception:
+                        # kept for the next write
+                        self._pending.appendleft(record)
+                        raise
+
+                if self._file is not None:
+                    self._file.flush()
+            except Exception as e:
+                self._stats["errors"] += 1
+
+                if not self._failing:
+                    from . import log
+                    log.error("{!r} write failed, {} records pending: {!r}".format(self, len(self._pending), e))
+                    self._failing = True
+
+                # reopened on the next write
+                try:
+                    self._close_file()
+                except Exception:
+                    self._file = None
+            else:
+                if self._failing:
+                    from . import log
+                    log.info("{!r} write recovered".format(self))
+                    self._failing = False
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self) -> None:
+        """
+        Stop the writer thread, write the queued records and close the file
+        """
+        self._stopped.set()
+
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+        self.flush()
+        self._close_file()
+        self._stopped.clear()
+
+
+class JournalReader:
+    """
+    Read the register journal and its rotated files through mmap
+    Timestamps are searched with a binary search in each file
+    """
+
+    def __init__(self, path: str, backup_count: int = 10) -> None:
+        self._paths = _rotated_paths(path, backup_count)
+
+    def get_paths(self) -> List[str]:
+        return self._paths
+
+    @staticmethod
+    def _bisect(buffer, count: int, timestamp: float) -> int:
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if RECORD.unpack_from(buffer, HEADER_SIZE + mid * RECORD.size)[0] < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _iter_file(self, path: str, start: Optional[float], end: Optional[float],
+                   device: Optional[str], address: Optional[int]) -> Iterator[JournalRecord]:
+        with open(path, mode="rb") as f:
+            if os.fstat(f.fileno()).st_size <= HEADER_SIZE:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                try:
+                    device_table = _read_device_table(buffer)
+                except ValueError as e:
+                    # e.g. a journal of a previous version, rotated aside by RegisterJournal
+                    sys.stderr.write("skip {}: {}\n".format(path, e))
+                    return
+                count = (len(buffer) - HEADER_SIZE) // RECORD.size
+
+                if count == 0:
+                    return
+
+                if end is not None and RECORD.unpack_from(buffer, HEADER_SIZE)[0] > end:
+                    return
+
+                index = 0 if start is None else self._bisect(buffer, count, start)
+
+                for offset in range(HEADER_SIZE + index * RECORD.size, HEADER_SIZE + count * RECORD.size, RECORD.size):
+                    timestamp, device_id, origin, record_address, old, new = RECORD.unpack_from(buffer, offset)
+
+                    if end is not None and timestamp > end:
+                        return
+
+                    record_device = device_table[device_id]
+
+                    if device is not None and record_device != device:
+                        continue
+
+                    if address is not None and record_address != address:
+                        continue
+
+                    yield JournalRecord(timestamp, record_device, origin, record_address, old, new)
+
+    def query(self, start: Optional[float] = None, end: Optional[float] = None,
+              device: Optional[str] = None, address: Optional[int] = None) -> Iterator[JournalRecord]:
+        """
+        Records in [start, end] from the oldest to the newest, optionally filtered by device and address
+        """
+        for path in self._paths:
+            yield from self._iter_file(path, start, end, device, address)
+
+
+def parse_time(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Query the PLC register transition journal")
+    parser.add_argument("path", help="journal file, rotated files are read as well")
+    parser.add_argument("--start", type=parse_time, help="epoch seconds or ISO time, e.g. '2023-07-12 16:20:41'")
+    parser.add_argument("--end", type=parse_time, help="epoch seconds or ISO time")
+    parser.add_argument("--device", help="device name")
+    parser.add_argument("--address", type=int, help="D register address")
+    parser.add_argument("--backup-count", type=int, default=10)
+    parser.add_argument("--csv", action="store_true", help="output csv instead of text")
+    args = parser.parse_args(argv)
+
+    reader = JournalReader(args.path, args.backup_count)
+
+    if args.csv:
+        sys.stdout.write("timestamp,device,origin,address,old,new\n")
+
+    for record in reader.query(args.start, args.end, args.device, args.address):
+        if args.csv:
+            sys.stdout.write("{},{},{},{},{},{}\n".format(
+                record.timestamp, record.device, ORIGIN_NAMES[record.origin], record.address, record.old, record.new))
+        else:
+            sys.stdout.write("{}\n".format(record))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,173 @@
 import os
 import json
-from logging import Logger
-from logging import getLogger
+import queue
+import atexit
+import threading
+from collections import OrderedDict
+from logging import Filter, Logger, LogRecord
+from logging import getLevelName, getLogger, makeLogRecord
 from logging.config import dictConfig
-from typing import ClassVar, Dict, Any, Optional
+from logging.handlers import QueueHandler, QueueListener
+from typing import ClassVar, Dict, Any, Hashable, List, Optional, Union
 
 
 from .auxiliary import FoxType
 
 
+class BoundedQueueHandler(QueueHandler):
+    """
+    A QueueHandler that never blocks the calling thread
+
+    Records are put on a bounded queue without being formatted, formatting and I/O
+    happen on the QueueListener thread. When the queue is full the record is dropped
+    according to `drop_policy` ("new" drops the incoming record, "old" the oldest queued one)
+    and counted in `dropped`
+    """
+
+    def __init__(self, queue: queue.Queue, drop_policy: str = "new") -> None:
+        assert drop_policy in ("new", "old"), "Unknown drop policy: {}".format(drop_policy)
+
+        super().__init__(queue)
+        self.drop_policy = drop_policy
+        self.dropped = 0
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # the listener lives in the same process, the record can be passed as is
+        return record
+
+    def enqueue(self, record: LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+
+        if self.drop_policy == "old":
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(record)
+            except (queue.Empty, queue.Full):
+                pass
+
+        self.dropped += 1
+
+
+class DrainingQueueListener(QueueListener):
+    """
+    A QueueListener whose stop() works on a full bounded queue
+
+    QueueListener.stop() enqueues its sentinel with put_nowait(), which raises queue.Full when the queue
+    is full at exit: the thread is never stopped and the queued records are lost. The sentinel is put
+    with a blocking put, the listener thread keeps draining the queue meanwhile. If the queue is still
+    full after `timeout` seconds (a handler is stuck), the oldest records are dropped to make room
+    """
+
+    def __init__(self, queue: queue.Queue, *handlers, respect_handler_level: bool = False,
+                 timeout: float = 5) -> None:
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        self.timeout = timeout
+
+    def enqueue_sentinel(self) -> None:
+        try:
+            self.queue.put(self._sentinel, timeout=self.timeout)
+            return
+        except queue.Full:
+            pass
+
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except queue.Empty:
+                pass
+
+            try:
+                self.queue.put_nowait(self._sentinel)
+                return
+            except queue.Full:
+                continue
+
+
+class RepeatFilter(Filter):
+    """
+    Suppress repeats of the same message within `window` seconds
+
+    Records are grouped into streams: by default every distinct (msg, args) is its own stream,
+    records logged with extra={"subject": ...} share the stream of that subject.
+    In a stream, the first record passes and identical records within the window are counted and dropped.
+    The first identical record after the window passes with the number of suppressed repeats appended.
+    A different record in the same stream (a state transition) always passes,
+    preceded by a "repeated N times" summary of the previous message if it was suppressed.
+
+    Records above `max_level` are never filtered
+    """
+
+    def __init__(self, window: float = 60, max_level: Union[int, str] = "WARNING", maxsize: int = 4096) -> None:
+        super().__init__()
+        self.window = window
+        self.max_level = max_level if isinstance(max_level, int) else getLevelName(max_level)
+        self.maxsize = maxsize
+        # stream -> [key, window start, suppressed count, last suppressed record]
+        self._streams: OrderedDict[Hashable, list] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(record: LogRecord) -> Hashable:
+        key = (record.msg, record.args)
+        try:
+            hash(key)
+        except TypeError:
+            key = (str(record.msg), repr(record.args))
+        return key
+
+    def _make_summary(self, record: LogRecord, count: int) -> LogRecord:
+        summary = makeLogRecord(record.__dict__)
+        summary.msg = "{} (repeated {} times)".format(record.getMessage(), count)
+        summary.args = ()
+        summary.exc_info = None
+        summary.exc_text = None
+        summary.repeat_summary = True
+        return summary
+
+    def filter(self, record: LogRecord) -> bool:
+        if record.levelno > self.max_level or getattr(record, "repeat_summary", False):
+            return True
+
+        key = self._get_key(record)
+        stream = (record.name, getattr(record, "subject", None) or key)
+        summary = None
+
+        with self._lock:
+            state = self._streams.get(stream)
+
+            if state is not None and state[0] == key:
+                if record.created - state[1] < self.window:
+                    state[2] += 1
+                    state[3] = record
+                    return False
+
+                if state[2]:
+                    record.msg = "{} (repeated {} times in the last {:.0f}s)".format(
+                        record.msg, state[2], record.created - state[1])
+
+                state[1:] = [record.created, 0, None]
+                self._streams.move_to_end(stream)
+            else:
+                if state is not None and state[2]:
+                    summary = self._make_summary(state[3], state[2])
+
+                self._streams[stream] = [key, record.created, 0, None]
+                self._streams.move_to_end(stream)
+
+                while len(self._streams) > self.maxsize:
+                    self._streams.popitem(last=False)
+
+        if summary is not None:
+            getLogger(summary.name).handle(summary)
+
+        return True
+
+
 class Logrus(metaclass=FoxType):
 
     _SINGLETON: ClassVar[bool] = True
@@ -18,9 +177,12 @@ class Logrus(metaclass=FoxType):
         self._logger_name = logger_name
         self._conf_dict: Dict[str, Any] = {}
         self._logger: Optional[Logger] = None
+        self._queue_handlers: List[BoundedQueueHandler] = []
+        self._queue_listeners: List[QueueListener] = []
 
     def __auto_run__(self) -> None:
         self._parse_conf()
+        self._setup_queue()
         self._logger = getLogger(self.get_logger_name())
 
     def get_logger(self) -> Logger:
@@ -53,4 +215,56 @@ class Logrus(metaclass=FoxType):
                 if not os.path.exists(dirname_full_path):
                     os.makedirs(dirname_full_path, exist_ok=True)
 
-        dictConfig(self.get_conf_dict())
+        # keys that are not part of the dictConfig schema
+        dictConfig({k: v for k, v in self.get_conf_dict().items() if k not in ("queue", )})
+
+    def get_dropped(self) -> int:
+        """
+        Number of records dropped because the log queue was full
+        """
+        return sum(handler.dropped for handler in self._queue_handlers)
+
+    def _setup_queue(self) -> None:
+        """
+        In queue mode, the handlers of every configured logger are moved to a QueueListener thread
+        and replaced by a single BoundedQueueHandler, the calling thread only enqueues records
+        """
+        self.stop()
+        self._queue_handlers.clear()
+
+        queue_conf: Dict[str, Any] = self.get_conf_dict().get("queue", {})
+
+        if not queue_conf.get("enable", False):
+            return
+
+        for logger_name in self.get_conf_dict().get("loggers", {}):
+            logger = getLogger(logger_name or None)
+            handlers = list(logger.handlers)
+
+            if not handlers:
+                continue
+
+            queue_handler = BoundedQueueHandler(
+                queue.Queue(maxsize=queue_conf.get("maxsize", 10000)),
+                drop_policy=queue_conf.get("drop_policy", "new"),
+            )
+            listener = DrainingQueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+            for handler in handlers:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+
+            listener.start()
+            self._queue_handlers.append(queue_handler)
+            self._queue_listeners.append(listener)
+
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """
+        Flush the queued records and stop the listener threads
+        """
+        for listener in self._queue_listeners:
+            listener.stop()
+
+        self._queue_listeners.clear()
@@ -0,0 +1,150 @@
+"""
+Health of the event loop shared by the service, the adapter loops and the heartbeat loops
+
+    monitor = LoopMonitor(interval=0.5, threshold=0.2)
+    monitor.start()       # from the event loop
+    ...
+    await monitor.close()
+
+- a beat task sleeps `interval` seconds in a loop, how late every wakeup is (the scheduling lag)
+  goes to the event_loop_lag_seconds histogram and to a window of recent samples,
+  the p50 / p90 / p99 / max of the window are published as event_loop_lag_quantile_seconds
+- a watchdog thread checks the last beat every threshold / 4 seconds, when the loop has not beaten for
+  `threshold` seconds the stack of the event loop thread, i.e. of the callback blocking it, is logged
+  while the loop is still blocked. A stall that never ends is logged too
+"""
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from . import metrics
+
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+EVENT_LOOP_LAG = metrics.histogram(
+    "event_loop_lag_seconds", "How late the event loop woke up a periodic sleep",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+EVENT_LOOP_LAG_QUANTILE = metrics.gauge(
+    "event_loop_lag_quantile_seconds", "Quantiles of the event loop lag over the recent window", ["quantile"],
+)
+EVENT_LOOP_STALLS = metrics.counter(
+    "event_loop_stalls_total", "Callbacks that blocked the event loop longer than the stall threshold",
+)
+
+
+def get_quantile(ordered: Any, q: float) -> float:
+    """
+    Nearest rank quantile of an ordered sequence
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.5, threshold: float = 0.2, window: int = 1200,
+                 stack_limit: int = 30) -> None:
+        """
+        interval: seconds between two beats
+        threshold: seconds without a beat before the blocking stack is captured
+        window: number of recent lag samples the quantiles are computed on
+        stack_limit: innermost frames of the captured stacks
+        """
+        self._interval = interval
+        self._threshold = threshold
+        self._stack_limit = stack_limit
+        self._samples: Deque[float] = deque(maxlen=window)
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._beat_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+        # time.monotonic() of the last beat, written by the loop thread, read by the watchdog thread
+        self._last_beat = 0.0
+        # the beat a stall was already reported for, one report per stall
+        self._reported_beat = 0.0
+
+        metrics.add_collector(self.collect_metrics)
+
+    def start(self) -> None:
+        """
+        Start the beat task and the watchdog thread, must be called from the event loop thread
+        """
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stopped.clear()
+
+        self._beat_task = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    async def close(self) -> None:
+        self._stopped.set()
+
+        if self._beat_task is not None:
+            self._beat_task.cancel()
+            await asyncio.gather(self._beat_task, return_exceptions=True)
+            self._beat_task = None
+
+        if self._watchdog is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._watchdog.join)
+            self._watchdog = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        ordered = sorted(self._samples)
+        rr: Dict[str, Any] = {"p{}".format(round(q * 100)): get_quantile(ordered, q) for q in QUANTILES}
+        rr["max"] = ordered[-1] if ordered else 0.0
+        rr["samples"] = len(ordered)
+        rr["stalls"] = EVENT_LOOP_STALLS.labels().value
+        return rr
+
+    def collect_metrics(self) -> None:
+        ordered = sorted(self._samples)
+
+        for q in QUANTILES:
+            EVENT_LOOP_LAG_QUANTILE.labels(q).set(get_quantile(ordered, q))
+        EVENT_LOOP_LAG_QUANTILE.labels(1).set(ordered[-1] if ordered else 0.0)
+
+    async def _beat(self) -> None:
+        loop = asyncio.get_running_loop()
+        child = EVENT_LOOP_LAG.labels()
+
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(self._interval)
+            lag = max(0.0, loop.time() - started_at - self._interval)
+
+            self._last_beat = time.monotonic()
+            child.observe(lag)
+            self._samples.append(lag)
+
+    def _watch(self) -> None:
+        from . import log
+
+        check_interval = max(self._threshold / 4, 0.01)
+
+        while not self._stopped.wait(check_interval):
+            last_beat = self._last_beat
+            # the loop is expected to beat every interval, the stall starts after the expected beat
+            blocked = time.monotonic() - last_beat - self._interval
+
+            if blocked < self._threshold or last_beat == self._reported_beat:
+                continue
+
+            self._reported_beat = last_beat
+            # metrics are only updated from the loop thread, the increment runs once the loop is unblocked
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(EVENT_LOOP_STALLS.inc)
+
+            frame = sys._current_frames().get(self._loop_thread_id)  # type: ignore
+            stack = "".join(traceback.format_stack(frame, limit=-self._stack_limit)) if frame else "<unknown>\n"
+            log.warning("event loop blocked for {:.3f}s, stack of the loop thread:\n{}".format(blocked, stack))
@@ -0,0 +1,274 @@
+"""
+Counters, gauges and histograms rendered in the Prometheus text exposition format (version 0.0.4)
+
+    FRAMES = metrics.counter("mc_frames_sent_total", "MC frames sent", ["plc", "command"])
+    FRAMES.labels("10.0.0.1:1101", "0401").inc()
+
+    LATENCY = metrics.histogram("mc_round_trip_seconds", "MC round trip", ["plc", "command"])
+    with LATENCY.labels("10.0.0.1:1101", "0401").time():
+        ...
+
+    metrics.render()  # the body of GET /metrics
+
+Updating a metric is a dict lookup and an addition (labels() children can be kept to skip the lookup),
+there is no lock: the metrics are updated and rendered from the event loop thread only
+"""
+import time
+import bisect
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+# seconds, from a fast PLC frame to a slow REST call
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_NAME_RE = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Timer:
+    def __init__(self, child: "HistogramChild") -> None:
+        self._child = child
+        self._started_at = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._child.observe(time.perf_counter() - self._started_at)
+
+
+class CounterChild:
+    __slots__ = ("value", )
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class GaugeChild:
+    __slots__ = ("value", )
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        # counts[i] is the number of values in (buckets[i - 1], buckets[i]], the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class Metric:
+    TYPE = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        assert _NAME_RE.match(name), "Invalid metric name: {}".format(name)
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def _new_child(self) -> Any:
+        raise NotImplementedError
+
+    def labels(self, *values: Any) -> Any:
+        """
+        The child of the label values, created on first use
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+
+        if child is None:
+            assert len(key) == len(self.labelnames), \
+                "{} expects labels {}, got {}".format(self.name, self.labelnames, key)
+            child = self._children[key] = self._new_child()
+
+        return child
+
+    def clear(self) -> None:
+        self._children.clear()
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n")),
+            "# TYPE {} {}".format(self.name, self.TYPE),
+        ]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> List[str]:
+        return [
+            "{}{} {}".format(self.name, _format_labels(self.labelnames, key), _format_value(child.value))
+            for key, child in self._children.items()
+        ]
+
+
+class Gauge(Counter):
+    TYPE = "gauge"
+
+    def _new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets if bucket != float("inf")))
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def samples(self) -> List[str]:
+        rr = []
+
+        for key, child in self._children.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets + (float("inf"), ), child.counts):
+                cumulative += count
+                rr.append("{}_bucket{} {}".format(
+                    self.name, _format_labels(self.labelnames, key, 'le="{}"'.format(_format_value(bucket))), cumulative))
+
+            labels = _format_labels(self.labelnames, key)
+            rr.append("{}_sum{} {}".format(self.name, labels, _format_value(child.sum)))
+            rr.append("{}_count{} {}".format(self.name, labels, child.count))
+
+        return rr
+
+
+class MetricsRegistry:
+    """
+    The metrics of the process, collectors are called before every render() to refresh
+    the metrics that mirror counters kept elsewhere (connection pools, caches ...)
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Register a metric, registering the same name twice returns the first metric
+        (modules may be imported again, e.g. by the benchmarks)
+        """
+        existing = self._metrics.get(metric.name)
+
+        if existing is not None:
+            assert type(existing) is type(metric) and existing.labelnames == metric.labelnames, \
+                "Metric {} is already registered with another type or labels".format(metric.name)
+            return existing
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        self._collectors.append(collector)
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        from . import log
+
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                log.error("metrics collector {} failed: {!r}".format(collector, e))
+
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def counter(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))  # type: ignore
+
+
+def gauge(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))  # type: ignore
+
+
+def histogram(name: str, documentation: str, labelnames: Iterable[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))  # type: ignore
+
+
+def add_collector(collector: Callable[[], None]) -> None:
+    REGISTRY.add_collector(collector)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
@@ -0,0 +1,285 @@
+"""
+Opt-in profiler attributing wall time, MC frames, database queries and REST calls to the adapter jobs
+and to the device accessors they call
+
+    profiler.start(duration=60, sample_rate=0.1)
+
+    with profiler.job("report_agv_state"):           # an iteration of an adapter job
+        ...
+
+    @profile_methods                                # every public coroutine method of the class
+    class Device(BaseDevice): ...
+
+    profiler.add("mc", elapsed)                      # from the MC client, the database and the REST client
+
+    profiler.get_report()                            # ranked by wall time
+    profiler.get_collapsed("mc_seconds")             # collapsed stacks, for flamegraph.pl / speedscope
+
+The current stack (job, accessor, nested accessor ...) lives in a context variable, so concurrent
+coroutines and the tasks they spawn are attributed to their own job. While the profiler is stopped,
+or for an iteration left out by the sampling, the stack is None and every hook is a context variable lookup
+"""
+import os
+import time
+import random
+import inspect
+import functools
+import contextlib
+import contextvars
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+# the resources counted by add(), each is reported as <kind>_calls and <kind>_seconds
+KINDS = ("mc", "db", "rest")
+
+# calls, wall time, then calls and seconds of every kind
+_CALLS = 0
+_WALL = 1
+_KIND_INDEX = {kind: 2 + index * 2 for index, kind in enumerate(KINDS)}
+_FIELDS = 2 + len(KINDS) * 2
+
+# weights of the collapsed stacks: field index and scale (seconds are written as microseconds)
+WEIGHTS = {"wall_seconds": (_WALL, 1e6)}
+for _kind, _index in _KIND_INDEX.items():
+    WEIGHTS["{}_calls".format(_kind)] = (_index, 1)
+    WEIGHTS["{}_seconds".format(_kind)] = (_index + 1, 1e6)
+
+
+def get_weight(weight: str) -> Tuple[int, float]:
+    """
+    Field index and scale of a collapsed stacks weight, ValueError for an unknown weight
+    """
+    if weight not in WEIGHTS:
+        raise ValueError("Unknown weight {!r}, expect one of {}".format(weight, ", ".join(WEIGHTS)))
+    return WEIGHTS[weight]
+
+Stack = Tuple[str, ...]
+
+_current_stack: contextvars.ContextVar[Optional[Stack]] = contextvars.ContextVar("profiler_stack", default=None)
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self._enabled = False
+        self._sample_rate = 1.0
+        self._started_at = 0.0
+        self._stopped_at = 0.0
+        self._deadline: Optional[float] = None
+        self._sampled = 0
+        self._skipped = 0
+        # self values of every stack: calls and wall time of the innermost frame, resources used by it
+        self._stats: Dict[Stack, List[float]] = {}
+
+    def is_enabled(self) -> bool:
+        if self._enabled and self._deadline is not None and time.monotonic() >= self._deadline:
+            self.stop()
+        return self._enabled
+
+    def start(self, duration: Optional[float] = None, sample_rate: float = 1.0) -> None:
+        """
+        Clear the previous profile and start profiling,
+        for `duration` seconds when given, `sample_rate` of the job iterations are profiled
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be in (0, 1], got {!r}".format(sample_rate))
+
+        self._stats = {}
+        self._sampled = 0
+        self._skipped = 0
+        self._sample_rate = sample_rate
+        self._started_at = time.monotonic()
+        self._stopped_at = 0.0
+        self._deadline = self._started_at + duration if duration else None
+        self._enabled = True
+
+    def stop(self) -> None:
+        if self._enabled:
+            self._enabled = False
+            self._stopped_at = time.monotonic()
+
+    def get_status(self) -> Dict[str, Any]:
+        enabled = self.is_enabled()
+        end = time.monotonic() if enabled else self._stopped_at
+
+        return {
+            "enabled": enabled,
+            "sample_rate": self._sample_rate,
+            "elapsed": round(end - self._started_at, 3) if self._started_at else 0,
+            "remaining": round(max(0.0, self._deadline - time.monotonic()), 3) if enabled and self._deadline else None,
+            "sampled": self._sampled,
+            "skipped": self._skipped,
+            "stacks": len(self._stats),
+        }
+
+    def _get_stats(self, stack: Stack) -> List[float]:
+        stats = self._stats.get(stack)
+        if stats is None:
+            stats = self._stats[stack] = [0.0] * _FIELDS
+        return stats
+
+    @contextlib.contextmanager
+    def _frame(self, stack: Stack) -> Iterator[None]:
+        token = _current_stack.set(stack)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats = self._get_stats(stack)
+            stats[_CALLS] += 1
+            stats[_WALL] += time.perf_counter() - started_at
+            _current_stack.reset(token)
+
+    @contextlib.contextmanager
+    def job(self, name: str) -> Iterator[None]:
+        """
+        Profile an iteration of a job, subject to the sampling
+        """
+        if not self.is_enabled():
+            yield
+            return
+
+        if self._sample_rate < 1 and random.random() >= self._sample_rate:
+            self._skipped += 1
+            yield
+            return
+
+        self._sampled += 1
+        with self._frame((name, )):
+            yield
+
+    @contextlib.contextmanager
+    def section(self, name: str) -> Iterator[None]:
+        """
+        Profile a call inside a profiled job, nothing happens outside of one
+        """
+        stack = _current_stack.get()
+
+        if stack is None or not self._enabled:
+            yield
+            return
+
+        with self._frame(stack + (name, )):
+            yield
+
+    def add(self, kind: str, seconds: float = 0.0) -> None:
+        """
+        Attribute a call of `kind` (mc, db, rest) taking `seconds` to the current stack
+        """
+        stack = _current_stack.get()
+
+        if stack is None or not self._enabled:
+            return
+
+        stats = self._get_stats(stack)
+        index = _KIND_INDEX[kind]
+        stats[index] += 1
+        stats[index + 1] += seconds
+
+    def _get_inclusive(self) -> Dict[Stack, List[float]]:
+        """
+        Values of every stack including its callees, wall time excepted (it is already inclusive)
+        """
+        rr: Dict[Stack, List[float]] = {}
+
+        for stack, stats in self._stats.items():
+            for depth in range(1, len(stack) + 1):
+                prefix = stack[:depth]
+                inclusive = rr.get(prefix)
+                if inclusive is None:
+                    inclusive = rr[prefix] = [0.0] * _FIELDS
+                for index in range(2, _FIELDS):
+                    inclusive[index] += stats[index]
+
+            inclusive = rr[stack]
+            inclusive[_CALLS] = stats[_CALLS]
+            inclusive[_WALL] = stats[_WALL]
+
+        return rr
+
+    def get_report(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Stacks ranked by wall time, the resources include the callees of the stack
+        """
+        rr = []
+
+        for stack, stats in self._get_inclusive().items():
+            row: Dict[str, Any] = {
+                "stack": ";".join(stack),
+                "calls": int(stats[_CALLS]),
+                "wall_seconds": round(stats[_WALL], 6),
+                "wall_mean_ms": round(stats[_WALL] / stats[_CALLS] * 1000, 3) if stats[_CALLS] else 0,
+            }
+            for kind, index in _KIND_INDEX.items():
+                row["{}_calls".format(kind)] = int(stats[index])
+                row["{}_seconds".format(kind)] = round(stats[index + 1], 6)
+            rr.append(row)
+
+        rr.sort(key=lambda row: row["wall_seconds"], reverse=True)
+        return rr[:limit] if limit else rr
+
+    def get_collapsed(self, weight: str = "wall_seconds") -> str:
+        """
+        Collapsed stacks ("job;accessor;accessor value" lines), the value is the self `weight` in microseconds
+        for the *_seconds weights, a count for the *_calls weights
+
+        The self wall time of a stack is its wall time minus the wall time of its direct callees,
+        callees running concurrently (asyncio.gather) can exceed their caller, the value is then 0
+        """
+        index, scale = get_weight(weight)
+
+        values = {stack: stats[index] for stack, stats in self._stats.items()}
+
+        if index == _WALL:
+            for stack, stats in self._stats.items():
+                if len(stack) > 1 and stack[:-1] in values:
+                    values[stack[:-1]] -= stats[_WALL]
+
+        return "".join(
+            "{} {}\n".format(";".join(stack), round(max(0.0, value) * scale))
+            for stack, value in sorted(values.items())
+            if value > 0
+        )
+
+    def dump(self, directory: str, weight: str = "wall_seconds") -> str:
+        """
+        Write the collapsed stacks to a new file of `directory`, returns its path
+        The weight is validated before the path is built, an unknown weight raises ValueError
+        """
+        collapsed = self.get_collapsed(weight)
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "profile-{}-{}.folded".format(time.strftime("%Y%m%d-%H%M%S"), weight))
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(collapsed)
+
+        return path
+
+
+profiler = Profiler()
+
+
+def profiled(name: str) -> Callable:
+    """
+    Profile every call of a coroutine function as the section `name`
+    """
+    def inner(coro):
+        @functools.wraps(coro)
+        async def wrapper(*args, **kwargs):
+            if _current_stack.get() is None:
+                return await coro(*args, **kwargs)
+
+            with profiler.section(name):
+                return await coro(*args, **kwargs)
+        return wrapper
+    return inner
+
+
+def profile_methods(cls: type) -> type:
+    """
+    Profile the public coroutine methods defined by a class as <class name>.<method name>
+    """
+    for name, value in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(value):
+            setattr(cls, name, profiled("{}.{}".format(cls.__name__, name))(value))
+    return cls
@@ -1,29 +1,86 @@
+import re
 import json
+import time
+import asyncio
+import logging
 import aiohttp
 from aiohttp.typedefs import StrOrURL
-from typing import Optional, Any
+from typing import Optional, Any, Dict, Callable
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+from utils import metrics
+from utils.profiler import profiler
+
+JsonLoads = Callable[[bytes | str], Any]
+
+_NOTSET = object()
+
+
+HTTP_CLIENT_SECONDS = metrics.histogram(
+    "http_client_request_seconds", "Latency of the outgoing http requests", ["method", "path"])
+HTTP_CLIENT_RESPONSES = metrics.counter(
+    "http_client_responses_total", "Outgoing http requests by status, error when no response", ["method", "path", "status"])
+
+_ID_SEGMENT_RE = re.compile(r"/\d+(?=/|$)")
+
+
+def get_metric_path(url: StrOrURL) -> str:
+    """
+    The path of an url without the query, numeric segments are replaced by {id} to bound the label values
+    """
+    return _ID_SEGMENT_RE.sub("/{id}", str(url).split("?", 1)[0])
+
+
+def get_default_json_loads() -> JsonLoads:
+    """
+    Use orjson when it is installed, otherwise fall back to the standard library
+    Both of them decode bytes directly, there is no need to build an intermediate str
+    """
+    if orjson is not None:
+        return orjson.loads
+    return json.loads
 
 
 class AioHttpClientResponse:
-    def __init__(self, ok, url, status, request_info, headers, text):
+    def __init__(self, ok, url, status, request_info, headers, body, encoding="utf-8", json_loads=None):
         self.ok = ok
         self.url = url
         self.status = status
         self.request_info = request_info
         self.headers = headers
-        self._text = text
+        self._body: bytes = body
+        self._encoding = encoding
+        self._json_loads: JsonLoads = json_loads or get_default_json_loads()
+        self._text: Optional[str] = None
+        self._json: Any = _NOTSET
+
+    async def read(self) -> bytes:
+        """
+        In keeping with the native calling method, you must add await
+        """
+        return self._body
 
     async def text(self):
         """
         In keeping with the native calling method, you must add await
+        The body is only decoded on the first call
         """
+        if self._text is None:
+            self._text = self._body.decode(self._encoding)
         return self._text
 
     async def json(self):
         """
         In keeping with the native calling method, you must add await
+        The body bytes are parsed only once, later calls return the same object
         """
-        return json.loads(self._text)
+        if self._json is _NOTSET:
+            self._json = self._json_loads(self._body)
+        return self._json
 
 
 class AioHttpClient:
@@ -32,7 +89,27 @@ class AioHttpClient:
      Lack of functions such as stream transmission, if necessary, you can package it yourself
     """
 
-    def __init__(self, keep_alive=True, timeout=0, *args, **kwargs, ) -> None:
+    def __init__(
+        self,
+        keep_alive=True,
+        timeout=0,
+        limit=100,
+        limit_per_host=0,
+        keepalive_timeout=15.0,
+        ttl_dns_cache=10,
+        json_loads: Optional[JsonLoads] = None,
+        *args,
+        **kwargs,
+    ) -> None:
+        """
+        keep_alive=True enables the connection pool mode:
+            limit: total number of simultaneous connections (0 is unlimited)
+            limit_per_host: number of simultaneous connections to the same endpoint (0 is unlimited)
+            keepalive_timeout: seconds an idle connection is kept in the pool
+            ttl_dns_cache: seconds a resolved host is cached (None caches forever)
+
+        json_loads is the json backend used by the responses, orjson is used by default when installed
+        """
         self.session: Optional[aiohttp.ClientSession] = None
 
         self._args = args
@@ -41,18 +118,90 @@ class AioHttpClient:
         self._keep_alive = keep_alive
         self._timeout = timeout
 
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._ttl_dns_cache = ttl_dns_cache
+
+        self._json_loads: JsonLoads = json_loads or get_default_json_loads()
+
+        self._pool_stats: Dict[str, int] = {
+            "requests": 0,
+            "in_flight": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "queued": 0,
+        }
+
     def get_session(self) -> aiohttp.ClientSession:
         if self.session is None:
-            connector = None
-            if not self._keep_alive:
+            if self._keep_alive:
+                connector = aiohttp.TCPConnector(
+                    limit=self._limit,
+                    limit_per_host=self._limit_per_host,
+                    keepalive_timeout=self._keepalive_timeout,
+                    use_dns_cache=True,
+                    ttl_dns_cache=self._ttl_dns_cache,
+                )
+            else:
                 # disabled keep-alive
                 connector = aiohttp.TCPConnector(force_close=True)
             if self._timeout > 0:
                 self._kwargs["timeout"] = aiohttp.ClientTimeout(total=self._timeout)
-            self.session = aiohttp.ClientSession(*self._args, **self._kwargs, connector=connector)
+            self.session = aiohttp.ClientSession(
+                *self._args,
+                **self._kwargs,
+                connector=connector,
+                trace_configs=[self._get_trace_config()]
+            )
 
         return self.session
 
+    def _get_trace_config(self) -> aiohttp.TraceConfig:
+        """
+        Count the connection pool usage through aiohttp's tracing signals
+        """
+        def counter(key):
+            async def inner(session, context, params):
+                self._pool_stats[key] += 1
+            return inner
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(counter("connections_created"))
+        trace_config.on_connection_reuseconn.append(counter("connections_reused"))
+        trace_config.on_connection_queued_start.append(counter("queued"))
+        return trace_config
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """
+        Connection pool usage, the counters are accumulated since the session was created
+        """
+        stats: Dict[str, Any] = dict(self._pool_stats)
+        stats["keep_alive"] = self._keep_alive
+        stats["limit"] = self._limit
+        stats["limit_per_host"] = self._limit_per_host
+        return stats
+
+    def _observe(self, method: str, url: StrOrURL, status: str, started_at: float) -> None:
+        path = get_metric_path(url)
+        elapsed = time.perf_counter() - started_at
+        HTTP_CLIENT_SECONDS.labels(method, path).observe(elapsed)
+        HTTP_CLIENT_RESPONSES.labels(method, path, status).inc()
+        profiler.add("rest", elapsed)
+
+    async def warm_up(self, url: StrOrURL = "/", connections: int = 1, timeout: float = 3) -> None:
+        """
+        Open `connections` keep-alive connections in advance, so the first real requests skip the handshake
+        The response of the warm-up request is not important, failures are only logged
+        """
+        async def head():
+            try:
+                await self.head(url, timeout=aiohttp.ClientTimeout(total=timeout))
+            except Exception as e:
+                logging.warning("{} warm up {} failed: {!r}".format(self, url, e))
+
+        await asyncio.gather(*(head() for _ in range(connections)))
+
     async def request(
         self, method: str, url: StrOrURL, **kwargs: Any
     ):
@@ -60,15 +209,26 @@ class AioHttpClient:
         Get necessary data before resp closes
         In this way, there is no need to call resp.close() externally
         """
-        async with self.get_session().request(method, url, **kwargs) as resp:
-            return AioHttpClientResponse(
-                ok=resp.ok,
-                url=resp.url,
-                status=resp.status,
-                request_info=resp.request_info,
-                headers=resp.headers,
-                text=await resp.text(),
-            )
+        self._pool_stats["requests"] += 1
+        self._pool_stats["in_flight"] += 1
+        status = "error"
+        started_at = time.perf_counter()
+        try:
+            async with self.get_session().request(method, url, **kwargs) as resp:
+                status = str(resp.status)
+                return AioHttpClientResponse(
+                    ok=resp.ok,
+                    url=resp.url,
+                    status=resp.status,
+                    request_info=resp.request_info,
+                    headers=resp.headers,
+                    body=await resp.read(),
+                    encoding=resp.charset or "utf-8",
+                    json_loads=self._json_loads,
+                )
+        finally:
+            self._pool_stats["in_flight"] -= 1
+            self._observe(method, url, status, started_at)
 
     async def options(self, url: StrOrURL, *, allow_redirects: bool = True, **kwargs: Any):
         return await self.request(
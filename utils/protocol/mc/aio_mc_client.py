@@ -1,15 +1,33 @@
+import time
 import enum
 import asyncio
 import logging
 import traceback
 
 from ..tcp.aio_tcp_client import AioTcpClient
+from . import frame
+from .frame import COMMAND_BATCH_READ, COMMAND_BATCH_WRITE, COMMAND_RANDOM_WRITE
 
 
-from utils import log
+from utils import log, metrics
+from utils.profiler import profiler
+from utils.tracing import tracer, get_current_span
 
 ListTuple = list | tuple
 
+# Maximum number of word points in a single random write (command 1402) frame
+RANDOM_WRITE_MAX_POINTS = 160
+# Maximum number of word points in a single batch read (command 0401) frame
+BATCH_READ_MAX_POINTS = 960
+
+MC_FRAMES_SENT = metrics.counter("mc_frames_sent_total", "MC frames sent to the PLC", ["plc", "command"])
+MC_FRAMES_RECEIVED = metrics.counter("mc_frames_received_total", "MC frames received from the PLC", ["plc", "command"])
+MC_ROUND_TRIP = metrics.histogram("mc_round_trip_seconds", "From sending a MC request to its complete response",
+                                  ["plc", "command"])
+MC_LOCK_WAIT = metrics.histogram("mc_lock_wait_seconds", "Time waited for the connection lock of a PLC", ["plc"])
+MC_RETRIES = metrics.counter("mc_retries_total", "Failed MC requests retried by the safe_* methods", ["plc", "command"])
+MC_CONNECTS = metrics.counter("mc_connects_total", "Connections opened to a PLC, reconnects included", ["plc"])
+
 
 def coroutine_safe(coro):
     ins = "lock"
@@ -17,30 +35,75 @@ def coroutine_safe(coro):
     async def wrapper(self: "AioMcClient", *args, **kwargs):
         if not hasattr(self, ins):
             setattr(self, ins, asyncio.Lock())
-        async with getattr(self, ins):
-            return await coro(self, *args, **kwargs)
+        with tracer.span("mc." + coro.__name__, plc=self._plc) as span:
+            started_at = time.perf_counter()
+            async with getattr(self, ins):
+                waited = time.perf_counter() - started_at
+                self._lock_wait.observe(waited)
+                if span is not None:
+                    span.set("lock_wait_ms", round(waited * 1000, 3))
+                return await coro(self, *args, **kwargs)
     return wrapper
 
 
+def trace_frame(started_at: float, sent_at: float, received_at: float, **attributes) -> None:
+    """
+    Add the send and receive time of a frame to the current span
+    """
+    span = get_current_span()
+
+    if span is not None:
+        span.set("send_ms", round((sent_at - started_at) * 1000, 3))
+        span.set("recv_ms", round((received_at - sent_at) * 1000, 3))
+        span.attributes.update(attributes)
+
+
 class SoftComponentCode(enum.Enum):
     data_register = "D*"
 
 
+# frames are encoded by .frame, which names the devices without the ASCII padding
+DATA_REGISTER = frame.DEVICES_BY_ASCII_CODE[SoftComponentCode.data_register.value].name
+
+
 class AioMcClient:
     """
     A package based on the Mitsubishi mc protocol that currently only supports D*'s register ASCII reads and writes
+    Requests are encoded and responses decoded by .frame, the codec shared with the simulator
     """
 
-    def __init__(self, host: str, port: int, debug: bool = False) -> None:
+    def __init__(self, host: str, port: int, debug: bool = False, transport=None) -> None:
+        """
+        transport replaces the tcp connection to the PLC, it must provide the
+        open / close / is_closing / write / readexactly methods of AioTcpClient (used by the replay mode)
+        """
         self._host = host
         self._port = port
         self._debug = debug
         self._stoped = True
-        self._tcp_client = AioTcpClient(host, port, timeout=3)
+        # a reply that never comes fails the request instead of holding the connection lock forever
+        self._tcp_client = transport or AioTcpClient(host, port, timeout=3, read_timeout=3)
+
+        self._plc = "{}:{}".format(host, port)
+        self._lock_wait = MC_LOCK_WAIT.labels(self._plc)
+        self._command_metrics = {}
 
     def __repr__(self) -> str:
         return "<{} {}:{} id={}>".format(__class__.__name__, self._host, self._port, id(self))
 
+    def get_command_metrics(self, command: str) -> tuple:
+        """
+        (frames sent, frames received, round trip) metrics of a command to this PLC
+        """
+        rr = self._command_metrics.get(command)
+        if rr is None:
+            rr = self._command_metrics[command] = (
+                MC_FRAMES_SENT.labels(self._plc, command),
+                MC_FRAMES_RECEIVED.labels(self._plc, command),
+                MC_ROUND_TRIP.labels(self._plc, command),
+            )
+        return rr
+
     def is_closing(self) -> bool:
         return self._tcp_client.is_closing()
 
@@ -52,8 +115,10 @@ class AioMcClient:
             await self.open()
 
     async def open(self) -> None:
-        await self._tcp_client.open()
+        with tracer.span("mc.connect", plc=self._plc):
+            await self._tcp_client.open()
         self._stoped = False
+        MC_CONNECTS.labels(self._plc).inc()
 
         # Since open and smart_start are called under the coroutine_safe decorator
         # So you don't need to consider the security of these 2 methods
@@ -68,71 +133,115 @@ class AioMcClient:
         if self._debug:
             logging.debug("close {}:{}".format(self._host, self._port))
 
+    async def _read_response(self) -> bytes:
+        """
+        Read exactly one response, its size comes from the data length field of its head
+        Returns the data after the end code, raises McEndCodeError when the end code isn't 0
+
+        A response that is cut short (broken link, read timeout, cancellation) leaves the stream
+        out of line with the requests, the connection is reopened by the next request
+        """
+        try:
+            first = await self._tcp_client.readexactly(2)
+            head = first + await self._tcp_client.readexactly(frame.get_prefix_size(first) - 2)
+            response = head + await self._tcp_client.readexactly(frame.get_request_size(head) - len(head))
+        except asyncio.IncompleteReadError:
+            self._stoped = True
+            raise BrokenPipeError("reception register data failed, broken links") from None
+        except BaseException:
+            self._stoped = True
+            raise
+
+        end_code, data = frame.decode_response(response)
+        if end_code != frame.END_CODE_OK:
+            raise frame.McEndCodeError("{} answered with end code 0x{:04X}".format(self, end_code), end_code)
+
+        return data
+
     @coroutine_safe
     async def recv_register(self, start_addr: int, count: int = 1) -> int | tuple:
         await self.smart_start()
 
-        # Build the request body
-        request = '500000FF03FF000018001004010000' + SoftComponentCode.data_register.value + \
-            str(start_addr).zfill(6) + hex(count)[2:].zfill(4)
-
-        await self._tcp_client.write(bytes(request.encode("utf-8")))
+        request = frame.encode_batch_read_request(DATA_REGISTER, start_addr, count)
 
-        resp_head = await self._tcp_client.read(22)
+        sent, received, round_trip = self.get_command_metrics(COMMAND_BATCH_READ)
+        started_at = time.perf_counter()
 
-        recv_size = 0
-        resp_body = b""
+        await self._tcp_client.write(request)
+        sent.inc()
+        sent_at = time.perf_counter()
 
-        if resp_head == b"":
-            raise BrokenPipeError("reception register data failed, broken links")
+        resp_body = await self._read_response()
 
-        resp_body_length = int(resp_head[14:18], base=16) - 4
+        received.inc()
+        elapsed = time.perf_counter() - started_at
+        round_trip.observe(elapsed)
+        profiler.add("mc", elapsed)
+        trace_frame(started_at, sent_at, started_at + elapsed,
+                    command=COMMAND_BATCH_READ, start_addr=start_addr, count=count)
 
-        while recv_size < resp_body_length:
-            resp_body += await self._tcp_client.read(1024)
-            recv_size += 1024
+        if len(resp_body) != count * 4:
+            raise frame.McEndCodeError("{} answered {} words to a read of {}".format(
+                self, len(resp_body) // 4, count), frame.END_CODE_LENGTH_ERROR)
 
         if count == 1:
             return int(resp_body, base=16)
 
-        rr = []
-        index = 0
-        while len(rr) != len(resp_body) // 4:
-            rr.append(int(resp_body[index:index + 4], base=16))
-            index += 4
-        return tuple(rr)
+        return frame.decode_words(resp_body, True)
 
     @coroutine_safe
     async def send_register(self, start_addr: int, values: int | ListTuple) -> None:
         await self.smart_start()
 
-        req_prefix = "500000FF03FF00"
-        req_data = ""
-        req_count = ""
-        req_length = ""
-        req_address = str(start_addr).zfill(6)
-
         if isinstance(values, int):
-            req_count = hex(1)[2:].zfill(4)
-            req_data = hex(values)[2:].zfill(4)
-        elif isinstance(values, ListTuple):
-            req_count = hex(len(values))[2:].zfill(4)
-            for value in values:
-                req_data += hex(value)[2:].zfill(4)
-        else:
+            values = (values, )
+        elif not isinstance(values, ListTuple):
             raise TypeError(
                 "Unsupported values type, expect <int|tuple|list> but got <{}>".format(
                     type(values).__name__))
 
-        req_suffix = req_address + req_count + req_data
-        req_middle = "001014010000" + SoftComponentCode.data_register.value
-        req_length = hex(len(req_middle + req_suffix))[2:].zfill(4)
+        request = frame.encode_batch_write_request(DATA_REGISTER, start_addr, values)
 
-        request = req_prefix + req_length + req_middle + req_suffix
+        sent, received, round_trip = self.get_command_metrics(COMMAND_BATCH_WRITE)
+        started_at = time.perf_counter()
 
-        await self._tcp_client.write(bytes(request.encode("utf-8")))
-        # discard 22 pieces of data
-        await self._tcp_client.read(22)
+        await self._tcp_client.write(request)
+        sent.inc()
+        sent_at = time.perf_counter()
+        await self._read_response()
+        received.inc()
+        elapsed = time.perf_counter() - started_at
+        round_trip.observe(elapsed)
+        profiler.add("mc", elapsed)
+        trace_frame(started_at, sent_at, started_at + elapsed, command=COMMAND_BATCH_WRITE, start_addr=start_addr)
+
+    @coroutine_safe
+    async def send_random_register(self, addr_values: dict[int, int]) -> None:
+        """
+        Random write of word units (command 1402), every address gets its own value
+        The caller must ensure that len(addr_values) <= RANDOM_WRITE_MAX_POINTS
+        """
+        await self.smart_start()
+
+        if len(addr_values) > RANDOM_WRITE_MAX_POINTS:
+            raise ValueError("Too many random write points, expect <= {} but got {}".format(
+                RANDOM_WRITE_MAX_POINTS, len(addr_values)))
+
+        request = frame.encode_random_write_request(
+            (DATA_REGISTER, addr, value) for addr, value in addr_values.items())
+
+        sent, received, round_trip = self.get_command_metrics(COMMAND_RANDOM_WRITE)
+        started_at = time.perf_counter()
+
+        await self._tcp_client.write(request)
+        sent.inc()
+        sent_at = time.perf_counter()
+        await self._read_response()
+        received.inc()
+        elapsed = time.perf_counter() - started_at
+        round_trip.observe(elapsed)
+        profiler.add("mc", elapsed)
+        trace_frame(started_at, sent_at, started_at + elapsed, command=COMMAND_RANDOM_WRITE, points=len(addr_values))
 
     async def safe_send_register(self, start_addr: int, values: int | ListTuple) -> None:
         while True:
@@ -140,6 +249,17 @@ class AioMcClient:
                 return await self.send_register(start_addr, values)
             except Exception as e:
                 self._stoped = True
+                MC_RETRIES.labels(self._plc, COMMAND_BATCH_WRITE).inc()
+                logging.error("{}: {}".format(self, traceback.format_exc()))
+            await asyncio.sleep(1)
+
+    async def safe_send_random_register(self, addr_values: dict[int, int]) -> None:
+        while True:
+            try:
+                return await self.send_random_register(addr_values)
+            except Exception as e:
+                self._stoped = True
+                MC_RETRIES.labels(self._plc, COMMAND_RANDOM_WRITE).inc()
                 logging.error("{}: {}".format(self, traceback.format_exc()))
             await asyncio.sleep(1)
 
@@ -149,5 +269,6 @@ class AioMcClient:
                 return await self.recv_register(start_addr, count)
             except Exception as e:
                 self._stoped = True
+                MC_RETRIES.labels(self._plc, COMMAND_BATCH_READ).inc()
                 logging.error("{}: {}".format(self, traceback.format_exc()))
             await asyncio.sleep(1)
@@ -0,0 +1,344 @@
+import json
+import random
+import asyncio
+import logging
+import argparse
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from ..tcp.aio_tcp_server import AioTcpServer, AioBaseRequestHandler
+from . import frame
+
+
+class McRegisterFile:
+    """
+    The in-memory devices of a simulated PLC, addresses that were never written read 0
+
+    Word access to a bit device reads / writes 16 consecutive bits (the lowest address is bit 0),
+    bit access to a word device is rejected like a real PLC does
+    """
+
+    def __init__(self) -> None:
+        self._devices: Dict[str, Dict[int, int]] = {name: {} for name in frame.DEVICES}
+
+    def get_word(self, device: str, addr: int) -> int:
+        if frame.DEVICES[device].is_bit:
+            bits = self._devices[device]
+            return sum((bits.get(addr + index, 0) & 1) << index for index in range(16))
+        return self._devices[device].get(addr, 0)
+
+    def set_word(self, device: str, addr: int, value: int) -> None:
+        if frame.DEVICES[device].is_bit:
+            bits = self._devices[device]
+            for index in range(16):
+                bits[addr + index] = value >> index & 1
+        else:
+            self._devices[device][addr] = value & 0xFFFF
+
+    def get_dword(self, device: str, addr: int) -> int:
+        return self.get_word(device, addr) | self.get_word(device, addr + 1) << 16
+
+    def set_dword(self, device: str, addr: int, value: int) -> None:
+        self.set_word(device, addr, value & 0xFFFF)
+        self.set_word(device, addr + 1, value >> 16 & 0xFFFF)
+
+    def get_bit(self, device: str, addr: int) -> int:
+        if not frame.DEVICES[device].is_bit:
+            raise ValueError("{} is not a bit device".format(device))
+        return self._devices[device].get(addr, 0)
+
+    def set_bit(self, device: str, addr: int, value: int) -> None:
+        if not frame.DEVICES[device].is_bit:
+            raise ValueError("{} is not a bit device".format(device))
+        self._devices[device][addr] = value & 1
+
+
+class McPlcSimulator:
+    """
+    A simulated PLC speaking the MC protocol (ASCII and binary, 3E and 4E frames)
+
+    Supports batch read / write and random read / write of word and bit devices.
+    Every request is delayed by `latency` plus a uniform random `jitter`, and faults can be injected:
+        error_rate: reply with `error_end_code` instead of executing the request
+        drop_rate: execute nothing and never reply (AioMcClient fails the request after its read timeout)
+        disconnect_rate: close the connection
+    Requests on an unknown device are answered with END_CODE_DEVICE_ERROR
+    """
+
+    def __init__(
+        self,
+        register_file: Optional[McRegisterFile] = None,
+        latency: float = 0,
+        jitter: float = 0,
+        error_rate: float = 0,
+        drop_rate: float = 0,
+        disconnect_rate: float = 0,
+        error_end_code: int = frame.END_CODE_UNSUPPORTED_COMMAND,
+        seed: Optional[int] = None,
+    ) -> None:
+        self._register_file = register_file or McRegisterFile()
+        self._latency = latency
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._drop_rate = drop_rate
+        self._disconnect_rate = disconnect_rate
+        self._error_end_code = error_end_code
+        self._random = random.Random(seed)
+
+        self._stats: Dict[str, int] = {
+            "requests": 0,
+            "errors": 0,
+            "drops": 0,
+            "disconnects": 0,
+        }
+
+    def get_register_file(self) -> McRegisterFile:
+        return self._register_file
+
+    def get_stats(self) -> Dict[str, int]:
+        return dict(self._stats)
+
+    def add_stat(self, key: str) -> None:
+        self._stats[key] += 1
+
+    def get_delay(self) -> float:
+        return self._latency + (self._random.uniform(0, self._jitter) if self._jitter else 0)
+
+    def get_fault(self) -> Optional[str]:
+        """
+        None, "error", "drop" or "disconnect"
+        """
+        roll = self._random.random()
+
+        for fault, rate in (("disconnect", self._disconnect_rate), ("drop", self._drop_rate),
+                            ("error", self._error_rate)):
+            if roll < rate:
+                return fault
+            roll -= rate
+
+        return None
+
+    def encode_error(self, request: frame.McRequest) -> bytes:
+        return frame.encode_response(request, end_code=self._error_end_code)
+
+    def execute(self, request: frame.McRequest) -> bytes:
+        """
+        Execute a request against the register file and encode the response
+        """
+        self.add_stat("requests")
+        registers = self._register_file
+
+        try:
+            if request.command == frame.COMMAND_BATCH_READ:
+                addr_range = range(request.start_addr, request.start_addr + request.count)
+                if request.is_bit_units():
+                    return frame.encode_response(request, [registers.get_bit(request.device, addr) for addr in addr_range])
+                return frame.encode_response(request, [registers.get_word(request.device, addr) for addr in addr_range])
+
+            if request.command == frame.COMMAND_BATCH_WRITE:
+                if len(request.values) != request.count:
+                    return frame.encode_response(request, end_code=frame.END_CODE_LENGTH_ERROR)
+
+                for addr, value in enumerate(request.values, request.start_addr):
+                    if request.is_bit_units():
+                        registers.set_bit(request.device, addr, value)
+                    else:
+                        registers.set_word(request.device, addr, value)
+                return frame.encode_response(request)
+
+            if request.command == frame.COMMAND_RANDOM_READ:
+                return frame.encode_response(
+                    request,
+                    [registers.get_word(device, addr) for device, addr in request.points],
+                    [registers.get_dword(device, addr) for device, addr in request.dword_points],
+                )
+
+            if request.command == frame.COMMAND_RANDOM_WRITE:
+                for device, addr, value in request.points:
+                    if request.is_bit_units():
+                        registers.set_bit(device, addr, value)
+                    else:
+                        registers.set_word(device, addr, value)
+
+                for device, addr, value in request.dword_points:
+                    registers.set_dword(device, addr, value)
+                return frame.encode_response(request)
+
+        except ValueError:
+            return frame.encode_response(request, end_code=frame.END_CODE_DEVICE_ERROR)
+
+        return frame.encode_response(request, end_code=frame.END_CODE_UNSUPPORTED_COMMAND)
+
+    def get_handler_class(self) -> Type["McSimulatorRequestHandler"]:
+        """
+        A request handler class bound to this simulator, for AioTcpServer
+        """
+        return type("BoundMcSimulatorRequestHandler", (McSimulatorRequestHandler, ), {"simulator": self})
+
+
+class McSimulatorRequestHandler(AioBaseRequestHandler):
+    """
+    Serve the requests of one connection in order, see McPlcSimulator
+    """
+
+    simulator: McPlcSimulator
+
+    async def read_request(self) -> bytes:
+        first = await self.request.readexactly(2)
+        head_size = frame.get_head_size(first)
+        # the head and the data length field
+        head = first + await self.request.readexactly(head_size - 2 + (4 if first[:1] == b"5" else 2))
+        return head + await self.request.readexactly(frame.get_request_size(head) - len(head))
+
+    async def handle(self) -> None:
+        simulator = self.simulator
+        peername = self.request.get_peername()
+        logging.debug("client {} connected".format(peername))
+
+        while True:
+            try:
+                data = await self.read_request()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                logging.debug("client {} disconnect".format(peername))
+                break
+
+            delay = simulator.get_delay()
+            if delay:
+                await asyncio.sleep(delay)
+
+            fault = simulator.get_fault()
+
+            if fault == "disconnect":
+                simulator.add_stat("disconnects")
+                break
+
+            if fault == "drop":
+                simulator.add_stat("drops")
+                continue
+
+            try:
+                request = frame.decode_request(data)
+            except frame.McDecodeError as e:
+                if e.request is None:
+                    logging.debug("client {} sent an invalid request: {}".format(peername, e))
+                    break
+
+                simulator.add_stat("errors")
+                await self.request.write(frame.encode_response(e.request, end_code=e.end_code))
+                continue
+
+            if fault == "error":
+                simulator.add_stat("errors")
+                await self.request.write(simulator.encode_error(request))
+                continue
+
+            await self.request.write(simulator.execute(request))
+
+        await self.request.close()
+
+
+# ---- command line
+
+def iter_signal_conf(signal_conf: Dict[str, Any], path: Tuple[str, ...] = ()):
+    """
+    Yield (path, conf) for every entry of a SIGNAL tree that has an ADDRESS
+    """
+    if "ADDRESS" in signal_conf:
+        yield path, signal_conf
+
+    for key, value in signal_conf.items():
+        if isinstance(value, dict):
+            yield from iter_signal_conf(value, path + (key, ))
+
+
+def preload_signal(register_file: McRegisterFile, device_conf: Dict[str, Any]) -> List[Tuple[int, int, int]]:
+    """
+    Prepare the registers of a device of signal.json:
+        RECV STATUS of every sub device is set to AUTO, so the lifts are in a normal mode
+    Returns the RECV heartbeats as (address, min, max)
+    """
+    heartbeats = []
+    device_conf_list = [device_conf] + list(device_conf.get("SUB_DEVICE", []))
+
+    for conf in device_conf_list:
+        for path, signal_conf in iter_signal_conf(conf.get("SIGNAL", {}).get("RECV", {})):
+            if path == ("HEARTBEAT", ):
+                heartbeats.append((signal_conf["ADDRESS"], signal_conf.get("MIN", 0), signal_conf.get("MAX", 100)))
+            elif path == ("STATUS", ) and "AUTO" in signal_conf.get("BIT", {}):
+                register_file.set_word("D", signal_conf["ADDRESS"], 1 << signal_conf["BIT"]["AUTO"])
+
+    return heartbeats
+
+
+async def tick_heartbeat(register_file: McRegisterFile, addr: int, min_value: int, max_value: int,
+                         interval: float = 1) -> None:
+    """
+    Increment a heartbeat register like the PLC does
+    """
+    while True:
+        value = register_file.get_word("D", addr) + 1
+        register_file.set_word("D", addr, min_value if value > max_value else value)
+        await asyncio.sleep(interval)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="MC protocol PLC simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, action="append",
+                        help="port to listen on, repeatable (default: the PORT of every device in --signal)")
+    parser.add_argument("--signal", help="signal.json to preload, e.g. ./conf/private/signal.json")
+    parser.add_argument("--set", action="append", default=[], metavar="DEVICE:ADDR=VALUE",
+                        help="preload a word, e.g. D:11001=2, repeatable")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0, help="uniform random seconds added to the latency")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--drop-rate", type=float, default=0)
+    parser.add_argument("--disconnect-rate", type=float, default=0)
+    parser.add_argument("--error-end-code", type=lambda value: int(value, 16), default=frame.END_CODE_UNSUPPORTED_COMMAND)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG, format="[%(levelname)s|%(asctime)s]: %(message)s")
+
+    device_conf_list = []
+    if args.signal:
+        with open(args.signal, mode="r", encoding="UTF-8") as f:
+            device_conf_list = json.load(f)["DEVICE"]
+
+    ports = args.port or [device_conf["PORT"] for device_conf in device_conf_list]
+    assert ports, "--port or --signal is required"
+
+    async def serve():
+        coros = []
+
+        for index, port in enumerate(ports):
+            register_file = McRegisterFile()
+
+            if index < len(device_conf_list):
+                for addr, min_value, max_value in preload_signal(register_file, device_conf_list[index]):
+                    coros.append(tick_heartbeat(register_file, addr, min_value, max_value))
+
+            for item in args.set:
+                key, value = item.split("=")
+                device, addr = key.split(":")
+                register_file.set_word(device, int(addr), int(value, 0))
+
+            simulator = McPlcSimulator(
+                register_file,
+                latency=args.latency,
+                jitter=args.jitter,
+                error_rate=args.error_rate,
+                drop_rate=args.drop_rate,
+                disconnect_rate=args.disconnect_rate,
+                error_end_code=args.error_end_code,
+                seed=args.seed,
+            )
+            server = AioTcpServer((args.host, port), simulator.get_handler_class())
+            coros.append(server.serve_forever())
+
+        await asyncio.gather(*coros)
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import struct
+import typing
+
+
+COMMAND_BATCH_READ = "0401"
+COMMAND_BATCH_WRITE = "1401"
+COMMAND_RANDOM_READ = "0403"
+COMMAND_RANDOM_WRITE = "1402"
+
+SUBCOMMAND_WORD = "0000"
+SUBCOMMAND_BIT = "0001"
+
+# end codes returned by the PLC
+END_CODE_OK = 0x0000
+END_CODE_UNSUPPORTED_COMMAND = 0xC059
+END_CODE_DEVICE_ERROR = 0xC056
+END_CODE_LENGTH_ERROR = 0xC061
+
+
+class McDecodeError(ValueError):
+    """
+    A request that can't be decoded, `request` holds its head and command when they could be decoded
+    so the error can be answered with `end_code`
+    """
+
+    def __init__(self, message: str, end_code: int) -> None:
+        super().__init__(message)
+        self.end_code = end_code
+        self.request: typing.Optional["McRequest"] = None
+
+
+class McEndCodeError(IOError):
+    """
+    A response whose end code is not END_CODE_OK
+    """
+
+    def __init__(self, message: str, end_code: int) -> None:
+        super().__init__(message)
+        self.end_code = end_code
+
+
+class McDevice(typing.NamedTuple):
+    name: str
+    ascii_code: str
+    binary_code: int
+    is_bit: bool
+    # base of the address in ASCII frames
+    base: int
+
+
+DEVICES = {
+    device.name: device for device in (
+        McDevice("D", "D*", 0xA8, False, 10),
+        McDevice("W", "W*", 0xB4, False, 16),
+        McDevice("R", "R*", 0xAF, False, 10),
+        McDevice("ZR", "ZR", 0xB0, False, 10),
+        McDevice("SD", "SD", 0xA9, False, 10),
+        McDevice("M", "M*", 0x90, True, 10),
+        McDevice("L", "L*", 0x92, True, 10),
+        McDevice("SM", "SM", 0x91, True, 10),
+        McDevice("B", "B*", 0xA0, True, 16),
+        McDevice("X", "X*", 0x9C, True, 16),
+        McDevice("Y", "Y*", 0x9D, True, 16),
+    )
+}
+DEVICES_BY_ASCII_CODE = {device.ascii_code: device for device in DEVICES.values()}
+DEVICES_BY_BINARY_CODE = {device.binary_code: device for device in DEVICES.values()}
+
+
+class McRequest(typing.NamedTuple):
+    """
+    A decoded 3E / 4E request, ASCII or binary
+
+    Batch commands use device, start_addr, count and values (the written words or bits).
+    Random reads use points = ((device, addr), ...) and dword_points likewise,
+    random writes use points = ((device, addr, value), ...) and dword_points likewise.
+    `head` is the frame before the data length, it is echoed back in the response
+    """
+    is_ascii: bool
+    frame_type: str
+    serial: int
+    head: bytes
+    command: str
+    subcommand: str
+    device: str = ""
+    start_addr: int = 0
+    count: int = 0
+    values: tuple = ()
+    points: tuple = ()
+    dword_points: tuple = ()
+
+    def is_bit_units(self) -> bool:
+        return self.subcommand == SUBCOMMAND_BIT
+
+
+# ---- framing
+
+def is_ascii_frame(first: bytes) -> bool:
+    return first[:1] in (b"5", b"D")
+
+
+def get_head_size(first: bytes) -> int:
+    """
+    Size of the part before the data length field, from the first 2 bytes of a request or a response
+    """
+    if first in (b"50", b"D0"):
+        return 14
+    if first in (b"54", b"D4"):
+        return 22
+    if first in (b"\x50\x00", b"\xd0\x00"):
+        return 7
+    if first in (b"\x54\x00", b"\xd4\x00"):
+        return 11
+    raise ValueError("Unknown subheader: {!r}".format(first))
+
+
+def get_prefix_size(first: bytes) -> int:
+    """
+    Size of the head and the data length field, the part get_request_size() needs
+    """
+    return get_head_size(first) + (4 if is_ascii_frame(first) else 2)
+
+
+def get_request_size(head: bytes) -> int:
+    """
+    Total size of a request or a response from its head and data length field
+    (get_head_size() + 4 bytes in ASCII, + 2 in binary)
+    """
+    head_size = get_head_size(head[:2])
+
+    if is_ascii_frame(head):
+        return head_size + 4 + int(head[head_size:head_size + 4], 16)
+
+    return head_size + 2 + struct.unpack_from("<H", head, head_size)[0]
+
+
+# ---- decoding
+
+class _Cursor:
+    def __init__(self, data: bytes, is_ascii: bool) -> None:
+        self.data = data
+        self.is_ascii = is_ascii
+        self.offset = 0
+
+    def _take(self, size: int) -> bytes:
+        rr = self.data[self.offset:self.offset + size]
+        if len(rr) != size:
+            raise McDecodeError("Request is too short", END_CODE_LENGTH_ERROR)
+        self.offset += size
+        return rr
+
+    def number(self, size: int) -> int:
+        """
+        An unsigned number of `size` bytes in binary, or 2 * size hex chars in ASCII
+        """
+        if self.is_ascii:
+            return int(self._take(size * 2), 16)
+        return int.from_bytes(self._take(size), "little")
+
+    def command(self) -> str:
+        if self.is_ascii:
+            return self._take(4).decode("ascii")
+        return "{:04X}".format(self.number(2))
+
+    def device(self) -> tuple[str, int]:
+        if self.is_ascii:
+            code = self._take(2).decode("ascii", errors="replace")
+            if code not in DEVICES_BY_ASCII_CODE:
+                raise McDecodeError("Unknown device code {!r}".format(code), END_CODE_DEVICE_ERROR)
+
+            device = DEVICES_BY_ASCII_CODE[code]
+            try:
+                return device.name, int(self._take(6), device.base)
+            except ValueError:
+                raise McDecodeError("Invalid device address", END_CODE_DEVICE_ERROR) from None
+
+        addr = self.number(3)
+        code = self.number(1)
+        if code not in DEVICES_BY_BINARY_CODE:
+            raise McDecodeError("Unknown device code 0x{:02X}".format(code), END_CODE_DEVICE_ERROR)
+
+        return DEVICES_BY_BINARY_CODE[code].name, addr
+
+    def bits(self, count: int) -> tuple:
+        if self.is_ascii:
+            return tuple(int(char) for char in self._take(count).decode("ascii"))
+
+        data = self._take((count + 1) // 2)
+        bits = []
+        for byte in data:
+            bits.append(byte >> 4 & 1)
+            bits.append(byte & 1)
+        return tuple(bits[:count])
+
+
+def _decode_data(cursor: _Cursor, base: dict) -> McRequest:
+    """
+    Decode the data of a request after its command and subcommand
+    """
+    command = base["command"]
+    is_bit_units = base["subcommand"] == SUBCOMMAND_BIT
+
+    if command in (COMMAND_BATCH_READ, COMMAND_BATCH_WRITE):
+        device, start_addr = cursor.device()
+        count = cursor.number(2)
+
+        values: tuple = ()
+        if command == COMMAND_BATCH_WRITE:
+            values = cursor.bits(count) if is_bit_units else tuple(cursor.number(2) for _ in range(count))
+
+        return McRequest(**base, device=device, start_addr=start_addr, count=count, values=values)
+
+    if command == COMMAND_RANDOM_READ:
+        word_count = cursor.number(1)
+        dword_count = cursor.number(1)
+        points = tuple(cursor.device() for _ in range(word_count))
+        dword_points = tuple(cursor.device() for _ in range(dword_count))
+        return McRequest(**base, count=word_count, points=points, dword_points=dword_points)
+
+    if command == COMMAND_RANDOM_WRITE:
+        if is_bit_units:
+            count = cursor.number(1)
+            points = tuple((*cursor.device(), cursor.number(1)) for _ in range(count))
+            return McRequest(**base, count=count, points=points)
+
+        word_count = cursor.number(1)
+        dword_count = cursor.number(1)
+        points = tuple((*cursor.device(), cursor.number(2)) for _ in range(word_count))
+        dword_points = tuple((*cursor.device(), cursor.number(4)) for _ in range(dword_count))
+        return McRequest(**base, count=word_count, points=points, dword_points=dword_points)
+
+    return McRequest(**base)
+
+
+def decode_request(frame: bytes) -> McRequest:
+    """
+    Decode a complete request, the format (ASCII / binary, 3E / 4E) is detected from the subheader
+    Raises McDecodeError, its `request` is set when the error can be answered (see encode_response)
+    """
+    head_size = get_head_size(frame[:2])
+    is_ascii = is_ascii_frame(frame)
+    frame_type = "4E" if frame[:2] in (b"54", b"\x54\x00") else "3E"
+
+    serial = 0
+    if frame_type == "4E":
+        serial = int(frame[4:8], 16) if is_ascii else struct.unpack_from("<H", frame, 2)[0]
+
+    cursor = _Cursor(frame, is_ascii)
+    cursor.offset = head_size
+    # data length, monitoring timer
+    cursor.number(2)
+    cursor.number(2)
+
+    command = cursor.command()
+    subcommand = cursor.command()
+    base = dict(is_ascii=is_ascii, frame_type=frame_type, serial=serial, head=frame[:head_size],
+                command=command, subcommand=subcommand)
+
+    try:
+        return _decode_data(cursor, base)
+    except McDecodeError as e:
+        e.request = McRequest(**base)
+        raise
+
+
+# ---- encoding
+
+def _encode_number(value: int, size: int, is_ascii: bool) -> bytes:
+    value &= (1 << size * 8) - 1
+    if is_ascii:
+        return "{:0{}X}".format(value, size * 2).encode("ascii")
+    return value.to_bytes(size, "little")
+
+
+def _encode_bits(bits: typing.Sequence[int], is_ascii: bool) -> bytes:
+    if is_ascii:
+        return "".join("1" if bit else "0" for bit in bits).encode("ascii")
+
+    bits = list(bits) + [0] * (len(bits) % 2)
+    return bytes((bits[index] & 1) << 4 | (bits[index + 1] & 1) for index in range(0, len(bits), 2))
+
+
+def _encode_command(command: str, is_ascii: bool) -> bytes:
+    return _encode_number(int(command, 16), 2, is_ascii)
+
+
+def encode_response(request: McRequest, values: typing.Iterable[int] = (), dword_values: typing.Iterable[int] = (),
+                    end_code: int = END_CODE_OK) -> bytes:
+    """
+    Encode the response to `request`
+
+    `values` are the words (or bits for bit unit reads) returned by a read,
+    `dword_values` the double words of a random read.
+    An error response carries the route and the command of the request instead of data
+    """
+    is_ascii = request.is_ascii
+
+    if end_code != END_CODE_OK:
+        route = request.head[-10:] if is_ascii else request.head[-5:]
+        data = route + _encode_command(request.command, is_ascii) + _encode_command(request.subcommand, is_ascii)
+    elif request.command == COMMAND_BATCH_READ and request.is_bit_units():
+        data = _encode_bits(tuple(values), is_ascii)
+    else:
+        data = b"".join(_encode_number(value, 2, is_ascii) for value in values) + \
+            b"".join(_encode_number(value, 4, is_ascii) for value in dword_values)
+
+    data = _encode_number(end_code, 2, is_ascii) + data
+
+    if is_ascii:
+        # D000 / D400 subheader, the rest of the head is echoed
+        head = b"D" + request.head[1:]
+        return head + "{:04X}".format(len(data)).encode("ascii") + data
+
+    head = bytes((0xD0 if request.frame_type == "3E" else 0xD4, 0x00)) + request.head[2:]
+    return head + struct.pack("<H", len(data)) + data
+
+
+# ---- client side
+
+def encode_device(device: str, addr: int, is_ascii: bool) -> bytes:
+    mc_device = DEVICES[device]
+
+    if is_ascii:
+        digits = "{:06d}".format(addr) if mc_device.base == 10 else "{:06X}".format(addr)
+        return (mc_device.ascii_code + digits).encode("ascii")
+
+    return addr.to_bytes(3, "little") + bytes((mc_device.binary_code, ))
+
+
+def encode_request(command: str, subcommand: str, data: bytes, is_ascii: bool = True, frame_type: str = "3E",
+                   serial: int = 0, timer: int = 0x10) -> bytes:
+    """
+    Frame the data of a command to the connected station (network 0, pc 0xFF, io 0x3FF, station 0)
+    """
+    body = _encode_number(timer, 2, is_ascii) + _encode_command(command, is_ascii) + \
+        _encode_command(subcommand, is_ascii) + data
+
+    if is_ascii:
+        head = "5000" if frame_type == "3E" else "5400{:04X}0000".format(serial)
+        return (head + "00FF03FF00" + "{:04X}".format(len(body))).encode("ascii") + body
+
+    head = b"\x50\x00" if frame_type == "3E" else b"\x54\x00" + struct.pack("<H", serial) + b"\x00\x00"
+    return head + b"\x00\xff\xff\x03\x00" + struct.pack("<H", len(body)) + body
+
+
+def encode_batch_read_request(device: str, start_addr: int, count: int, is_ascii: bool = True,
+                              frame_type: str = "3E", serial: int = 0) -> bytes:
+    data = encode_device(device, start_addr, is_ascii) + _encode_number(count, 2, is_ascii)
+    return encode_request(COMMAND_BATCH_READ, SUBCOMMAND_WORD, data, is_ascii, frame_type, serial)
+
+
+def encode_batch_write_request(device: str, start_addr: int, values: typing.Sequence[int], is_ascii: bool = True,
+                               frame_type: str = "3E", serial: int = 0) -> bytes:
+    data = encode_device(device, start_addr, is_ascii) + _encode_number(len(values), 2, is_ascii) + \
+        b"".join(_encode_number(value, 2, is_ascii) for value in values)
+    return encode_request(COMMAND_BATCH_WRITE, SUBCOMMAND_WORD, data, is_ascii, frame_type, serial)
+
+
+def encode_random_write_request(points: typing.Iterable[tuple[str, int, int]], is_ascii: bool = True,
+                                frame_type: str = "3E", serial: int = 0) -> bytes:
+    """
+    Random write of word units, points are (device, addr, value)
+    """
+    points = tuple(points)
+    # word points, double word points
+    data = _encode_number(len(points), 1, is_ascii) + _encode_number(0, 1, is_ascii) + b"".join(
+        encode_device(device, addr, is_ascii) + _encode_number(value, 2, is_ascii) for device, addr, value in points)
+    return encode_request(COMMAND_RANDOM_WRITE, SUBCOMMAND_WORD, data, is_ascii, frame_type, serial)
+
+
+def decode_response(frame: bytes) -> tuple[int, bytes]:
+    """
+    Split a complete response into its end code and data
+    """
+    is_ascii = is_ascii_frame(frame)
+    offset = get_head_size(frame[:2]) + (4 if is_ascii else 2)
+
+    if is_ascii:
+        return int(frame[offset:offset + 4], 16), frame[offset + 4:]
+
+    return struct.unpack_from("<H", frame, offset)[0], frame[offset + 2:]
+
+
+def decode_words(data: bytes, is_ascii: bool) -> tuple:
+    if is_ascii:
+        return tuple(int(data[index:index + 4], 16) for index in range(0, len(data), 4))
+
+    return struct.unpack("<{}H".format(len(data) // 2), data)
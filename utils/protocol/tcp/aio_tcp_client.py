@@ -3,10 +3,16 @@ from typing import Optional
 
 class AioTcpClient:
 
-    def __init__(self, host: str, port: int, timeout=0) -> None:
+    def __init__(self, host: str, port: int, timeout=0, read_timeout=0) -> None:
+        """
+        timeout: seconds to connect, 0 waits forever
+        read_timeout: seconds to wait for the data of a read, 0 waits forever.
+            The connection is closed when a read times out, a late reply can't be taken for the reply of the next request
+        """
         self._host = host
         self._port = port
         self._timeout = timeout
+        self._read_timeout = read_timeout
         self._reader: Optional[asyncio.StreamReader] = None
         self._writer: Optional[asyncio.StreamWriter] = None
 
@@ -45,21 +51,35 @@ class AioTcpClient:
         self._writer.close()
         await self._writer.wait_closed()
 
+    async def _wait_read(self, coro):
+        if not self._read_timeout:
+            return await coro
+
+        # asyncio.timeout() rather than wait_for(): wait_for() of python 3.11 can swallow the cancellation
+        # of the caller when the read completes at the same time
+        try:
+            async with asyncio.timeout(self._read_timeout):
+                return await coro
+        except TimeoutError:
+            assert self._writer is not None
+            self._writer.close()
+            raise
+
     async def read(self, n=-1) -> bytes:
         assert self._reader is not None
-        return await self._reader.read(n)
+        return await self._wait_read(self._reader.read(n))
 
     async def readline(self) -> bytes:
         assert self._reader is not None
-        return await self._reader.readline()
+        return await self._wait_read(self._reader.readline())
 
     async def readexactly(self, n) -> bytes:
         assert self._reader is not None
-        return await self._reader.readexactly(n)
+        return await self._wait_read(self._reader.readexactly(n))
 
     async def readuntil(self, separator=b'\n') -> bytes:
         assert self._reader is not None
-        return await self._reader.readuntil(separator)
+        return await self._wait_read(self._reader.readuntil(separator))
 
     async def open(self, *, limit=2 ** 16, **kwds):
         if self._timeout:
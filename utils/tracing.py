@@ -0,0 +1,352 @@
+"""
+Lightweight span tracing from the http handlers down to the MC frames
+
+    with tracer.start_trace("POST /ssio/request/in/"):     # the tracing middleware
+        with tracer.span("SubDevice.ready_docking"):        # @trace_methods on the device classes
+            with tracer.span("mc.recv_register") as span:   # the MC client
+                span.set("lock_wait_ms", 0.2)
+
+The current span lives in a context variable, outside of a trace span() yields None and costs
+a context variable lookup. The spans of a trace are kept until its root span ends, the trace is then
+exported when it was sampled (`sample_rate`, or forced by the caller) or when it was slower than
+`slow_threshold` seconds, so slow requests are always kept whatever the sample rate.
+At most `force_limit` traces per second are forced, the others fall back to `sample_rate`.
+
+Finished traces are put on a bounded queue, a writer thread serializes them and runs the exporter:
+the event loop never blocks on the file. When the queue is full the trace is dropped and counted.
+The exporter appends one JSON object per span to a file, rotated like RotatingFileHandler
+"""
+import os
+import json
+import time
+import queue
+import random
+import threading
+import inspect
+import functools
+import contextlib
+import contextvars
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from . import metrics
+
+
+# updated by a collector: the writer thread counts the exports, metrics are only updated from the loop thread
+TRACING_STATS = metrics.gauge("tracing_traces", "Pending, exported, dropped and failed traces of the tracer",
+                              ["stat"])
+
+
+def new_id(bits: int = 64) -> str:
+    return "{:0{}x}".format(random.getrandbits(bits), bits // 4)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start", "duration", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any]) -> None:
+        self.trace = trace
+        self.span_id = new_id(32)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.duration = 0.0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool) -> None:
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.spans: List[Span] = []
+
+
+class FileSpanExporter:
+    """
+    Append the spans as JSON lines to `path`, rotated when it would exceed `max_bytes`
+    """
+
+    def __init__(self, path: str, max_bytes: int = 16 * 1024 * 1024, backup_count: int = 5) -> None:
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._file = None
+        self._size = 0
+
+    def __repr__(self) -> str:
+        return "<{} {}>".format(__class__.__name__, self._path)
+
+    def get_path(self) -> str:
+        return self._path
+
+    def _open(self) -> None:
+        dirname = os.path.dirname(self._path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname, exist_ok=True)
+
+        self._file = open(self._path, mode="a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def _rotate(self) -> None:
+        self.close()
+
+        for index in range(self._backup_count - 1, 0, -1):
+            src = "{}.{}".format(self._path, index)
+            if os.path.exists(src):
+                os.replace(src, "{}.{}".format(self._path, index + 1))
+
+        if self._backup_count > 0:
+            os.replace(self._path, "{}.1".format(self._path))
+        else:
+            os.remove(self._path)
+
+        self._open()
+
+    def export(self, spans: List[Span]) -> None:
+        data = "".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n" for span in spans)
+
+        if self._file is None:
+            self._open()
+        elif self._size and self._size + len(data) > self._max_bytes:
+            self._rotate()
+
+        assert self._file is not None
+
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("tracing_span", default=None)
+
+
+def get_current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def annotate(**attributes: Any) -> None:
+    """
+    Add attributes to the current span, if any
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.attributes.update(attributes)
+
+
+class Tracer:
+    def __init__(self, exporter: Optional[FileSpanExporter] = None, enable: bool = False,
+                 sample_rate: float = 0.01, slow_threshold: Optional[float] = 1, force_limit: int = 10,
+                 max_pending: int = 1000) -> None:
+        self._exporter = exporter
+        self._enable = enable
+        self._sample_rate = sample_rate
+        self._slow_threshold = slow_threshold
+        self._force_limit = force_limit
+
+        # forced traces in the current second
+        self._force_window = 0
+        self._forced = 0
+
+        self._queue: queue.Queue = queue.Queue(max_pending)
+        self._writer: Optional[threading.Thread] = None
+        self._stats: Dict[str, int] = {"exported": 0, "dropped": 0, "errors": 0}
+
+        metrics.add_collector(self.collect_metrics)
+
+    def configure(self, exporter: Optional[FileSpanExporter] = None, enable: Optional[bool] = None,
+                  sample_rate: Optional[float] = None, slow_threshold: Optional[float] = None,
+                  force_limit: Optional[int] = None) -> None:
+        if exporter is not None:
+            if self._exporter is not None:
+                self._exporter.close()
+            self._exporter = exporter
+        if enable is not None:
+            self._enable = enable
+        if sample_rate is not None:
+            self._sample_rate = sample_rate
+        if slow_threshold is not None:
+            self._slow_threshold = slow_threshold
+        if force_limit is not None:
+            self._force_limit = force_limit
+
+    def is_enabled(self) -> bool:
+        return self._enable and self._exporter is not None
+
+    def get_exported(self) -> int:
+        """
+        Number of traces exported
+        """
+        return self._stats["exported"]
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        return stats
+
+    def collect_metrics(self) -> None:
+        for key, value in self.get_stats().items():
+            TRACING_STATS.labels(key).set(value)
+
+    def _allow_forced(self) -> bool:
+        window = int(time.monotonic())
+        if window != self._force_window:
+            self._force_window = window
+            self._forced = 0
+
+        self._forced += 1
+        return self._forced <= self._force_limit
+
+    @contextlib.contextmanager
+    def _open_span(self, trace: Trace, name: str, parent_id: Optional[str],
+                   attributes: Dict[str, Any]) -> Iterator[Span]:
+        span = Span(trace, name, parent_id, attributes)
+        token = _current_span.set(span)
+        started_at = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = repr(e)
+            raise
+        finally:
+            span.duration = time.perf_counter() - started_at
+            _current_span.reset(token)
+            trace.spans.append(span)
+
+    @contextlib.contextmanager
+    def start_trace(self, name: str, trace_id: Optional[str] = None, sampled: Optional[bool] = None,
+                    **attributes: Any) -> Iterator[Optional[Span]]:
+        """
+        Open the root span of a new trace, yields None when the tracing is disabled
+        A given `trace_id` is kept (e.g. from a request header), `sampled` forces the sampling decision,
+        sampled=True beyond `force_limit` traces per second is sampled at `sample_rate` instead
+        """
+        if not self.is_enabled():
+            yield None
+            return
+
+        if sampled and not self._allow_forced():
+            sampled = None
+
+        if sampled is None:
+            sampled = random.random() < self._sample_rate
+
+        trace = Trace(trace_id or new_id(), sampled)
+
+        try:
+            with self._open_span(trace, name, None, attributes) as span:
+                yield span
+        finally:
+            self._finish(trace, span)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+        """
+        Open a child span of the current span, yields None outside of a trace
+        """
+        parent = _current_span.get()
+
+        if parent is None:
+            yield None
+            return
+
+        with self._open_span(parent.trace, name, parent.span_id, attributes) as span:
+            yield span
+
+    def _finish(self, trace: Trace, root: Span) -> None:
+        slow = self._slow_threshold is not None and root.duration >= self._slow_threshold
+
+        if not (trace.sampled or slow) or self._exporter is None:
+            return
+
+        root.set("slow", slow)
+
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self._stats["dropped"] += 1
+            return
+
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name="tracing-exporter", daemon=True)
+            self._writer.start()
+
+    def _run(self) -> None:
+        while True:
+            trace = self._queue.get()
+            if trace is None:
+                return
+
+            exporter = self._exporter
+            if exporter is None:
+                continue
+
+            try:
+                exporter.export(trace.spans)
+                self._stats["exported"] += 1
+            except Exception as e:
+                self._stats["errors"] += 1
+                from . import log
+                log.error("export trace {} to {!r} failed: {!r}".format(trace.trace_id, exporter, e))
+
+    def close(self) -> None:
+        """
+        Stop the writer thread after the queued traces are exported and close the exporter
+        """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+        if self._exporter is not None:
+            self._exporter.close()
+
+
+tracer = Tracer()
+
+
+def traced(name: str) -> Callable:
+    """
+    Trace every call of a coroutine function as the span `name`
+    """
+    def inner(coro):
+        @functools.wraps(coro)
+        async def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return await coro(*args, **kwargs)
+
+            with tracer.span(name):
+                return await coro(*args, **kwargs)
+        return wrapper
+    return inner
+
+
+def trace_methods(cls: type) -> type:
+    """
+    Trace the public coroutine methods defined by a class as <class name>.<method name>
+    """
+    for name, value in list(vars(cls).items()):
+        if not name.startswith("_") and inspect.iscoroutinefunction(value):
+            setattr(cls, name, traced("{}.{}".format(cls.__name__, name))(value))
+    return cls